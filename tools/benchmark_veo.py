@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+"""
+视频生成流水线基准测试：用本地模拟的 Veo 服务端测量提交、轮询、下载路径的吞吐
+不调用真实 API、不消耗配额，可以在改动调度逻辑前后对比
+
+示例:
+  python tools/benchmark_veo.py --clips 20 --parallel 1 4 8 --keys 1 3 5
+  python tools/benchmark_veo.py --poller fixed adaptive --rate-429 0.1 --server-rpm 2
+  python tools/benchmark_veo.py --tail-rate 0.1 --hedge-model veo-3.0-fast-generate-001
+"""
+
+import io
+import os
+import sys
+import argparse
+import itertools
+import tempfile
+import contextlib
+
+import generate_videos_veo as veo
+import veo_simulator as sim
+
+
+class FixedPoller(veo.AdaptivePoller):
+    """旧实现：固定每 10 秒查询一次"""
+
+    def next_interval(self, elapsed: float) -> float:
+        return 10.0
+
+
+def make_poller(kind: str, clock):
+    if kind == "fixed":
+        return FixedPoller(clock=clock)
+    return veo.AdaptivePoller(clock=clock)
+
+
+def run_scenario(args, parallel: int, key_count: int, poller_kind: str) -> dict:
+    """跑一组参数，返回统计结果（时间均为模拟秒）"""
+    clock = sim.ScaledClock(args.scale)
+    profile = sim.SimulationProfile(
+        queue_latency=args.queue_latency,
+        generation_time=args.generation_time,
+        generation_jitter=args.generation_jitter,
+        tail_rate=args.tail_rate,
+        tail_factor=args.tail_factor,
+        model_time_scale={args.hedge_model: args.hedge_speedup} if args.hedge_model else {},
+        rate_429=args.rate_429,
+        key_rpm_limit=args.server_rpm,
+        failure_rate=args.failure_rate,
+        payload_bytes=int(args.payload_mb * 1024 * 1024),
+        download_mbps=args.download_mbps,
+        seed=args.seed,
+    )
+    server = sim.SimulatedVeoServer(profile, clock)
+    key_pool = veo.KeyPool([f"sim-key-{i}" for i in range(key_count)],
+                           rate_per_minute=args.key_rpm, clock=clock,
+                           backend_factory=lambda key: sim.SimulatedBackend(key, server))
+
+    with tempfile.TemporaryDirectory(prefix="veo-bench-") as assets_dir:
+        frame_path = os.path.join(assets_dir, "start.jpg")
+        with open(frame_path, "wb") as f:
+            f.write(b"\xff\xd8\xff\xd9")
+        start_frame = veo.StartFrame(frame_path)
+
+        hedge = {"model": args.hedge_model, "percentile": args.hedge_percentile} if args.hedge_model else None
+        scheduler = veo.VideoScheduler(key_pool, parallel=parallel, clock=clock,
+                                       poller=make_poller(poller_kind, clock), hedge=hedge)
+        for i in range(args.clips):
+            scheduler.add(veo.VideoJob(f"clip{i:03d}", "benchmark", 6, start_frame, assets_dir))
+
+        started = clock.monotonic()
+        with contextlib.redirect_stdout(io.StringIO()):
+            scheduler.run()
+        elapsed = clock.monotonic() - started
+
+    done = len(scheduler.succeeded)
+    time_to_asset = [job.timings["done"] - job.timings["queued"] for job in scheduler.succeeded]
+    # 发现延迟：服务端完成到客户端查询到完成之间的时间，只取决于轮询策略
+    detect_delay = [job.timings["generated"] - server.operations[job.operation.name][1]
+                    for job in scheduler.succeeded]
+    return {
+        "poller": poller_kind,
+        "parallel": parallel,
+        "keys": key_count,
+        "done": done,
+        "failed": len(scheduler.failed),
+        "elapsed": elapsed,
+        "clips_per_min": done / elapsed * 60 if elapsed else 0.0,
+        "p50": veo.percentile(time_to_asset, 50),
+        "p95": veo.percentile(time_to_asset, 95),
+        "detect_p50": veo.percentile(detect_delay, 50),
+        "detect_p95": veo.percentile(detect_delay, 95),
+        "status_per_clip": server.status_calls / done if done else float("nan"),
+        "quota_429": server.quota_rejections,
+        "hedges": scheduler.hedges_launched,
+        "hedge_wins": len(scheduler.hedge_wins),
+    }
+
+
+def print_table(results: list):
+    header = (f"{'轮询':<9}{'并发':>5}{'Keys':>6}{'成功':>6}{'失败':>6}{'总耗时(s)':>11}"
+              f"{'片/分钟':>9}{'p50(s)':>9}{'p95(s)':>9}{'发现p50':>9}{'发现p95':>9}{'查询/片':>9}"
+              f"{'429':>6}{'对冲':>6}{'胜出':>6}")
+    print(header)
+    print("-" * 115)
+    for r in results:
+        print(f"{r['poller']:<9}{r['parallel']:>5}{r['keys']:>6}{r['done']:>6}{r['failed']:>6}"
+              f"{r['elapsed']:>11.0f}{r['clips_per_min']:>9.2f}{r['p50']:>9.0f}{r['p95']:>9.0f}"
+              f"{r['detect_p50']:>9.1f}{r['detect_p95']:>9.1f}"
+              f"{r['status_per_clip']:>9.1f}{r['quota_429']:>6}{r['hedges']:>6}{r['hedge_wins']:>6}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Veo 生成流水线基准测试（本地模拟服务端）')
+    parser.add_argument('--clips', type=int, default=20, help='每组测试生成的视频数 (默认: 20)')
+    parser.add_argument('--parallel', type=int, nargs='+', default=[1, 4, 8],
+                        help='要测试的并发数 (默认: 1 4 8)')
+    parser.add_argument('--keys', type=int, nargs='+', default=[1, 3],
+                        help='要测试的 API Key 数量 (默认: 1 3)')
+    parser.add_argument('--poller', nargs='+', choices=['adaptive', 'fixed'], default=['adaptive'],
+                        help='轮询策略：adaptive 为当前实现，fixed 为旧的固定 10 秒 (默认: adaptive)')
+    parser.add_argument('--key-rpm', type=float, default=veo.KEY_SUBMITS_PER_MINUTE,
+                        help=f'客户端每个 Key 每分钟提交上限 (默认: {veo.KEY_SUBMITS_PER_MINUTE})')
+    parser.add_argument('--server-rpm', type=float, default=0,
+                        help='模拟服务端每个 Key 每分钟提交上限，超出返回 429 (默认: 0 不限)')
+    parser.add_argument('--queue-latency', type=float, default=20, help='平均排队时间，秒 (默认: 20)')
+    parser.add_argument('--generation-time', type=float, default=60, help='平均生成时间，秒 (默认: 60)')
+    parser.add_argument('--generation-jitter', type=float, default=15, help='生成时间标准差，秒 (默认: 15)')
+    parser.add_argument('--tail-rate', type=float, default=0,
+                        help='长尾 operation 的比例，生成时间乘以 --tail-factor (默认: 0)')
+    parser.add_argument('--tail-factor', type=float, default=4, help='长尾 operation 的耗时倍数 (默认: 4)')
+    parser.add_argument('--hedge-model', help='开启对冲并指定备用模型名 (默认: 不对冲)')
+    parser.add_argument('--hedge-percentile', type=float, default=veo.HEDGE_PERCENTILE,
+                        help=f'发起对冲的耗时百分位 (默认: {veo.HEDGE_PERCENTILE})')
+    parser.add_argument('--hedge-speedup', type=float, default=0.5,
+                        help='备用模型的生成时间倍数 (默认: 0.5)')
+    parser.add_argument('--rate-429', type=float, default=0, help='每次提交随机 429 的概率 (默认: 0)')
+    parser.add_argument('--failure-rate', type=float, default=0, help='生成失败概率 (默认: 0)')
+    parser.add_argument('--payload-mb', type=float, default=2, help='每个视频大小，MB (默认: 2)')
+    parser.add_argument('--download-mbps', type=float, default=0, help='下载带宽 MB/s (默认: 0 不限)')
+    parser.add_argument('--scale', type=float, default=200,
+                        help='时间加速倍数，模拟 1 分钟 = 真实 60/scale 秒 (默认: 200)')
+    parser.add_argument('--seed', type=int, default=1, help='随机种子 (默认: 1)')
+    args = parser.parse_args()
+
+    if args.scale <= 0:
+        parser.error("--scale 必须 > 0")
+
+    print("=" * 50)
+    print("Veo 流水线基准测试（模拟服务端）")
+    print("=" * 50)
+    print(f"每组视频数: {args.clips}, 排队 {args.queue_latency:.0f}s + 生成 "
+          f"{args.generation_time:.0f}±{args.generation_jitter:.0f}s, 429 概率 {args.rate_429}, "
+          f"时间加速 {args.scale:g}x")
+    print()
+
+    results = []
+    for poller_kind, parallel, key_count in itertools.product(args.poller, args.parallel, args.keys):
+        print(f"运行: 轮询={poller_kind}, 并发={parallel}, Keys={key_count}...", file=sys.stderr)
+        results.append(run_scenario(args, parallel, key_count, poller_kind))
+    print_table(results)
+
+
+if __name__ == "__main__":
+    main()
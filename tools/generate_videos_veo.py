@@ -1,337 +1,254 @@
 #!/usr/bin/env python3
 """
 使用 Google Veo API 为数字人角色生成动作视频
-支持多角色：通过 -c 参数指定角色 ID
+支持多角色：通过 -c 参数指定角色 ID，提示词定义在 characters/<id>/prompts.json
 使用 image_to_video 方法，在 prompt 中强调回到起始姿势
 """
 
 import os
+import re
 import sys
+import json
+import hashlib
+import functools
+import glob
+import struct
 import time
+import random
+import statistics
 import argparse
 import mimetypes
-
-try:
-    from google import genai
-    from google.genai import types
-except ImportError:
-    print("Error: google-genai not installed. Run: pip install google-genai")
-    sys.exit(1)
-
-try:
-    from PIL import Image
-except ImportError:
-    print("Error: Pillow not installed. Run: pip install Pillow")
-    sys.exit(1)
+import shutil
+import threading
+import tempfile
+import subprocess
+import sqlite3
+import uuid
+import hmac
+import secrets
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from concurrent.futures import (FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor,
+                                wait as wait_futures)
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Any, Optional
 
 # 配置
 VIDEO_MODEL = "veo-3.1-generate-preview"
 TARGET_ASPECT_RATIO = 9 / 16
 MIN_WIDTH = 360
 MIN_HEIGHT = 640
+VEO_INPUT_SIZE = (720, 1280)  # Veo 9:16 输出分辨率，更大的起始帧只会增加上传量
+START_FRAME_CACHE_DIR = ".veo-cache"
 
 TOOLS_DIR = os.path.dirname(os.path.abspath(__file__))
 PROJECT_DIR = os.path.dirname(TOOLS_DIR)
 CHARACTERS_DIR = os.path.join(PROJECT_DIR, "characters")
 
 # ============================================================
-# 角色配置：每个角色的描述和动作提示词
-# ============================================================
-
-CHARACTERS = {}
-
-# ---------- 狐小狸 (fox-xiaoli) ----------
-
-_FOX_CHARACTER = (
-    "A cute cartoon 3D orange fox cub with big round brown eyes, white fluffy chest fur, "
-    "and a bushy orange tail with a white tip, sitting on green grass in a sunlit forest"
-)
-
-CHARACTERS["fox-xiaoli"] = {
-    "name": "狐小狸",
-    "emoji": "🦊",
-    "character": _FOX_CHARACTER,
-    "videos": {
-        "idle": (
-            f"{_FOX_CHARACTER}. The little fox sits perfectly still in a calm, relaxed resting pose. "
-            "Extremely subtle, lifelike micro-movements only: very slow gentle breathing motion in the chest, "
-            "occasional soft blink, and the tiniest ear twitch. "
-            "No head movement, no paw movement, no body shifting. "
-            "The overall impression is a peaceful, living creature at rest. Very minimal and natural. "
-            "The pose at the end is exactly the same as the beginning, creating a seamless loop.",
-            6
-        ),
-        "speaking": (
-            f"{_FOX_CHARACTER}. The little fox has subtle mouth movements and gentle facial expression changes. "
-            "Its mouth opens and closes slightly as if talking, showing a friendly expression. "
-            "Subtle ear twitching. "
-            "At the end, it returns to the exact same neutral pose as the beginning with a calm, gentle smile.",
-            6
-        ),
-        "listening": (
-            f"{_FOX_CHARACTER}. The little fox turns its head to the side and raises one front paw to its ear, "
-            "then holds completely still in this listening pose. "
-            "No mouth movement, no blinking, no body movement - perfectly still and focused. "
-            "The expression is calm, quiet, and deeply concentrated, like carefully listening to a faint sound. "
-            "The pose is maintained motionless throughout, simulating a real attentive listener. "
-            "At the end, it slowly lowers its paw and turns back, returning to the exact same neutral pose as the beginning, "
-            "with its head centered and a calm expression.",
-            6
-        ),
-        "wave": (
-            f"{_FOX_CHARACTER}. The little fox raises one front paw and waves hello with a playful, cheerful expression. "
-            "Its tail sways gently with excitement. The movement is cute and energetic. "
-            "At the end, it lowers its paw and returns to the exact same neutral pose as the beginning, "
-            "sitting calmly with paws on the ground.",
-            6
-        ),
-        "nod": (
-            f"{_FOX_CHARACTER}. The little fox simply nods its head up and down slowly and clearly, showing agreement. "
-            "Only the head moves - no paw movement, no body movement, no other gestures. "
-            "The mouth stays closed, the body stays perfectly still, only the head nods gently. "
-            "A soft, approving smile on its face. Minimal and clean motion. "
-            "At the end, it stops nodding and returns to the exact same neutral pose as the beginning, "
-            "with its head level and a calm expression.",
-            6
-        ),
-        "think": (
-            f"{_FOX_CHARACTER}. The little fox shows a thoughtful expression, tilting its head slightly "
-            "and looking upward with one paw raised near its chin. Its eyes look contemplative and curious. "
-            "At the end, it lowers its paw and returns to the exact same neutral pose as the beginning, "
-            "with a calm, neutral expression.",
-            6
-        ),
-        "sneeze": (
-            f"{_FOX_CHARACTER}. The little fox's nose twitches rapidly, its eyes squint, "
-            "then it lets out an adorable big sneeze - head jerking forward with ears flattening back. "
-            "After the sneeze, it shakes its head and looks slightly dazed with a funny expression. "
-            "At the end, it returns to the exact same neutral pose as the beginning, "
-            "with a calm, gentle smile.",
-            6
-        ),
-        "shy": (
-            f"{_FOX_CHARACTER}. The little fox suddenly becomes shy and bashful. "
-            "It covers its face with both front paws, ears flatten back, and its tail curls around its body. "
-            "It peeks through its paws with one eye, looking adorably embarrassed. "
-            "At the end, it lowers its paws and returns to the exact same neutral pose as the beginning, "
-            "sitting calmly with a gentle smile.",
-            6
-        ),
-        "tail_wag": (
-            f"{_FOX_CHARACTER}. The little fox looks back at its own bushy tail, then starts wagging it "
-            "enthusiastically from side to side with pure joy. Its whole body wiggles slightly with the movement. "
-            "It looks happy and excited, ears perked up. "
-            "At the end, it stops wagging and returns to the exact same neutral pose as the beginning, "
-            "sitting calmly facing forward.",
-            6
-        ),
-    },
-}
+# 依赖：google-genai、Pillow、NumPy 导入很慢，只在真正用到时才导入，
+# 这样 --list、参数错误等不需要等待
+# ============================================================
 
-# ---------- 星罗猫 (star-cat) ----------
-
-_CAT_CHARACTER = (
-    "A cute cartoon 3D lavender-gray cat with glowing constellation star-line patterns on its fur, "
-    "large deep-blue eyes with starlight reflections, small rounded ears with inner purple glow, "
-    "wearing a midnight blue hoodie with a crescent moon embroidery on the chest, "
-    "fluffy tail with gradient from lavender to deep indigo with twinkling star particles at the tip. "
-    "The cat is sitting on dark rooftop tiles at night. "
-    "Background: starry sky with constellations, crescent moon, distant warm city lights in soft bokeh, depth-of-field blur"
-)
-
-CHARACTERS["star-cat"] = {
-    "name": "星罗猫",
-    "emoji": "🐱",
-    "character": _CAT_CHARACTER,
-    "videos": {
-        "idle": (
-            f"{_CAT_CHARACTER}. The cat sits perfectly still in a calm, elegant posture on the rooftop edge. "
-            "Paws neatly together in front, tail gently curled around its body. "
-            "Extremely subtle, lifelike micro-movements only: very slow gentle breathing motion, "
-            "occasional soft blink. No head movement, no paw movement, no body shifting. "
-            "Regal, composed, dignified demeanor. The overall impression is a noble, peaceful creature at rest. "
-            "The pose at the end is exactly the same as the beginning, creating a seamless loop.",
-            6
-        ),
-        "speaking": (
-            f"{_CAT_CHARACTER}. The cat is speaking with subtle lip movements, "
-            "mouth opening and closing gently as if explaining something. "
-            "One front paw lifts slightly in a gentle gesture. "
-            "Eyes warm and engaged, looking directly at the camera. "
-            "The cat remains in a relaxed upright seated pose on the rooftop throughout. "
-            "No body shifting, no standing up, no leaning forward or backward. "
-            "IMPORTANT: The first frame and last frame must be nearly identical — "
-            "the cat in the same calm seated pose, paws together on the ground, head centered, gentle smile. "
-            "This ensures seamless looping.",
-            6
-        ),
-        "speaking_v2": (
-            f"{_CAT_CHARACTER}. The cat is speaking with subtle natural lip movements. "
-            "One front paw lifts just slightly off the ground in a small unconscious gesture, "
-            "like a person casually moving their hand while chatting — understated, not exaggerated. "
-            "The tail tip sways gently, a slow lazy movement. "
-            "Occasional soft blink, relaxed warm eyes looking at the camera. "
-            "Natural and conversational, not performative. "
-            "The cat remains in a relaxed upright seated pose on the rooftop throughout. "
-            "No big movements, no standing up, no leaning forward or backward. "
-            "IMPORTANT: The first frame and last frame must be nearly identical — "
-            "the cat in the same calm seated pose, paws together on the ground, head centered, gentle smile. "
-            "This ensures seamless looping and smooth transition from other speaking clips.",
-            6
-        ),
-        "listening": (
-            f"{_CAT_CHARACTER}. The cat tilts its head clearly to one side, "
-            "one ear perked up noticeably higher than the other, leaning in attentively. "
-            "Eyes wide and focused, looking straight at the camera with full attention. "
-            "Mouth firmly closed. Body holds completely still and perfectly steady. "
-            "No mouth movement, no fidgeting, no body shifting. "
-            "Only the head tilt and ear position show active listening. Still, focused, attentive. "
-            "At the end, it slowly straightens its head, returning to the exact same neutral pose as the beginning, "
-            "with head centered and a calm expression.",
-            6
-        ),
-        "wave": (
-            f"{_CAT_CHARACTER}. The cat raises its right paw up high in a clear friendly wave, "
-            "paw pads visible, fingers spread slightly. The left paw stays resting on the rooftop tile. "
-            "A cheerful bright smile with eyes slightly squinted from joy. Tail lifts gently behind. "
-            "No body shifting from the seated position, no standing up. Only the right paw waves. "
-            "At the end, it lowers its paw and returns to the exact same neutral pose as the beginning, "
-            "sitting calmly with paws together.",
-            6
-        ),
-        "nod": (
-            f"{_CAT_CHARACTER}. The cat simply nods slowly and clearly, chin moving downward toward the chest. "
-            "Eyes half-closed with a warm agreeing smile. Only the head moves, body stays perfectly still "
-            "in seated position. Both paws rest neatly in front. "
-            "No dramatic movement, no body swaying. A gentle, single, clear nod. Subtle and graceful. "
-            "At the end, it stops nodding and returns to the exact same neutral pose as the beginning, "
-            "with its head level and a calm expression.",
-            6
-        ),
-        "think": (
-            f"{_CAT_CHARACTER}. The cat raises one paw to its chin in a classic thinking pose, "
-            "looking upward at the starry sky with a contemplative expression. "
-            "Eyes gazing up and to the side, eyebrows slightly furrowed in concentration. "
-            "The constellation patterns on the fur glow slightly brighter. "
-            "Mouth in a small thoughtful pout. Body stays still in seated position. No extra movements. "
-            "Only the paw-on-chin and upward gaze show thinking. "
-            "At the end, it lowers its paw and returns to the exact same neutral pose as the beginning, "
-            "looking straight at the camera with a calm expression.",
-            6
-        ),
-        "sneeze": (
-            f"{_CAT_CHARACTER}. The cat squeezes its eyes tightly shut with nose scrunched up, "
-            "head tilting back slightly in a sneeze. "
-            "Tiny glowing star particles burst from the nose like magical sparkles. "
-            "Both paws clutch the front of the hoodie. Constellation patterns on fur flicker. "
-            "A cute involuntary expression. No body shifting from seated position. "
-            "At the end, it returns to the exact same neutral pose as the beginning, "
-            "sitting calmly with a gentle smile.",
-            6
-        ),
-        "shy": (
-            f"{_CAT_CHARACTER}. The cat covers its face with both paws in a bashful shy pose, "
-            "peeking through the gap between paws with one eye visible. Ears flattened back slightly. "
-            "Tail curls tightly around the body. A soft blush glow appears on cheeks. "
-            "Body stays in seated position on rooftop. No standing, no body shifting. "
-            "Only the paws covering face and peeking eye show shyness. "
-            "At the end, it lowers its paws and returns to the exact same neutral pose as the beginning, "
-            "sitting calmly with a gentle smile.",
-            6
-        ),
-        "tail_wag": (
-            f"{_CAT_CHARACTER}. The cat sits calmly facing the camera. "
-            "Its fluffy tail slowly rises behind it and sways gently from side to side, "
-            "with a soft faint glow at the tip. "
-            "The cat notices its own tail moving and glances back briefly with a small curious smile, "
-            "then looks back at the camera with a content, happy expression. "
-            "The movement is gentle and lazy, not fast or energetic. "
-            "Body stays seated, paws stay on the ground. No standing, no jumping, no paw gestures. "
-            "At the end, the tail settles down and the cat returns to the exact same neutral pose as the beginning, "
-            "sitting calmly facing the camera with a gentle smile.",
-            6
-        ),
-    },
-}
+def import_genai():
+    try:
+        from google import genai
+        from google.genai import errors, types
+    except ImportError:
+        print("Error: google-genai not installed. Run: pip install google-genai")
+        sys.exit(1)
+    return genai, types, errors
+
+
+def import_pil():
+    try:
+        from PIL import Image
+    except ImportError:
+        print("Error: Pillow not installed. Run: pip install Pillow")
+        sys.exit(1)
+    return Image
+
+
+def import_numpy():
+    try:
+        import numpy
+    except ImportError:
+        print("Error: NumPy not installed. Run: pip install numpy")
+        sys.exit(1)
+    return numpy
 
 
 # ============================================================
-# 图片处理
+# 角色配置：每个角色的描述和动作提示词在 characters/<id>/prompts.json
 # ============================================================
 
-def convert_png_to_jpg(png_path: str) -> str:
-    """将 PNG (可能含 RGBA 透明通道) 转为 JPG，返回 JPG 路径"""
-    jpg_path = png_path.rsplit('.', 1)[0] + '.jpg'
-    if os.path.exists(jpg_path):
-        print(f"✓ JPG 已存在: {jpg_path}")
-        return jpg_path
-
-    print(f"转换 PNG → JPG: {png_path}")
-    img = Image.open(png_path)
-    if img.mode == 'RGBA':
-        bg = Image.new('RGB', img.size, (0, 0, 0))  # 黑色背景（夜景）
-        bg.paste(img, mask=img.split()[3])
-        img = bg
-    elif img.mode != 'RGB':
-        img = img.convert('RGB')
-    img.save(jpg_path, quality=95)
-    print(f"✓ 转换完成: {jpg_path}")
-    return jpg_path
-
-
-def check_and_crop_image(image_path: str, backup: bool = True) -> tuple:
-    """检查图片宽高比，如果不是 9:16 则自动裁剪"""
-    img = Image.open(image_path)
-    w, h = img.size
-    current_ratio = w / h
+PROMPTS_NAME = "prompts.json"
+
+
+def list_characters() -> list:
+    """characters/index.json 中有 prompts.json 的角色，按前端展示顺序"""
+    with open(os.path.join(CHARACTERS_DIR, "index.json"), encoding="utf-8") as f:
+        character_ids = json.load(f)
+    return [c for c in character_ids
+            if os.path.exists(os.path.join(CHARACTERS_DIR, c, PROMPTS_NAME))]
+
 
-    print(f"图片尺寸: {w}x{h}, 宽高比: {current_ratio:.4f}")
-    print(f"目标宽高比: {TARGET_ASPECT_RATIO:.4f} (9:16)")
+def load_character(character_id: str) -> dict:
+    """读取角色的提示词定义
 
-    if abs(current_ratio - TARGET_ASPECT_RATIO) < 0.01:
-        print("✓ 图片宽高比已经是 9:16，无需裁剪")
-        if w < MIN_WIDTH or h < MIN_HEIGHT:
-            return False, f"图片尺寸太小（{w}x{h}），最小要求 {MIN_WIDTH}x{MIN_HEIGHT}"
-        return True, "图片已符合要求"
+    prompts.json 中动作 prompt 里的 {character} 会替换为角色描述。
+    返回 {"name", "emoji", "character", "videos": {动作: (prompt, 时长)},
+    "motion": {动作: 预期运动量 low / medium / high}}。
+    结果按文件修改时间缓存：常驻服务运行期间改了 prompts.json，下一个请求就会用到新内容。
+    """
+    path = os.path.join(CHARACTERS_DIR, character_id, PROMPTS_NAME)
+    stat = os.stat(path)
+    return _load_character(path, stat.st_mtime_ns, stat.st_size)
 
-    print(f"图片宽高比不是 9:16，需要裁剪...")
 
-    if current_ratio > TARGET_ASPECT_RATIO:
+@functools.lru_cache(maxsize=32)
+def _load_character(path: str, mtime_ns: int, size: int) -> dict:
+    with open(path, encoding="utf-8") as f:
+        data = json.load(f)
+    description = data["character"]
+    return {
+        "name": data["name"],
+        "emoji": data["emoji"],
+        "character": description,
+        "videos": {
+            action: (video["prompt"].replace("{character}", description), video["duration"])
+            for action, video in data["videos"].items()
+        },
+        "motion": {action: video.get("motion", "medium") for action, video in data["videos"].items()},
+    }
+
+
+# ============================================================
+# 图片处理
+# ============================================================
+
+def find_idle_image(assets_dir: str) -> Optional[str]:
+    """查找 idle 图片（优先 jpg，其次 png）"""
+    for name in ("idle.jpg", "idle.png"):
+        path = os.path.join(assets_dir, name)
+        if os.path.exists(path):
+            return path
+    return None
+
+
+def _crop_box(w: int, h: int) -> tuple:
+    """居中裁剪到 9:16 的区域 (left, top, right, bottom)"""
+    if w / h > TARGET_ASPECT_RATIO:
         new_w = int(h * TARGET_ASPECT_RATIO)
-        new_h = h
         left = (w - new_w) // 2
-        crop_box = (left, 0, left + new_w, h)
-        print(f"裁剪方式: 左右裁剪，保留中间 {new_w} 像素宽度")
-    else:
-        new_w = w
-        new_h = int(w / TARGET_ASPECT_RATIO)
-        left = 0
-        top = (h - new_h) // 2
-        crop_box = (left, top, w, top + new_h)
-        print(f"裁剪方式: 上下裁剪，保留中间 {new_h} 像素高度")
-
-    if new_w < MIN_WIDTH or new_h < MIN_HEIGHT:
-        return False, (
-            f"裁剪后尺寸太小（{new_w}x{new_h}），最小要求 {MIN_WIDTH}x{MIN_HEIGHT}。\n"
+        return (left, 0, left + new_w, h)
+    new_h = int(w / TARGET_ASPECT_RATIO)
+    top = (h - new_h) // 2
+    return (0, top, w, top + new_h)
+
+
+def update_poster(source_path: str, frame_path: str, cropped: bool):
+    """前端用 idle.jpg 作为 poster，它必须存在且是 9:16
+
+    PNG 源图没有对应 jpg 时生成一份；jpg 源图被裁剪时先把原图存进内容仓库
+    （原样字节，不重新编码，可用 rollback 取回），再用裁剪后的起始帧替换。
+    """
+    assets_dir = os.path.dirname(source_path)
+    poster_path = os.path.join(assets_dir, "idle.jpg")
+    if source_path == poster_path:
+        if not cropped:
+            return
+        if store_commit(assets_dir, "idle.jpg", "original"):
+            print(f"原图已存入内容仓库: {store_root(assets_dir)}")
+    elif os.path.exists(poster_path):
+        return
+    tmp_path = poster_path + ".tmp"
+    shutil.copyfile(frame_path, tmp_path)
+    os.replace(tmp_path, poster_path)
+    store_commit(assets_dir, "idle.jpg", "poster")
+    print(f"✓ 已更新 poster: {poster_path}")
+
+
+def prepare_start_frame(source_path: str, crop: bool = True, poster: bool = True) -> tuple:
+    """一次解码完成起始帧预处理：透明通道铺黑底、裁剪到 9:16、缩小到 Veo 输入分辨率
+
+    结果按源文件哈希缓存在 assets/.veo-cache/，源图不变时不再解码。
+    JPEG 用 draft() 按需降采样解码，4K 以上的原图也不会整张解到内存里。
+    poster=False 时不更新 idle.jpg、不写内容仓库（--plan 只读不改）。
+    返回 (起始帧路径, 说明)，失败时路径为 None。
+    """
+    assets_dir = os.path.dirname(source_path)
+    with open(source_path, 'rb') as f:
+        source_bytes = f.read()
+    cache_key = hashlib.sha256(source_bytes)
+    cache_key.update(f"|{VEO_INPUT_SIZE}|crop={crop}".encode())
+    cache_dir = os.path.join(assets_dir, START_FRAME_CACHE_DIR)
+    frame_path = os.path.join(cache_dir, f"start-{cache_key.hexdigest()[:16]}.jpg")
+    if os.path.exists(frame_path):
+        return frame_path, "起始帧已缓存"
+
+    Image = import_pil()
+    img = Image.open(source_path)
+    w, h = img.size
+    print(f"图片尺寸: {w}x{h}, 宽高比: {w / h:.4f}")
+
+    needs_crop = crop and abs(w / h - TARGET_ASPECT_RATIO) >= 0.01
+    box = _crop_box(w, h) if needs_crop else (0, 0, w, h)
+    crop_w, crop_h = box[2] - box[0], box[3] - box[1]
+    if crop_w < MIN_WIDTH or crop_h < MIN_HEIGHT:
+        return None, (
+            f"{'裁剪后' if needs_crop else '图片'}尺寸太小（{crop_w}x{crop_h}），"
+            f"最小要求 {MIN_WIDTH}x{MIN_HEIGHT}。\n"
             f"请上传更大的图片，建议至少 {MIN_WIDTH}x{MIN_HEIGHT} 像素，宽高比接近 9:16。"
         )
 
-    cropped = img.crop(crop_box)
-
-    if backup:
-        backup_path = image_path.rsplit('.', 1)
-        backup_path = f"{backup_path[0]}_original.{backup_path[1]}"
-        if not os.path.exists(backup_path):
-            img.save(backup_path)
-            print(f"原图已备份到: {backup_path}")
-
-    if image_path.lower().endswith(('.jpg', '.jpeg')):
-        cropped.save(image_path, quality=95)
+    scale = min(1.0, VEO_INPUT_SIZE[0] / crop_w, VEO_INPUT_SIZE[1] / crop_h)
+    out_size = (round(crop_w * scale), round(crop_h * scale))
+    already_final = (not needs_crop and scale == 1.0
+                     and img.format == "JPEG" and img.mode == "RGB")
+
+    os.makedirs(cache_dir, exist_ok=True)
+    # 临时文件名唯一：服务模式的多个请求、同时运行的其他进程可能在处理同一张图
+    fd, tmp_path = tempfile.mkstemp(prefix=".start-", suffix=".jpg.tmp", dir=cache_dir)
+    os.close(fd)
+    if already_final:
+        # 已经是目标格式和尺寸：直接使用原始字节，避免重复 JPEG 压缩
+        with open(tmp_path, 'wb') as f:
+            f.write(source_bytes)
+        message = "图片已符合要求"
     else:
-        cropped.save(image_path)
-
-    print(f"✓ 裁剪完成: {new_w}x{new_h}, 宽高比: {new_w/new_h:.4f}")
-    return True, f"图片已裁剪为 {new_w}x{new_h}"
+        if img.format == "JPEG":
+            # 让解码器直接按 1/2、1/4、1/8 降采样，保证裁剪区域仍不小于输出尺寸
+            img.draft("RGB", (-(-w * out_size[0] // crop_w), -(-h * out_size[1] // crop_h)))
+            # 降采样后的尺寸按 8 像素块向上取整，两个方向的比例不一定相同，分别换算并限制在图内
+            sx, sy = img.size[0] / w, img.size[1] / h
+            box = (min(round(box[0] * sx), img.size[0]), min(round(box[1] * sy), img.size[1]),
+                   min(round(box[2] * sx), img.size[0]), min(round(box[3] * sy), img.size[1]))
+        flatten = img.mode in ("RGBA", "LA") or (img.mode == "P" and "transparency" in img.info)
+        if flatten:
+            rgba = img.convert("RGBA")
+            img = Image.new("RGB", rgba.size, (0, 0, 0))  # 黑色背景（夜景）
+            img.paste(rgba, mask=rgba.getchannel("A"))
+        elif img.mode != "RGB":
+            img = img.convert("RGB")
+        img = img.resize(out_size, Image.LANCZOS, box=box)
+        img.save(tmp_path, "JPEG", quality=95)
+        actions = ["铺黑底"] if flatten else []
+        if needs_crop:
+            actions.append("裁剪到 9:16")
+        if scale < 1.0:
+            actions.append("缩小")
+        message = f"已{'、'.join(actions) or '转换'}为 {out_size[0]}x{out_size[1]}"
+    os.replace(tmp_path, frame_path)
+
+    # 旧的缓存帧不再需要
+    for name in os.listdir(cache_dir):
+        if name.startswith("start-") and os.path.join(cache_dir, name) != frame_path:
+            os.remove(os.path.join(cache_dir, name))
+
+    if poster:
+        update_poster(source_path, frame_path, needs_crop)
+    return frame_path, message
 
 
 def load_image_as_bytes(image_path: str) -> tuple:
@@ -342,212 +259,3402 @@ def load_image_as_bytes(image_path: str) -> tuple:
     return image_data, mime_type
 
 
+class StartFrame:
+    """起始帧：每次运行只读取、编码一次，所有动作、所有 Key、所有重试共用
+
+    Gemini API 的 Veo 接口只接受内联图片（不支持 files API 上传的 URI），
+    所以缓存的是同一个 types.Image 对象，而不是每次请求重新读文件构造。
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.image_bytes, self.mime_type = load_image_as_bytes(path)
+        self.prep_seconds = 0.0  # 预处理耗时，计入每个动作的 image_prep 阶段
+        self._image = None
+
+    @property
+    def image(self):
+        if self._image is None:
+            _, types, _ = import_genai()
+            self._image = types.Image(image_bytes=self.image_bytes, mime_type=self.mime_type)
+        return self._image
+
+
 # ============================================================
-# Veo 视频生成
+# 生成缓存：按输入内容哈希跳过未变化的动作
 # ============================================================
 
-def wait_for_video(video_client, operation) -> any:
-    """等待视频生成完成"""
-    print("    等待视频生成...")
-    check_count = 0
-    while not operation.done:
-        check_count += 1
-        print(f"    生成中... (第 {check_count} 次检查)")
-        time.sleep(10)
-        operation = video_client.operations.get(operation)
+MANIFEST_NAME = ".veo-manifest.json"
 
-    response = operation.response
-    if not response:
-        print(f"    响应为空，operation: {operation}")
-        return None
-    if not response.generated_videos:
-        print(f"    没有生成视频，response: {response}")
+
+def compute_input_hash(model: str, prompt: str, duration: int, image_bytes: bytes) -> str:
+    """生成结果只取决于模型、prompt、时长和起始帧，任一变化都需要重新生成"""
+    h = hashlib.sha256()
+    for part in (model, prompt, str(duration)):
+        h.update(part.encode("utf-8"))
+        h.update(b"\0")
+    h.update(image_bytes)
+    return h.hexdigest()
+
+
+def load_manifest(assets_dir: str) -> dict:
+    path = os.path.join(assets_dir, MANIFEST_NAME)
+    if not os.path.exists(path):
+        return {"version": 1, "assets": {}}
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def save_manifest(assets_dir: str, manifest: dict):
+    """先写临时文件再替换，中途崩溃不会留下损坏的 manifest"""
+    path = os.path.join(assets_dir, MANIFEST_NAME)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2, sort_keys=True)
+        f.write("\n")
+    os.replace(tmp_path, path)
+
+
+def record_generated(job) -> None:
+    """生成成功后立即写入 manifest，中途中断也不会丢失已完成的记录"""
+    manifest = load_manifest(job.assets_dir)
+    file_name = os.path.basename(job.output_path)
+    previous = manifest["assets"].get(file_name, {})
+    if job.postprocess_only:
+        entry = dict(previous)
+    else:
+        entry = {
+            "action": job.action,
+            "input_hash": job.input_hash,
+            "model": job.model,
+            "tier": job.tier,
+            "duration": job.duration,
+            "generated_at": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        }
+    if job.candidate_scores:
+        entry["candidates"] = job.candidate_scores  # 按扣分从小到大，第一个为选用的候选
+    if job.postprocess:
+        entry.update(job.postprocess)
+    remove_stale_variants(job.assets_dir, file_name, previous, entry)
+    manifest["assets"][file_name] = entry
+    save_manifest(job.assets_dir, manifest)
+    if job.assets_dir == os.path.join(CHARACTERS_DIR, job.character, "assets"):
+        # 分片的暂存目录不入库，merge 安装到 assets/ 时再入库
+        store_commit(job.assets_dir, file_name, "postprocess" if job.postprocess_only else "generate", entry)
+
+
+def remove_stale_variants(assets_dir: str, file_name: str, previous: dict, entry: dict):
+    """不再产出的旧版本（例如去掉了某个分辨率）一并删除"""
+    for name in previous.get("variants", {}):
+        if name != file_name and name not in entry.get("variants", {}):
+            stale_path = os.path.join(assets_dir, name)
+            if os.path.exists(stale_path):
+                os.remove(stale_path)
+
+
+# ============================================================
+# 内容仓库：每个产出的视频、图片按 sha256 存一份只读副本，history / rollback 从这里取回
+# ============================================================
+
+STORE_DIR = ".store"                 # characters/<id>/.store/，不进 git、不随 assets 部署
+HISTORY_NAME = "history.jsonl"       # 每个文件每次内容变化一行，history / rollback 子命令读取
+LEGACY_BACKUP_RE = re.compile(r"^(.*)_original(\.(?:jpg|jpeg|png))$")  # 旧版 update_poster 留下的备份
+
+_store_lock = threading.Lock()
+
+
+def store_root(assets_dir: str) -> str:
+    return os.path.join(os.path.dirname(os.path.abspath(assets_dir)), STORE_DIR)
+
+
+def object_path(assets_dir: str, sha256: str) -> str:
+    """.store/objects/ab/cdef..."""
+    return os.path.join(store_root(assets_dir), "objects", sha256[:2], sha256[2:])
+
+
+def copy_replace(src: str, dst: str, mode: int = 0o644):
+    """复制到临时文件再原子替换 dst，播放器不会读到写了一半的文件"""
+    os.makedirs(os.path.dirname(dst), exist_ok=True)
+    tmp_path = dst + ".tmp"
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    shutil.copyfile(src, tmp_path)
+    os.chmod(tmp_path, mode)
+    os.replace(tmp_path, dst)
+
+
+def verify_object(assets_dir: str, sha256: str) -> bool:
+    obj = object_path(assets_dir, sha256)
+    return os.path.exists(obj) and file_sha256(obj) == sha256
+
+
+def store_put(assets_dir: str, path: str, sha256: str = None) -> str:
+    """把文件的一份只读副本放进仓库，返回 sha256
+
+    对象从不和 assets 下的文件共用 inode：cp 覆盖、图片编辑器原地保存都会改写文件本身，
+    共用时仓库里的旧版本也会被一起改掉。
+    """
+    sha256 = sha256 or file_sha256(path)
+    obj = object_path(assets_dir, sha256)
+    if not os.path.exists(obj):
+        copy_replace(path, obj, 0o444)
+    elif os.stat(obj).st_mode & 0o222:
+        # 旧版仓库的对象是 assets 文件的硬链接：拆开，内容已被改写的用当前文件修复
+        if os.path.samefile(path, obj) or not verify_object(assets_dir, sha256):
+            copy_replace(path, obj, 0o444)
+        else:
+            os.chmod(obj, 0o444)
+    return sha256
+
+
+def load_history(assets_dir: str, file_name: str = None) -> list:
+    """按时间排序的历史记录，可只取一个文件的"""
+    path = os.path.join(store_root(assets_dir), HISTORY_NAME)
+    if not os.path.exists(path):
+        return []
+    with open(path, encoding="utf-8") as f:
+        records = [json.loads(line) for line in f if line.strip()]
+    records = [r for r in records if file_name is None or r["file"] == file_name]
+    return sorted(records, key=lambda r: r["time"])
+
+
+def append_history(assets_dir: str, record: dict):
+    path = os.path.join(store_root(assets_dir), HISTORY_NAME)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with _store_lock, open(path, "a", encoding="utf-8") as f:
+        f.write(json.dumps(record, ensure_ascii=False, sort_keys=True) + "\n")
+
+
+def store_commit(assets_dir: str, file_name: str, source: str, entry: dict = None,
+                 sha256: str = None) -> Optional[dict]:
+    """把 assets 下的一个文件（连同低分辨率版本、原始视频缓存）入库并记一条历史
+
+    entry 是生成 manifest 中的记录，rollback 时原样恢复。内容和上一条历史相同时不记录，返回 None。
+    """
+    path = os.path.join(assets_dir, file_name)
+    record = {
+        "time": time.time(),
+        "file": file_name,
+        "sha256": store_put(assets_dir, path, sha256),
+        "bytes": os.path.getsize(path),
+        "source": source,
+    }
+    if entry is not None:
+        record["entry"] = entry
+        record["variants"] = {name: store_put(assets_dir, os.path.join(assets_dir, name))
+                              for name in entry.get("variants", {})
+                              if name != file_name and os.path.exists(os.path.join(assets_dir, name))}
+        raw_path = os.path.join(assets_dir, RAW_CACHE_DIR, file_name)
+        if os.path.exists(raw_path):
+            record["raw"] = store_put(assets_dir, raw_path)
+    history = load_history(assets_dir, file_name)
+    if history and all(history[-1].get(key) == record.get(key) for key in ("sha256", "variants", "raw")):
         return None
-    return response.generated_videos[0]
+    append_history(assets_dir, record)
+    return record
+
+
+def store_adopt(assets_dir: str, file_name: str, sha256: str = None):
+    """已有文件（手工放入的、旧版本）入库：内容和最近一条历史不同时记为 import"""
+    sha256 = store_put(assets_dir, os.path.join(assets_dir, file_name), sha256)
+    history = load_history(assets_dir, file_name)
+    if not history or history[-1]["sha256"] != sha256:
+        store_commit(assets_dir, file_name, "import", sha256=sha256)
+
+
+def adopt_before_replace(path: str):
+    """覆盖角色 assets/ 下已有的文件之前先入库，rollback 才能取回被覆盖的版本
+
+    分片暂存目录、.veo-cache 等其他位置的文件不入库。
+    """
+    assets_dir, file_name = os.path.split(os.path.abspath(path))
+    characters_dir = os.path.dirname(os.path.dirname(assets_dir))
+    if (os.path.basename(assets_dir) == "assets" and os.path.isfile(path)
+            and os.path.samefile(characters_dir, CHARACTERS_DIR)):
+        store_adopt(assets_dir, file_name)
+
+
+def adopt_legacy_backups(assets_dir: str):
+    """把旧版留下的 idle_original.jpg 之类的整份备份移进仓库，作为对应文件最早的历史"""
+    for name in sorted(os.listdir(assets_dir)):
+        match = LEGACY_BACKUP_RE.match(name)
+        if not match:
+            continue
+        path = os.path.join(assets_dir, name)
+        target = match.group(1) + match.group(2)
+        # 备份时间无从得知，排在该文件现有历史之前
+        history = load_history(assets_dir, target)
+        first = history[0]["time"] if history else os.path.getmtime(path)
+        sha256 = file_sha256(path)
+        copy_replace(path, object_path(assets_dir, sha256), 0o444)
+        append_history(assets_dir, {"time": min(first, os.path.getmtime(path)) - 1, "file": target,
+                                    "sha256": sha256, "bytes": os.path.getsize(path), "source": "original"})
+        os.remove(path)
+        print(f"✓ {name} 已移入内容仓库（{target} 的原始版本，可用 rollback 取回）")
+
+
+# ============================================================
+# 后处理：转码为适合网页播放的版本（在进程池中运行）
+# ============================================================
+
+POSTPROCESS_WORKERS = 2          # ffmpeg 自身多线程，进程数不宜过多
+RAW_CACHE_DIR = os.path.join(START_FRAME_CACHE_DIR, "raw")  # Veo 原始输出，供重新转码
+WEB_MAX_BITRATE = "2M"
+WEB_CRF = 23
+
+
+def ffmpeg_available() -> bool:
+    return shutil.which("ffmpeg") is not None
+
 
+def transcode_web(src: str, dst: str, max_bitrate: str, height: int = None,
+                  duration: float = None):
+    """转码为 faststart（moov 前置）、无音轨、限码率的 H.264，原子替换 dst；duration 为截取时长"""
+    rate = int(max_bitrate.rstrip("kKmM")) * (1000 if max_bitrate[-1] in "kK" else 1000000)
+    tmp_path = dst + ".part.mp4"
+    cmd = ["ffmpeg", "-y", "-v", "error", "-i", src,
+           "-an", "-c:v", "libx264", "-preset", "slow", "-crf", str(WEB_CRF),
+           "-maxrate", max_bitrate, "-bufsize", str(rate * 2),
+           "-pix_fmt", "yuv420p", "-movflags", "+faststart"]
+    if height:
+        # 只缩小不放大：比原视频高的档位等同于原分辨率
+        cmd += ["-vf", f"scale=-2:'min(ih,{height})'"]
+    if duration:
+        cmd += ["-t", f"{duration:.3f}"]
+    cmd.append(tmp_path)
+    _run_ffmpeg(cmd, tmp_path, dst)
 
-def generate_video(video_client, action: str, prompt: str, duration: int,
-                   idle_image: str, assets_dir: str) -> str:
-    """使用 Veo API 的 image_to_video 方法生成视频"""
-    print(f"\n[{action}] 开始生成视频...")
-    print(f"  时长: {duration}秒")
-    print(f"  起始帧: {idle_image}")
 
+def trim_clip(src: str, dst: str, duration: float):
+    """截取前 duration 秒，原子替换 dst
+
+    视频必须重新编码（结尾不一定落在关键帧上），用高质量参数以免可见损失；音轨直接复制。
+    """
+    tmp_path = dst + ".part.mp4"
+    cmd = ["ffmpeg", "-y", "-v", "error", "-i", src, "-t", f"{duration:.3f}",
+           "-c:v", "libx264", "-preset", "slow", "-crf", "18", "-pix_fmt", "yuv420p",
+           "-c:a", "copy", "-movflags", "+faststart", tmp_path]
+    _run_ffmpeg(cmd, tmp_path, dst)
+
+
+def _run_ffmpeg(cmd: list, tmp_path: str, dst: str):
     try:
-        image_data, mime_type = load_image_as_bytes(idle_image)
-        start_image = types.Image(image_bytes=image_data, mime_type=mime_type)
+        subprocess.run(cmd, check=True, capture_output=True)
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, dst)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def rendition_name(file_name: str, height: int) -> str:
+    """wave.mp4 → wave-640p.mp4"""
+    stem, ext = os.path.splitext(file_name)
+    return f"{stem}-{height}p{ext}"
+
+
+def postprocess_clip(raw_path: str, assets_dir: str, file_name: str, options: dict) -> dict:
+    """对下载好的原始视频做后处理，返回要写入 manifest 的字段
+
+    在子进程中运行，参数和返回值都必须可以 pickle。
+    """
+    output_path = os.path.join(assets_dir, file_name)
+    result = {"raw_bytes": os.path.getsize(raw_path)}
+    for name in [file_name] + [rendition_name(file_name, height)
+                               for height in (options.get("transcode") or {}).get("renditions", [])]:
+        adopt_before_replace(os.path.join(assets_dir, name))
+    trim_to = None
+    if options.get("loop"):
+        result["loop"] = detect_loop_point(raw_path, options["loop"])
+        trim_to = result["loop"].get("trim_to")
+    transcode = options.get("transcode")
+    if transcode:
+        variants = {}
+        transcode_web(raw_path, output_path, transcode["max_bitrate"], duration=trim_to)
+        variants[file_name] = os.path.getsize(output_path)
+        for height in transcode["renditions"]:
+            name = rendition_name(file_name, height)
+            transcode_web(raw_path, os.path.join(assets_dir, name), transcode["max_bitrate"],
+                          height, duration=trim_to)
+            variants[name] = os.path.getsize(os.path.join(assets_dir, name))
+        result["variants"] = variants
+        result["transcode"] = transcode
+    elif trim_to:
+        trim_clip(raw_path, output_path, trim_to)
+    else:
+        tmp_path = output_path + ".part.mp4"
+        shutil.copyfile(raw_path, tmp_path)
+        os.replace(tmp_path, output_path)
+    result["bytes"] = os.path.getsize(output_path)
+    return result
+
+
+def needs_postprocess(manifest: dict, file_name: str, options: dict) -> bool:
+    """已是最新的视频，如果后处理设置变了，只需重新后处理，不必重新生成"""
+    entry = manifest["assets"].get(file_name, {})
+    transcode = options.get("transcode")
+    if transcode and entry.get("transcode") != transcode:
+        return True
+    loop = options.get("loop")
+    return bool(loop) and entry.get("loop", {}).get("options") != loop
+
+
+# ============================================================
+# 画面分析：候选视频评分、循环点检测（ffmpeg 解码缩略帧 + NumPy）
+# ============================================================
+
+MAX_CANDIDATES = 4                   # Veo 单个 operation 最多返回 4 个视频
+CANDIDATE_DIR = os.path.join(START_FRAME_CACHE_DIR, "candidates")  # 落选的候选保留在这里供人工对比
+SCORE_SIZE = (64, 112)               # 评分用的灰度缩略帧（9:16），足够比较整体姿态
+SCORE_FPS = 4
+# prompts.json 中 motion 对应的目标运动量：相邻采样帧的平均像素差（0-1），
+# 按现有 assets 中人工挑选过的视频标定
+MOTION_TARGETS = {"low": 0.012, "medium": 0.02, "high": 0.03}
+MOTION_WEIGHT = 0.03                 # 运动量偏离目标一倍的扣分，与首尾帧差同一量纲
+LOOP_THRESHOLD = 0.035               # 循环接缝（和第一帧的平均像素差）超过此值视为明显跳变
+LOOP_MIN_KEEP = 0.75                 # 剪切循环点时至少保留的时长比例
+LOOP_MIN_GAIN = 0.002                # 接缝改善小于此值时不剪
+
+
+def decode_gray_frames(path: str, size: tuple = SCORE_SIZE, fps: float = None):
+    """用 ffmpeg 把视频解码为灰度缩略帧，返回 (帧数, 高, 宽) 的 uint8 数组
+
+    帧通过管道以 rawvideo 传回，不落盘；fps 为 None 时保留原帧率。
+    """
+    np = import_numpy()
+    width, height = size
+    filters = f"scale={width}:{height},format=gray"
+    if fps:
+        filters = f"fps={fps}," + filters
+    result = subprocess.run(["ffmpeg", "-v", "error", "-i", path, "-vf", filters,
+                             "-f", "rawvideo", "-"], check=True, capture_output=True)
+    frames = np.frombuffer(result.stdout, dtype=np.uint8)
+    return frames[:len(frames) // (width * height) * width * height].reshape(-1, height, width)
+
+
+def score_candidate(path: str, motion_level: str) -> dict:
+    """给候选视频打分，penalty 越小越好
+
+    loop_error: 首尾帧平均像素差，越小循环越无缝；
+    motion: 相邻采样帧平均像素差，和动作预期运动量的比值偏离 1 越多扣分越多。
+    """
+    np = import_numpy()
+    frames = decode_gray_frames(path, fps=SCORE_FPS).astype(np.float32) / 255
+    if len(frames) < 2:
+        raise GenerationError(f"无法解码候选视频: {path}", ERROR_TRANSIENT)
+    loop_error = float(np.abs(frames[-1] - frames[0]).mean())
+    motion = float(np.abs(np.diff(frames, axis=0)).mean())
+    target = MOTION_TARGETS.get(motion_level, MOTION_TARGETS["medium"])
+    penalty = loop_error + MOTION_WEIGHT * abs(np.log2(max(motion, 1e-4) / target))
+    return {"loop_error": round(loop_error, 4), "motion": round(motion, 4),
+            "penalty": round(float(penalty), 4)}
+
+
+def detect_loop_point(path: str, options: dict) -> dict:
+    """找出和第一帧最接近的帧 k，播放 0..k-1 再回到 0 时接缝最小
+
+    只在后 (1 - min_keep) 的范围内找，避免把动作本身剪掉；剪短带来的改善
+    不足 LOOP_MIN_GAIN 时不剪。最佳接缝仍高于 threshold 的视频标记为 flagged。
+    """
+    np = import_numpy()
+    frames = decode_gray_frames(path).astype(np.int16)
+    count = len(frames)
+    if count < 2:
+        raise GenerationError(f"无法解码视频: {path}", ERROR_TRANSIENT)
+    distances = np.abs(frames - frames[0]).mean(axis=(1, 2)) / 255
+    first = max(1, int(count * options["min_keep"]))
+    best = first + int(np.argmin(distances[first:]))
+    end_seam = float(distances[-1])  # 不剪：最后一帧接回第一帧
+    seam = float(distances[best])
+    duration = mp4_duration(path)
+    info = {"options": options, "frames": count, "seam": round(end_seam, 4)}
+    if seam < end_seam - LOOP_MIN_GAIN and duration:
+        info.update(frame=best, seam=round(seam, 4), trim_to=round(duration * best / count, 3),
+                    trimmed_seconds=round(duration * (count - best) / count, 3))
+    info["flagged"] = info["seam"] > options["threshold"]
+    return info
+
+
+# ============================================================
+# 前端资源清单：assets/manifest.json
+# ============================================================
+
+ASSET_MANIFEST_NAME = "manifest.json"
+POSTER_DIR = "posters"
+
+# 预加载优先级：数字越小越先加载
+PRIORITY_IDLE = 0
+PRIORITY_CONVERSATION = 1   # speaking / listening，对话一开始就会用到
+PRIORITY_BASIC = 2
+PRIORITY_FUN = 3
+PRIORITY_UNREFERENCED = 4   # 前端没有引用的文件（旧版本、备选等）
+CONVERSATION_ACTIONS = ("speaking", "listening")
+
+
+def load_player_config(character_id: str) -> dict:
+    with open(os.path.join(CHARACTERS_DIR, character_id, "config.json"), encoding="utf-8") as f:
+        return json.load(f)
+
+
+def player_clip_references(config: dict) -> dict:
+    """按 index.html 的规则解析前端会加载的视频文件
+
+    返回 {文件名: {"actions": [...], "priority": n, "optional": bool, "segment": n}}，
+    segment 为该文件在 sequence 中的序号（单文件为 0）。
+    """
+    refs = {}
+
+    def add(file_name, action, priority, optional=False, segment=0):
+        ref = refs.setdefault(file_name, {"actions": [], "priority": priority, "optional": optional,
+                                          "segment": segment})
+        ref["actions"].append(action)
+        ref["priority"] = min(ref["priority"], priority)
+        ref["optional"] = ref["optional"] and optional
+
+    idle_sequence = config.get("idle", {}).get("sequence")
+    for segment, file_name in enumerate(idle_sequence or ["idle.mp4"]):
+        add(file_name, "idle", PRIORITY_IDLE, segment=segment)
+
+    speaking_is_sequence = False
+    for group, group_priority in (("basic", PRIORITY_BASIC), ("fun", PRIORITY_FUN)):
+        for action in config.get("actions", {}).get(group, []):
+            action_id = action["id"]
+            priority = PRIORITY_CONVERSATION if action_id in CONVERSATION_ACTIONS else group_priority
+            if action.get("sequence"):
+                speaking_is_sequence |= action_id == "speaking"
+                for segment, file_name in enumerate(action["sequence"]):
+                    add(file_name, action_id, priority, segment=segment)
+            else:
+                add(action.get("file") or f"{action_id}.mp4", action_id, priority)
+    # 非 sequence 模式下前端会尝试 speaking_v2.mp4，不存在也能正常工作
+    if not speaking_is_sequence:
+        add("speaking_v2.mp4", "speaking_v2", PRIORITY_CONVERSATION, optional=True)
+    return refs
+
+
+def mp4_duration(path: str) -> Optional[float]:
+    """读取 moov/mvhd 中的时长（秒），不依赖 ffprobe；文件截断、box 损坏时返回 None"""
+    with open(path, 'rb') as f:
+        def read(n):
+            data = f.read(n)
+            if len(data) != n:
+                raise ValueError("文件截断")
+            return data
+
+        def boxes(end):
+            while f.tell() + 8 <= end:
+                start = f.tell()
+                size, kind = struct.unpack(">I4s", read(8))
+                if size == 1:
+                    size = struct.unpack(">Q", read(8))[0]
+                elif size == 0:
+                    size = end - start
+                if size < 8:
+                    return
+                yield kind, start, f.tell(), start + size
+                f.seek(start + size)
+
+        try:
+            for kind, _, body, end in boxes(os.path.getsize(path)):
+                if kind != b"moov":
+                    continue
+                f.seek(body)
+                for inner, _, inner_body, _ in boxes(end):
+                    if inner != b"mvhd":
+                        continue
+                    f.seek(inner_body)
+                    version = read(4)[0]
+                    if version == 1:
+                        f.seek(16, 1)
+                        timescale, duration = struct.unpack(">IQ", read(12))
+                    else:
+                        f.seek(8, 1)
+                        timescale, duration = struct.unpack(">II", read(8))
+                    return round(duration / timescale, 3) if timescale else None
+        except (ValueError, struct.error):
+            return None
+    return None
+
+
+def file_sha256(path: str) -> str:
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def extract_poster(video_path: str, poster_path: str) -> bool:
+    """用 ffmpeg 抽取第一帧作为 poster"""
+    if not ffmpeg_available():
+        return False
+    os.makedirs(os.path.dirname(poster_path), exist_ok=True)
+    tmp_path = poster_path + ".part.jpg"
+    result = subprocess.run(["ffmpeg", "-y", "-v", "error", "-i", video_path,
+                             "-frames:v", "1", "-q:v", "3", tmp_path], capture_output=True)
+    if result.returncode != 0:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        return False
+    os.replace(tmp_path, poster_path)
+    return True
+
+
+def describe_clip(assets_dir: str, file_name: str, previous: dict) -> dict:
+    """单个视频的时长、大小、哈希；大小和修改时间没变时沿用上次的结果"""
+    path = os.path.join(assets_dir, file_name)
+    stat = os.stat(path)
+    if (previous.get("bytes") == stat.st_size
+            and previous.get("mtime") == int(stat.st_mtime)
+            and previous.get("sha256")):
+        return {key: previous[key] for key in ("bytes", "mtime", "sha256", "duration")}
+    return {
+        "bytes": stat.st_size,
+        "mtime": int(stat.st_mtime),
+        "sha256": file_sha256(path),
+        "duration": mp4_duration(path),
+    }
+
+
+def write_asset_manifest(character_id: str) -> str:
+    """生成前端预加载用的 assets/manifest.json
+
+    每个视频记录时长、字节数、内容哈希（可用于缓存失效）、poster 和预加载
+    优先级；低分辨率版本挂在对应视频的 renditions 下；config.json 引用了
+    但磁盘上不存在的文件列在 missing 中。
+    顺带把还不在内容仓库里的文件（手工放入的、旧版备份）入库。
+    """
+    assets_dir = os.path.join(CHARACTERS_DIR, character_id, "assets")
+    path = os.path.join(assets_dir, ASSET_MANIFEST_NAME)
+    adopt_legacy_backups(assets_dir)
+    idle_image = find_idle_image(assets_dir)
+    if idle_image:
+        store_adopt(assets_dir, os.path.basename(idle_image))
+    previous = {}
+    if os.path.exists(path):
+        with open(path, encoding="utf-8") as f:
+            previous = json.load(f).get("clips", {})
+
+    refs = player_clip_references(load_player_config(character_id))
+    on_disk = sorted(name for name in os.listdir(assets_dir)
+                     if name.endswith(".mp4") and not name.startswith("."))
+    rendition_pattern = re.compile(r"^(.*)-(\d+)p\.mp4$")
+    renditions = {}
+    clip_names = []
+    for name in on_disk:
+        match = rendition_pattern.match(name)
+        if match and f"{match.group(1)}.mp4" in on_disk:
+            renditions.setdefault(f"{match.group(1)}.mp4", []).append(name)
+        else:
+            clip_names.append(name)
+
+    default_poster = "idle.jpg" if os.path.exists(os.path.join(assets_dir, "idle.jpg")) else None
+    clips = {}
+    for name in clip_names:
+        old = previous.get(name, {})
+        clip = describe_clip(assets_dir, name, old)
+        store_adopt(assets_dir, name, clip["sha256"])
+        ref = refs.get(name)
+        clip["actions"] = ref["actions"] if ref else []
+        clip["priority"] = ref["priority"] if ref else PRIORITY_UNREFERENCED
+
+        # 所有动作都从 idle 起始帧开始生成，没有 ffmpeg 时用 idle.jpg 代替
+        poster = f"{POSTER_DIR}/{os.path.splitext(name)[0]}.jpg"
+        poster_path = os.path.join(assets_dir, poster)
+        if old.get("sha256") == clip["sha256"] and old.get("poster") == poster and os.path.exists(poster_path):
+            clip["poster"] = poster
+        elif extract_poster(os.path.join(assets_dir, name), poster_path):
+            clip["poster"] = poster
+        else:
+            clip["poster"] = default_poster
+
+        if name in renditions:
+            old_renditions = old.get("renditions", {})
+            clip["renditions"] = {
+                r: describe_clip(assets_dir, r, old_renditions.get(r, {})) for r in renditions[name]
+            }
+            for r, rendition in clip["renditions"].items():
+                store_put(assets_dir, os.path.join(assets_dir, r), rendition["sha256"])
+        clips[name] = clip
+
+    manifest = {
+        "version": 1,
+        "character": character_id,
+        "generated_at": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "clips": clips,
+        "preload": sorted((name for name in clips if clips[name]["priority"] < PRIORITY_UNREFERENCED),
+                          key=lambda name: (clips[name]["priority"], name)),
+        "missing": sorted(name for name, ref in refs.items()
+                          if name not in clips and not ref["optional"]),
+    }
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+        f.write("\n")
+    os.replace(tmp_path, path)
+    return path
+
+
+# ============================================================
+# 生成计划：播放器实际引用的文件中，哪些缺失、过期或损坏
+# ============================================================
+
+# 计划中每个文件的状态；除 ok 和 no-prompt 外都需要生成
+CLIP_OK = "ok"
+CLIP_MISSING = "missing"        # 文件不存在
+CLIP_STALE = "stale"            # 生成输入（prompt、起始帧、模型、时长）变了；手工放入的文件则是起始帧变了
+CLIP_INVALID = "invalid"        # 文件损坏，无法解析
+CLIP_FLAGGED = "flagged"        # 循环接缝明显（--regenerate-flagged）
+CLIP_FORCED = "forced"          # --force
+CLIP_NO_PROMPT = "no-prompt"    # prompts.json 中找不到对应的提示词
+CLIP_STATUS_LABELS = {
+    CLIP_OK: "最新", CLIP_MISSING: "缺失", CLIP_STALE: "过期", CLIP_INVALID: "损坏",
+    CLIP_FLAGGED: "接缝明显", CLIP_FORCED: "强制", CLIP_NO_PROMPT: "无提示词",
+}
+
 
+@dataclass
+class PlannedClip:
+    """播放器引用的一个视频文件及其生成方式"""
+    file_name: str
+    action: str                 # 播放器中的动作 ID
+    recipe: Optional[str]       # prompts.json 中使用的动作
+    priority: int
+    optional: bool
+    status: str = CLIP_OK
+    detail: str = ""
+    input_hash: Optional[str] = None
+
+    @property
+    def needs_generation(self) -> bool:
+        return self.status not in (CLIP_OK, CLIP_NO_PROMPT)
+
+
+def clip_recipe(file_name: str, action: str, segment: int, videos: dict) -> Optional[str]:
+    """为播放器引用的文件找到 prompts.json 中的动作
+
+    依次尝试：与文件名同名的动作（wave.mp4 → wave）；sequence 第 n 段用
+    <动作>_v<n>（speaking2.mp4 → speaking_v2）；最后用播放器动作本身
+    （listening2.mp4 → listening，idel1.mp4 → idle）。
+    """
+    stem = os.path.splitext(file_name)[0]
+    if stem in videos:
+        return stem
+    if segment and f"{action}_v{segment + 1}" in videos:
+        return f"{action}_v{segment + 1}"
+    if action in videos:
+        return action
+    return None
+
+
+def select_clip_files(refs: dict, only: str, videos: dict) -> dict:
+    """按播放器动作、提示词动作或文件名（不含扩展名）筛选播放器引用的文件"""
+    return {file_name: ref for file_name, ref in refs.items()
+            if only in (ref["actions"][0], os.path.splitext(file_name)[0],
+                        clip_recipe(file_name, ref["actions"][0], ref["segment"], videos))}
+
+
+def clip_status(assets_dir: str, file_name: str, manifest: dict, input_hash: str,
+                start_frame_sha256: str) -> tuple:
+    """返回 (状态, 说明)
+
+    生成的文件按输入哈希判断；手工放入的文件在第一次运行时记下当时起始帧的哈希
+    （adopt_unrecorded_clips），之后只在起始帧变化时过期。都按内容比较，不看修改时间：
+    idle.jpg 会被 update_poster 改写，clone、复制也会改变修改时间。
+    """
+    path = os.path.join(assets_dir, file_name)
+    if not os.path.exists(path):
+        return CLIP_MISSING, ""
+    problem = validate_mp4(path)
+    if problem:
+        return CLIP_INVALID, problem
+    if mp4_duration(path) is None:
+        return CLIP_INVALID, "无法读取时长"
+    entry = manifest["assets"].get(file_name)
+    if entry is None:
+        return CLIP_OK, ""
+    if "input_hash" in entry:
+        if entry["input_hash"] != input_hash:
+            return CLIP_STALE, "生成输入已变化"
+    elif entry.get("start_frame") != start_frame_sha256:
+        return CLIP_STALE, "起始帧已变化"
+    return CLIP_OK, ""
+
+
+def plan_clips(character_id: str, image_bytes: bytes, force: bool = False,
+               regenerate_flagged: bool = False, only: str = None) -> list:
+    """根据 config.json（播放器引用）和 prompts.json（生成方式）列出所有文件及其状态
+
+    按播放器优先级排序：idle 先于对话动作，对话动作先于普通和趣味动作，
+    这样中途中断时最先用到的视频已经就绪。
+    only 按播放器动作、提示词动作或文件名筛选；播放器没有引用但 prompts.json
+    中有的动作，按明确要求生成 <动作>.mp4。
+    """
+    config = load_character(character_id)
+    refs = player_clip_references(load_player_config(character_id))
+    if only:
+        refs = select_clip_files(refs, only, config["videos"])
+        if not refs and only in config["videos"]:
+            refs = {f"{only}.mp4": {"actions": [only], "priority": PRIORITY_UNREFERENCED,
+                                    "optional": False, "segment": 0}}
+    assets_dir = os.path.join(CHARACTERS_DIR, character_id, "assets")
+    manifest = load_manifest(assets_dir)
+    start_frame_sha256 = hashlib.sha256(image_bytes).hexdigest()
+    clips = []
+    for file_name, ref in sorted(refs.items(), key=lambda item: (item[1]["priority"], item[0])):
+        action = ref["actions"][0]
+        recipe = clip_recipe(file_name, action, ref["segment"], config["videos"])
+        clip = PlannedClip(file_name, action, recipe, ref["priority"], ref["optional"])
+        if recipe is None:
+            clip.status = CLIP_NO_PROMPT
+        else:
+            prompt, duration = config["videos"][recipe]
+            clip.input_hash = compute_input_hash(VIDEO_MODEL, prompt, duration, image_bytes)
+            clip.status, clip.detail = clip_status(assets_dir, file_name, manifest,
+                                                   clip.input_hash, start_frame_sha256)
+            if clip.status == CLIP_OK:
+                entry = manifest["assets"].get(file_name, {})
+                if regenerate_flagged and entry.get("loop", {}).get("flagged"):
+                    clip.status = CLIP_FLAGGED
+                elif force:
+                    clip.status = CLIP_FORCED
+        clips.append(clip)
+    return clips
+
+
+def adopt_unrecorded_clips(assets_dir: str, clips: list, image_bytes: bytes):
+    """手工放入、没有生成记录的文件：记下当前起始帧的哈希，之后起始帧变了再标为过期"""
+    manifest = load_manifest(assets_dir)
+    adopted = [clip.file_name for clip in clips
+               if clip.status in (CLIP_OK, CLIP_FORCED) and clip.file_name not in manifest["assets"]]
+    if not adopted:
+        return
+    start_frame_sha256 = hashlib.sha256(image_bytes).hexdigest()
+    for file_name in adopted:
+        manifest["assets"][file_name] = {
+            "source": "import",
+            "start_frame": start_frame_sha256,
+            "adopted_at": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        }
+    save_manifest(assets_dir, manifest)
+
+
+def print_plan(clips: list):
+    print(f"  {'文件':<18}{'播放器动作':<10}{'提示词':<12}状态")
+    for clip in clips:
+        status = CLIP_STATUS_LABELS[clip.status]
+        if clip.detail:
+            status += f"（{clip.detail}）"
+        if clip.optional and clip.status in (CLIP_MISSING, CLIP_NO_PROMPT):
+            status += "，可选"
+        mark = "→" if clip.needs_generation else " "
+        print(f"{mark} {clip.file_name:<20}{clip.action:<15}{clip.recipe or '-':<15}{status}")
+
+
+# ============================================================
+# 任务日志：记录已提交的 operation，崩溃后可继续轮询而不重复提交
+# ============================================================
+
+JOURNAL_NAME = ".veo-journal.jsonl"
+_journal_lock = threading.Lock()
+
+
+def key_fingerprint(api_key: str) -> str:
+    """只记录 Key 的哈希前缀，日志里不出现明文 Key"""
+    return hashlib.sha256(api_key.encode("utf-8")).hexdigest()[:12]
+
+
+def journal_append(assets_dir: str, record: dict):
+    """追加一条记录并 fsync，进程随时被杀也不会丢失已提交的 operation"""
+    path = os.path.join(assets_dir, JOURNAL_NAME)
+    line = json.dumps(record, ensure_ascii=False, sort_keys=True)
+    with _journal_lock, open(path, "a", encoding="utf-8") as f:
+        f.write(line + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def _read_journal(path: str) -> list:
+    records = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                records.append(json.loads(line))
+            except json.JSONDecodeError:
+                # 写到一半被中断的最后一行
+                continue
+    return records
+
+
+def load_pending_operations(assets_dir: str) -> list:
+    """返回已提交但还没有结束记录的 operation（按提交顺序）"""
+    path = os.path.join(assets_dir, JOURNAL_NAME)
+    if not os.path.exists(path):
+        return []
+    pending = {}
+    for record in _read_journal(path):
+        if record["event"] == "submitted":
+            pending[record["operation"]] = record
+        elif record["event"] == "finished":
+            pending.pop(record["operation"], None)
+    return list(pending.values())
+
+
+def compact_journal(assets_dir: str):
+    """只保留仍未结束的 operation；全部结束则删除日志"""
+    path = os.path.join(assets_dir, JOURNAL_NAME)
+    if not os.path.exists(path):
+        return
+    pending = load_pending_operations(assets_dir)
+    with _journal_lock:
+        if not pending:
+            os.remove(path)
+            return
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            for record in pending:
+                f.write(json.dumps(record, ensure_ascii=False, sort_keys=True) + "\n")
+        os.replace(tmp_path, path)
+
+
+# ============================================================
+# 视频后端：调度器只通过这个接口和服务端交互
+# ============================================================
+
+class VeoBackend:
+    """通过 google-genai 调用 Veo，每个 API Key 一个实例，内部持有常驻 client
+
+    后端接口：submit / refresh / is_running / download / operation_from_name。
+    veo_simulator.SimulatedBackend 实现同样的接口，用于不消耗配额的测试和基准测试。
+    """
+
+    def __init__(self, api_key: str):
+        self.api_key = api_key
+        self._client = None
+
+    @property
+    def client(self):
+        if self._client is None:
+            genai, _, _ = import_genai()
+            self._client = genai.Client(
+                http_options={"api_version": "v1beta"},
+                api_key=self.api_key,
+            )
+        return self._client
+
+    def submit(self, model: str, prompt: str, start_frame, duration: int,
+               number_of_videos: int = 1):
+        """提交 image_to_video 请求，返回 operation（不等待完成）"""
+        _, types, _ = import_genai()
         config = types.GenerateVideosConfig(
             aspect_ratio="9:16",
             duration_seconds=duration,
-            number_of_videos=1,
+            number_of_videos=number_of_videos,
         )
-
-        print("  发送请求...")
-        operation = video_client.models.generate_videos(
-            model=VIDEO_MODEL,
+        return self.client.models.generate_videos(
+            model=model,
             prompt=prompt,
-            image=start_image,
+            image=start_frame.image,
             config=config,
         )
 
-        video = wait_for_video(video_client, operation)
-        if not video:
-            print("  错误: 视频生成失败")
+    def refresh(self, operation):
+        return self.client.operations.get(operation)
+
+    def is_running(self, operation) -> bool:
+        """operation 是否已离开服务端队列开始生成
+
+        Veo 的 operation 不报告排队状态，排队时间只能计入生成阶段。
+        """
+        return False
+
+    def download(self, video, fileobj):
+        """SDK 按块写入 fileobj，不会把整个视频读进内存"""
+        self.client.files.download(file=video.video, destination=fileobj)
+
+    def operation_from_name(self, name: str):
+        _, types, _ = import_genai()
+        return types.GenerateVideosOperation(name=name)
+
+
+# ============================================================
+# API Key 池：每个 Key 一个常驻后端 + 令牌桶限速 + 配额冷却
+# ============================================================
+
+KEY_SUBMITS_PER_MINUTE = 2      # 每个 Key 每分钟最多提交的生成请求
+KEY_COOLDOWN_SECONDS = 60       # 首次 429 后的冷却时间，连续 429 翻倍
+KEY_MAX_COOLDOWN_SECONDS = 900
+MAX_TRANSIENT_RETRIES = 2       # 网络等临时错误的重试次数
+QUOTA_RETRY_ROUNDS = 2          # 配额错误时，每个 Key 最多轮到几次
+COORDINATION_PATH = os.path.join(PROJECT_DIR, START_FRAME_CACHE_DIR, "keys.sqlite")
+LEASE_TTL_SECONDS = 600         # 进程退出没来得及释放的租约在这之后失效；每次访问协调库时续期
+
+# 错误分类
+ERROR_QUOTA = "quota"           # 429 / RESOURCE_EXHAUSTED：冷却该 Key，换 Key 重试
+ERROR_REJECTED = "rejected"     # prompt 不合法 / 安全过滤：换 Key 也没用，直接失败
+ERROR_KEY = "key"               # Key 无效、被吊销或没有权限：停用该 Key，换 Key 重试
+ERROR_TRANSIENT = "transient"   # 网络错误、5xx 等：有限次重试
+
+# google.rpc.Code
+_RPC_INVALID_ARGUMENT = 3
+_RPC_PERMISSION_DENIED = 7
+_RPC_RESOURCE_EXHAUSTED = 8
+_RPC_FAILED_PRECONDITION = 9
+
+
+class GenerationError(Exception):
+    """生成失败，kind 为 ERROR_* 之一"""
+
+    def __init__(self, message: str, kind: str):
+        super().__init__(message)
+        self.kind = kind
+
+
+def classify_error(error) -> str:
+    """区分真正的配额错误和 prompt / 安全过滤等不可重试的错误"""
+    if isinstance(error, GenerationError):
+        return error.kind
+    errors = sys.modules.get("google.genai.errors")
+    if errors and isinstance(error, errors.APIError):
+        if error.code == 429 or error.status == "RESOURCE_EXHAUSTED":
+            return ERROR_QUOTA
+        if is_key_error(error.code, error.status, str(error)):
+            return ERROR_KEY
+        if error.code in (400, 404):
+            return ERROR_REJECTED
+        return ERROR_TRANSIENT
+    message = str(error)
+    if "429" in message or "RESOURCE_EXHAUSTED" in message:
+        return ERROR_QUOTA
+    return ERROR_TRANSIENT
+
+
+# Key 本身的问题返回的也是 400 / 403，要和 prompt 被拒区分开
+_KEY_ERROR_MARKERS = ("API_KEY_INVALID", "API key not valid", "API key expired", "API_KEY_SERVICE_BLOCKED",
+                      "SERVICE_DISABLED", "CONSUMER_SUSPENDED")
+
+
+def is_key_error(code: int, status: Optional[str], message: str) -> bool:
+    if code == 401 or code == 403 or status in ("UNAUTHENTICATED", "PERMISSION_DENIED"):
+        return True
+    return code == 400 and any(marker in message for marker in _KEY_ERROR_MARKERS)
+
+
+def classify_operation_error(error: dict) -> str:
+    """operation.error 是 google.rpc.Status 字典"""
+    code = error.get("code")
+    if code == _RPC_RESOURCE_EXHAUSTED:
+        return ERROR_QUOTA
+    if code in (_RPC_INVALID_ARGUMENT, _RPC_PERMISSION_DENIED, _RPC_FAILED_PRECONDITION):
+        return ERROR_REJECTED
+    return ERROR_TRANSIENT
+
+
+class TokenBucket:
+    """令牌桶：每分钟补充 rate 个令牌，最多累积 burst 个"""
+
+    def __init__(self, rate_per_minute: float, burst: float = None, clock=time):
+        self.rate = rate_per_minute / 60
+        self.capacity = burst if burst is not None else max(1, rate_per_minute)
+        self.tokens = self.capacity
+        self.clock = clock
+        self.updated_at = clock.monotonic()
+
+    def _refill(self):
+        now = self.clock.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def try_take(self) -> bool:
+        self._refill()
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+    def time_until_token(self) -> float:
+        self._refill()
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+
+class KeyCoordinator:
+    """多个生成进程共享的 Key 状态，存放在本地 SQLite 中
+
+    每个进程进行中的 operation 在 leases 表里占一个租约，提交时间记在 submits 表里
+    （滑动窗口限速），冷却时间和用量计数在 keys 表里。所有决策都在 BEGIN IMMEDIATE
+    事务中完成，同一时刻只有一个进程能选 Key，不会多个进程同时挤到同一个 Key 上。
+    只保存 Key 指纹，不保存 Key 本身；时间用墙上时钟，跨进程可比较。
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS keys (
+            fingerprint TEXT PRIMARY KEY,
+            cooldown_until REAL NOT NULL DEFAULT 0,
+            quota_strikes INTEGER NOT NULL DEFAULT 0,
+            submitted INTEGER NOT NULL DEFAULT 0,
+            succeeded INTEGER NOT NULL DEFAULT 0,
+            quota_errors INTEGER NOT NULL DEFAULT 0
+        );
+        CREATE TABLE IF NOT EXISTS leases (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            fingerprint TEXT NOT NULL,
+            owner TEXT NOT NULL,
+            expires_at REAL NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS submits (
+            fingerprint TEXT NOT NULL,
+            time REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS submits_by_key ON submits (fingerprint, time);
+    """
+
+    def __init__(self, path: str = COORDINATION_PATH, owner: str = None):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+        self.owner = owner or f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.executescript(self.SCHEMA)
+
+    def _transaction(self, fingerprints: list, fn):
+        """在写锁事务中执行 fn(now)：先清理过期记录、续期本进程的租约"""
+        with self.lock:
+            self.db.execute("BEGIN IMMEDIATE")
+            try:
+                now = time.time()
+                self.db.execute("DELETE FROM leases WHERE expires_at < ?", (now,))
+                self.db.execute("DELETE FROM submits WHERE time < ?", (now - 3600,))
+                self.db.execute("UPDATE leases SET expires_at = ? WHERE owner = ?",
+                                (now + LEASE_TTL_SECONDS, self.owner))
+                self.db.executemany("INSERT OR IGNORE INTO keys (fingerprint) VALUES (?)",
+                                    [(fp,) for fp in fingerprints])
+                result = fn(now)
+                self.db.execute("COMMIT")
+                return result
+            except BaseException:
+                self.db.execute("ROLLBACK")
+                raise
+
+    def _key_state(self, fingerprint: str, rate_per_minute: float, now: float) -> tuple:
+        """返回 (还需等待的秒数, 所有进程的进行中任务数, 累计提交数)"""
+        cooldown_until, submitted = self.db.execute(
+            "SELECT cooldown_until, submitted FROM keys WHERE fingerprint = ?", (fingerprint,)).fetchone()
+        in_flight = self.db.execute(
+            "SELECT COUNT(*) FROM leases WHERE fingerprint = ?", (fingerprint,)).fetchone()[0]
+        # 滑动窗口限速：rate < 1 时把窗口拉长，保证每个窗口至少允许一次提交
+        window = 60 / min(1.0, rate_per_minute)
+        limit = max(1, int(rate_per_minute))
+        recent = [t for (t,) in self.db.execute(
+            "SELECT time FROM submits WHERE fingerprint = ? AND time > ? ORDER BY time",
+            (fingerprint, now - window))]
+        rate_wait = recent[-limit] + window - now if len(recent) >= limit else 0.0
+        return max(0.0, cooldown_until - now, rate_wait), in_flight, submitted
+
+    def acquire(self, fingerprints: list, rate_per_minute: float) -> Optional[str]:
+        """选一个可以立即提交的 Key 并登记租约和提交记录，没有则返回 None"""
+        def pick(now):
+            ready = []
+            for i, fp in enumerate(fingerprints):
+                wait, in_flight, submitted = self._key_state(fp, rate_per_minute, now)
+                if wait == 0:
+                    ready.append((in_flight, submitted, i, fp))
+            if not ready:
+                return None
+            fp = min(ready)[3]
+            self.db.execute("INSERT INTO leases (fingerprint, owner, expires_at) VALUES (?, ?, ?)",
+                            (fp, self.owner, now + LEASE_TTL_SECONDS))
+            self.db.execute("INSERT INTO submits (fingerprint, time) VALUES (?, ?)", (fp, now))
+            self.db.execute("UPDATE keys SET submitted = submitted + 1 WHERE fingerprint = ?", (fp,))
+            return fp
+        return self._transaction(fingerprints, pick)
+
+    def attach(self, fingerprint: str):
+        """恢复的 operation 只占租约，不计入提交"""
+        self._transaction([fingerprint], lambda now: self.db.execute(
+            "INSERT INTO leases (fingerprint, owner, expires_at) VALUES (?, ?, ?)",
+            (fingerprint, self.owner, now + LEASE_TTL_SECONDS)))
+
+    def release(self, fingerprint: str):
+        self._transaction([fingerprint], lambda now: self.db.execute(
+            "DELETE FROM leases WHERE id = (SELECT id FROM leases WHERE fingerprint = ? AND owner = ? LIMIT 1)",
+            (fingerprint, self.owner)))
+
+    def report_success(self, fingerprint: str):
+        self._transaction([fingerprint], lambda now: self.db.execute(
+            "UPDATE keys SET quota_strikes = 0, succeeded = succeeded + 1 WHERE fingerprint = ?",
+            (fingerprint,)))
+
+    def report_quota_error(self, fingerprint: str) -> float:
+        """登记一次 429，返回该 Key 对所有进程的剩余冷却秒数"""
+        def cool(now):
+            cooldown_until, strikes = self.db.execute(
+                "SELECT cooldown_until, quota_strikes FROM keys WHERE fingerprint = ?", (fingerprint,)).fetchone()
+            if cooldown_until > now:
+                # 其他进程已经让它冷却了：同一波 429 不重复加倍
+                return cooldown_until - now
+            cooldown = min(KEY_COOLDOWN_SECONDS * 2 ** strikes, KEY_MAX_COOLDOWN_SECONDS)
+            self.db.execute("UPDATE keys SET cooldown_until = ?, quota_strikes = quota_strikes + 1, "
+                            "quota_errors = quota_errors + 1 WHERE fingerprint = ?", (now + cooldown, fingerprint))
+            return cooldown
+        return self._transaction([fingerprint], cool)
+
+    def wait_time(self, fingerprints: list, rate_per_minute: float) -> float:
+        return self._transaction(fingerprints, lambda now: min(
+            self._key_state(fp, rate_per_minute, now)[0] for fp in fingerprints))
+
+    def usage(self, fingerprints: list) -> dict:
+        """指纹 -> 所有进程合计的 {in_flight, submitted, succeeded, quota_errors, owners}"""
+        def read(now):
+            usage = {}
+            for fp in fingerprints:
+                submitted, succeeded, quota_errors = self.db.execute(
+                    "SELECT submitted, succeeded, quota_errors FROM keys WHERE fingerprint = ?", (fp,)).fetchone()
+                in_flight, owners = self.db.execute(
+                    "SELECT COUNT(*), COUNT(DISTINCT owner) FROM leases WHERE fingerprint = ?", (fp,)).fetchone()
+                usage[fp] = {"in_flight": in_flight, "owners": owners, "submitted": submitted,
+                             "succeeded": succeeded, "quota_errors": quota_errors}
+            return usage
+        return self._transaction(fingerprints, read)
+
+    def close(self):
+        """释放本进程剩下的租约（进行中的 operation 已写入任务日志，--resume 时重新占用）"""
+        with self.lock:
+            self.db.execute("DELETE FROM leases WHERE owner = ?", (self.owner,))
+            self.db.close()
+
+
+class ApiKeySlot:
+    """一个 API Key 的状态：常驻后端、限速、冷却、进行中的任务数"""
+
+    def __init__(self, index: int, api_key: str, rate_per_minute: float, clock=time,
+                 backend_factory=VeoBackend):
+        self.index = index
+        self.api_key = api_key
+        self.backend = backend_factory(api_key)
+        self.bucket = TokenBucket(rate_per_minute, clock=clock)
+        self.clock = clock
+        self.cooldown_until = 0.0
+        self.quota_strikes = 0
+        self.in_flight = 0
+        self.submitted = 0
+        self.disabled = None  # Key 无效时记录原因，本次运行不再使用
+
+    @property
+    def label(self) -> str:
+        return f"#{self.index + 1}"
+
+    @property
+    def fingerprint(self) -> str:
+        return key_fingerprint(self.api_key)
+
+    def cooling_for(self) -> float:
+        return max(0.0, self.cooldown_until - self.clock.monotonic())
+
+
+class KeyPool:
+    """在所有健康的 Key 之间分配任务
+
+    优先选择进行中任务最少、且令牌桶有余量的 Key；遇到 429 的 Key 进入
+    指数增长的冷却期，期间不再分配任务。
+    传入 coordinator 时，进行中任务数、限速和冷却改由所有进程共享的 KeyCoordinator
+    决定，本地只保留本进程的计数用于汇总。
+    """
+
+    def __init__(self, api_keys: list, rate_per_minute: float = KEY_SUBMITS_PER_MINUTE,
+                 clock=time, backend_factory=VeoBackend, coordinator: KeyCoordinator = None):
+        self.slots = [ApiKeySlot(i, key, rate_per_minute, clock, backend_factory)
+                      for i, key in enumerate(api_keys)]
+        self.clock = clock
+        self.rate_per_minute = rate_per_minute
+        self.coordinator = coordinator
+
+    def __len__(self):
+        return len(self.slots)
+
+    @property
+    def fingerprints(self) -> list:
+        return [slot.fingerprint for slot in self.slots]
+
+    def usable(self) -> list:
+        return [slot for slot in self.slots if not slot.disabled]
+
+    def _slot(self, fingerprint: str) -> ApiKeySlot:
+        return next(slot for slot in self.slots if slot.fingerprint == fingerprint)
+
+    def acquire(self) -> Optional[ApiKeySlot]:
+        """取一个可以立即提交的 Key，没有则返回 None"""
+        if self.coordinator:
+            fingerprints = [slot.fingerprint for slot in self.usable()]
+            fingerprint = self.coordinator.acquire(fingerprints, self.rate_per_minute) if fingerprints else None
+            if fingerprint is None:
+                return None
+            slot = self._slot(fingerprint)
+            slot.in_flight += 1
+            slot.submitted += 1
+            return slot
+        candidates = [slot for slot in self.usable() if slot.cooling_for() == 0]
+        candidates.sort(key=lambda slot: (slot.in_flight, slot.submitted))
+        for slot in candidates:
+            if slot.bucket.try_take():
+                slot.in_flight += 1
+                slot.submitted += 1
+                return slot
+        return None
+
+    def attach(self, fingerprint: str) -> Optional[ApiKeySlot]:
+        """为恢复的 operation 占用对应的 Key（不消耗令牌），Key 不在本次列表中则返回 None"""
+        for slot in self.slots:
+            if slot.fingerprint == fingerprint:
+                slot.in_flight += 1
+                if self.coordinator:
+                    self.coordinator.attach(fingerprint)
+                return slot
+        return None
+
+    def release(self, slot: ApiKeySlot):
+        slot.in_flight = max(0, slot.in_flight - 1)
+        if self.coordinator:
+            self.coordinator.release(slot.fingerprint)
+
+    def report_success(self, slot: ApiKeySlot):
+        slot.quota_strikes = 0
+        if self.coordinator:
+            self.coordinator.report_success(slot.fingerprint)
+
+    def report_quota_error(self, slot: ApiKeySlot):
+        if self.coordinator:
+            cooldown = self.coordinator.report_quota_error(slot.fingerprint)
+        else:
+            cooldown = min(KEY_COOLDOWN_SECONDS * 2 ** slot.quota_strikes, KEY_MAX_COOLDOWN_SECONDS)
+        slot.quota_strikes += 1
+        slot.cooldown_until = self.clock.monotonic() + cooldown
+        print(f"  🔑 Key {slot.label} 配额耗尽，冷却 {cooldown:.0f} 秒")
+
+    def disable(self, slot: ApiKeySlot, error):
+        """Key 无效 / 没有权限：换 Key 重试也不会好转，本次运行不再分配给它"""
+        if not slot.disabled:
+            slot.disabled = str(error)
+            print(f"  🔑 Key {slot.label} 无效或没有权限，已停用（剩余 {len(self.usable())} 个可用）")
+
+    def wait_time(self) -> float:
+        """距离下一个 Key 可用还需等待的秒数；没有可用的 Key 时返回 0"""
+        slots = self.usable()
+        if not slots:
+            return 0.0
+        if self.coordinator:
+            return self.coordinator.wait_time([slot.fingerprint for slot in slots], self.rate_per_minute)
+        return min(max(slot.cooling_for(), slot.bucket.time_until_token()) for slot in slots)
+
+    def close(self):
+        if self.coordinator:
+            self.coordinator.close()
+
+
+# ============================================================
+# Veo 视频生成
+# ============================================================
+
+# 轮询间隔（秒）：根据任务已运行时间和历史完成时间自适应调整
+POLL_MIN_INTERVAL = 2
+POLL_MAX_INTERVAL = 30
+POLL_JITTER = 0.2
+POLL_STEP = 5                   # 第一次检查之后的固定间隔
+POLL_FIRST_PERCENTILE = 10      # 第一次检查放在历史完成耗时的这个百分位
+POLL_SLOWDOWN_PERCENTILE = 95   # 超过这个百分位后逐渐放缓
+POLL_DEFAULT_FRACTIONS = (0.6, 1.5)  # 历史不足时，以上两个时间点取预估耗时的这些倍数
+POLL_MIN_HISTORY = 5
+EXPECTED_GENERATION_SECONDS = 90  # 尚无历史数据时的预估生成时间
+
+# 对冲：主模型超过历史耗时的某个百分位仍未完成时，把同一任务再发给备用模型
+TIER_PRIMARY = "primary"
+TIER_HEDGE = "hedge"
+HEDGE_PERCENTILE = 90
+HEDGE_MIN_SAMPLES = 5           # 主模型完成数少于此值时用默认截止时间
+HEDGE_DEFAULT_DEADLINE = 2 * EXPECTED_GENERATION_SECONDS
+
+DOWNLOAD_WORKERS = 4            # 下载线程数，与轮询循环相互独立
+DOWNLOAD_RETRIES = 3            # 同一个视频下载失败后的重试次数（不重新生成）
+DOWNLOAD_RETRY_DELAY = 2        # 首次重试前等待的秒数，之后翻倍
+SERVE_TICK_SECONDS = 1.0        # 常驻模式下调度循环检查新任务的间隔
+MIN_VIDEO_BYTES = 10 * 1024     # 小于此大小的下载结果视为损坏
+
+
+@dataclass(eq=False)
+class VideoJob:
+    """一个待生成的动作视频（按对象身份比较，对冲任务和原任务互相引用）"""
+    action: str                      # prompts.json 中的动作，决定 prompt
+    prompt: str
+    duration: int
+    start_frame: StartFrame
+    assets_dir: str
+    input_hash: Optional[str] = None
+    file_name: Optional[str] = None  # 输出文件名，默认 <action>.mp4（sequence 分段等情况不同）
+    attempts: int = 0
+    quota_errors: int = 0
+    transient_errors: int = 0
+    key_index: int = 0
+    key_fingerprint: Optional[str] = None
+    operation: Any = None
+    operation_name: Optional[str] = None
+    resumed: bool = False
+    character: str = ""
+    postprocess_only: bool = False
+    postprocess: Optional[dict] = None
+    output_path: Optional[str] = None
+    candidates: int = 1              # 每个 operation 请求的视频数
+    motion: str = "medium"           # 预期运动量，候选评分用
+    candidate_downloads: list = field(default_factory=list)  # 已结束的候选：(路径, 评分)，失败为异常
+    candidate_total: int = 0
+    candidate_scores: Optional[list] = None
+    error: Optional[str] = None  # 最后一次失败的原因
+    model: str = VIDEO_MODEL
+    tier: str = TIER_PRIMARY         # 结果来自哪个模型档位
+    hedge: Optional["VideoJob"] = field(default=None, repr=False)     # 进行中的对冲任务
+    hedge_of: Optional["VideoJob"] = field(default=None, repr=False)  # 对冲任务指向原任务
+    hedged: bool = False
+    deferred_failure: Optional[tuple] = field(default=None, repr=False)  # 等对冲结果时暂缓处理的 (slot, error)
+    timings: dict = field(default_factory=dict)  # 事件名 -> 调度器时钟时间，见 job_phases()
+
+    @property
+    def output_name(self) -> str:
+        return self.file_name or f"{self.action}.mp4"
+
+    @property
+    def clip(self) -> str:
+        """输出文件名去掉扩展名，例如 speaking2"""
+        return os.path.splitext(self.output_name)[0]
+
+    @property
+    def label(self) -> str:
+        return f"{self.character}/{self.clip}" if self.character else self.clip
+
+
+def submit_video(backend, job: VideoJob):
+    """提交 image_to_video 请求，返回 operation（不等待完成）"""
+    model = f", 备用模型 {job.model}" if job.tier == TIER_HEDGE else ""
+    print(f"\n[{job.label}] 提交生成请求 (Key #{job.key_index + 1}{model})...")
+    print(f"  时长: {job.duration}秒")
+    print(f"  起始帧: {job.start_frame.path}")
+    if job.candidates > 1:
+        print(f"  候选数: {job.candidates}")
+    return backend.submit(job.model, job.prompt, job.start_frame, job.duration,
+                          number_of_videos=job.candidates)
+
+
+def extract_videos(operation) -> list:
+    """从已完成的 operation 中取出生成的所有视频，失败时抛出 GenerationError
+
+    多候选时部分视频被安全过滤不算失败，只要还剩下至少一个。
+    """
+    if operation.error:
+        raise GenerationError(f"operation 失败: {operation.error}",
+                              classify_operation_error(operation.error))
+    response = operation.response
+    if not response:
+        raise GenerationError(f"响应为空，operation: {operation}", ERROR_TRANSIENT)
+    if not response.generated_videos:
+        if response.rai_media_filtered_count:
+            raise GenerationError(f"视频被安全过滤: {response.rai_media_filtered_reasons}",
+                                  ERROR_REJECTED)
+        raise GenerationError(f"没有生成视频，response: {response}", ERROR_TRANSIENT)
+    if response.rai_media_filtered_count:
+        print(f"  {response.rai_media_filtered_count} 个候选被安全过滤: "
+              f"{response.rai_media_filtered_reasons}")
+    return response.generated_videos
+
+
+def validate_mp4(path: str) -> Optional[str]:
+    """检查文件大小和 MP4 头（第 4-8 字节为 ftyp），有问题返回错误描述"""
+    size = os.path.getsize(path)
+    if size < MIN_VIDEO_BYTES:
+        return f"文件过小 ({size} 字节)"
+    with open(path, 'rb') as f:
+        header = f.read(12)
+    if header[4:8] != b"ftyp":
+        return f"不是有效的 MP4 文件 (文件头: {header[:12]!r})"
+    return None
+
+
+def is_video_gone(error) -> bool:
+    """下载返回 404 / 410：生成结果已在服务端过期，只能重新生成"""
+    errors = sys.modules.get("google.genai.errors")
+    if errors and isinstance(error, errors.APIError):
+        return error.code in (404, 410) or error.status == "NOT_FOUND"
+    return False
+
+
+def download_video(backend, job: VideoJob, video, output_path: str = None) -> str:
+    """下载已完成 operation 的视频；失败时在下载线程里重试同一个视频
+
+    网络中断、文件头校验失败都只是重新下载，不重新生成（那会再消耗一次配额）。
+    视频已在服务端过期（is_video_gone）时不再重试。
+    """
+    output_path = output_path or os.path.join(job.assets_dir, job.output_name)
+    for attempt in range(DOWNLOAD_RETRIES + 1):
+        try:
+            _download_to(backend, job, video, output_path)
+            break
+        except Exception as e:
+            if attempt == DOWNLOAD_RETRIES or is_video_gone(e):
+                raise
+            delay = DOWNLOAD_RETRY_DELAY * 2 ** attempt
+            print(f"  [{job.label}] 下载失败: {e}，{delay}秒后重新下载")
+            time.sleep(delay)
+    print(f"  [{job.label}] 成功! 保存到: {output_path}")
+    return output_path
+
+
+def _download_to(backend, job: VideoJob, video, output_path: str):
+    """流式下载到同目录的临时文件，校验通过后原子替换正在使用的资源
+
+    前端随时可能在读 assets 下的视频，直接覆盖写会让它读到半个文件。
+    """
+    output_dir = os.path.dirname(output_path)
+    os.makedirs(output_dir, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=output_dir, prefix=f".{job.clip}.", suffix=".part")
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            backend.download(video, f)
+            f.flush()
+            os.fsync(f.fileno())
+        problem = validate_mp4(tmp_path)
+        if problem:
+            raise GenerationError(f"下载的视频无效: {problem}", ERROR_TRANSIENT)
+        os.chmod(tmp_path, 0o644)  # mkstemp 默认 0600，静态服务器会读不到
+        adopt_before_replace(output_path)
+        os.replace(tmp_path, output_path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def download_candidate(backend, job: VideoJob, video, output_path: str) -> tuple:
+    """下载一个候选并评分，在下载线程中运行，返回 (路径, 评分)"""
+    path = download_video(backend, job, video, output_path)
+    return path, score_candidate(path, job.motion)
+
+
+class AdaptivePoller:
+    """统一轮询所有进行中的 operation
+
+    在历史完成耗时的 p10 之前一次都不查询（几乎不可能已经完成），之后每 POLL_STEP
+    秒查询一次，完成后最多 POLL_STEP 秒就能发现；超过 p95 后逐渐放缓。
+    间隔加入随机抖动，避免多个任务同时打到 API 上。
+    """
+
+    def __init__(self, min_interval: float = POLL_MIN_INTERVAL,
+                 max_interval: float = POLL_MAX_INTERVAL,
+                 expected: float = EXPECTED_GENERATION_SECONDS, clock=time,
+                 jitter: float = POLL_JITTER):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.default_expected = expected
+        self.clock = clock
+        self.jitter = jitter
+        self.entries = {}
+        self.history = []  # 已完成 operation 的耗时（秒）
+        self.status_calls = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def expected_duration(self) -> float:
+        """最近完成耗时的中位数，没有历史时用默认预估"""
+        if not self.history:
+            return self.default_expected
+        return statistics.median(self.history[-20:])
+
+    def schedule(self) -> tuple:
+        """(第一次检查时间, 开始放缓的时间)，从提交起算的秒数"""
+        recent = self.history[-50:]
+        if len(recent) < POLL_MIN_HISTORY:
+            return tuple(self.default_expected * fraction for fraction in POLL_DEFAULT_FRACTIONS)
+        return percentile(recent, POLL_FIRST_PERCENTILE), percentile(recent, POLL_SLOWDOWN_PERCENTILE)
+
+    def next_interval(self, elapsed: float) -> float:
+        first, slowdown = self.schedule()
+        if first - elapsed >= self.min_interval:
+            # 第一次检查不受 max_interval 限制：提前查询只是浪费一次调用
+            return (first - elapsed) * random.uniform(1 - self.jitter, 1)
+        interval = POLL_STEP + max(0.0, elapsed - slowdown) / 4
+        interval = min(max(interval, self.min_interval), self.max_interval)
+        return interval * random.uniform(1 - self.jitter, 1 + self.jitter)
+
+    def add(self, key, operation, refresh, on_done, on_error, started_at: float = None):
+        """登记一个 operation
+
+        refresh(operation) 返回最新状态；完成时调用 on_done(operation, elapsed)，
+        查询出错时调用 on_error(exception)。
+        """
+        now = self.clock.monotonic()
+        started_at = now if started_at is None else started_at
+        self.entries[key] = {
+            "operation": operation,
+            "refresh": refresh,
+            "on_done": on_done,
+            "on_error": on_error,
+            "started_at": started_at,
+            "next_check": now + self.next_interval(now - started_at),
+        }
+
+    def remove(self, key):
+        self.entries.pop(key, None)
+
+    def time_until_next(self) -> Optional[float]:
+        """距离最早需要检查的 operation 还有多少秒，没有 operation 时返回 None"""
+        if not self.entries:
             return None
+        next_check = min(entry["next_check"] for entry in self.entries.values())
+        return max(0.0, next_check - self.clock.monotonic())
+
+    def wait(self):
+        """睡眠到最早需要检查的 operation"""
+        delay = self.time_until_next()
+        if delay:
+            self.clock.sleep(delay)
+
+    def poll_due(self) -> int:
+        """检查所有到期的 operation，返回本轮检查数量"""
+        now = self.clock.monotonic()
+        due = [key for key, entry in self.entries.items() if entry["next_check"] <= now]
+        for key in due:
+            entry = self.entries[key]
+            self.status_calls += 1
+            try:
+                operation = entry["refresh"](entry["operation"])
+            except Exception as e:
+                self.remove(key)
+                entry["on_error"](e)
+                continue
+            now = self.clock.monotonic()
+            elapsed = now - entry["started_at"]
+            if operation.done:
+                self.remove(key)
+                self.history.append(elapsed)
+                entry["on_done"](operation, elapsed)
+            else:
+                entry["operation"] = operation
+                entry["next_check"] = now + self.next_interval(elapsed)
+        return len(due)
+
+
+class VideoScheduler:
+    """并发提交 Veo operation，由 AdaptivePoller 统一轮询，完成后交给下载线程池
+
+    最多同时有 parallel 个 operation 在服务端运行，由 KeyPool 分摊到所有
+    健康的 API Key 上。失败按错误类型处理：配额错误冷却该 Key 后重新排队，
+    prompt / 安全过滤错误直接失败，临时错误有限次重试。
+    下载完成后如有后处理（转码等），交给进程池执行。
+    开启对冲时，运行时间超过主模型历史耗时某个百分位的任务会再提交一份给
+    备用模型，先拿到结果的一方胜出（同时完成时优先主模型），另一方的结果被忽略。
+    所有状态变更（manifest、日志、重试）都在调用 run() 的线程中进行，
+    下载线程和后处理进程只负责文件 I/O 和计算。
+    """
+
+    def __init__(self, key_pool: KeyPool, parallel: int = 1, clock=time,
+                 download_workers: int = DOWNLOAD_WORKERS, postprocess_options: dict = None,
+                 poller: AdaptivePoller = None, on_complete=None, hedge: dict = None):
+        self.key_pool = key_pool
+        self.parallel = max(1, parallel)
+        self.clock = clock
+        self.pending = deque()
+        self.poller = poller if poller is not None else AdaptivePoller(clock=clock)  # 空的 poller 也是假值
+        self.download_pool = ThreadPoolExecutor(max_workers=download_workers,
+                                                thread_name_prefix="veo-download")
+        self.downloads = {}  # future -> (job, slot)
+        self.postprocess_options = postprocess_options or {}
+        self.postprocess_pool = None
+        self.postprocessing = {}  # future -> job
+        self.succeeded = []
+        self.failed = []
+        self.on_complete = on_complete  # on_complete(job, 成功与否)，在调度线程中调用
+        self.max_wait = None  # 常驻模式下单次等待的上限
+        self.inbox = deque()
+        self.inbox_lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.tracked = {}  # id(job) -> (job, slot)，正在轮询的 operation
+        self.hedge = hedge  # {"model": 备用模型, "percentile": 截止百分位}，None 为不对冲
+        self.hedge_pending = deque()
+        self.hedges_launched = 0
+        self.hedge_wins = []
+        self.latency = []  # 主模型 operation 的完成耗时（秒），用于计算对冲截止时间
+
+    def add(self, job: VideoJob):
+        job.timings.setdefault("queued", self.clock.monotonic())
+        self.pending.append(job)
+
+    def add_postprocess(self, job: VideoJob):
+        """视频本身已是最新，只重新做后处理"""
+        job.timings.setdefault("queued", self.clock.monotonic())
+        file_name = job.output_name
+        raw_path = os.path.join(job.assets_dir, RAW_CACHE_DIR, file_name)
+        if not os.path.exists(raw_path):
+            os.makedirs(os.path.dirname(raw_path), exist_ok=True)
+            shutil.copyfile(os.path.join(job.assets_dir, file_name), raw_path)
+        job.postprocess_only = True
+        self._start_postprocess(job, raw_path)
+
+    def _start_postprocess(self, job: VideoJob, raw_path: str):
+        if self.postprocess_pool is None:
+            self.postprocess_pool = ProcessPoolExecutor(max_workers=POSTPROCESS_WORKERS)
+        print(f"  [{job.label}] 后处理中...")
+        future = self.postprocess_pool.submit(postprocess_clip, raw_path, job.assets_dir,
+                                              job.output_name, self.postprocess_options)
+        self.postprocessing[future] = job
+        job.timings["postprocess_started"] = self.clock.monotonic()
+
+    def _finish(self, job: VideoJob):
+        try:
+            if job.input_hash:
+                record_generated(job)
+        except Exception as e:
+            print(f"  [{job.label}] 写入生成记录失败: {type(e).__name__}: {e}")
+            job.error = f"record: {e}"
+            self._fail(job)
+            return
+        job.timings["done"] = self.clock.monotonic()
+        self.succeeded.append(job)
+        self._notify(job, True)
+
+    def _fail(self, job: VideoJob):
+        job.timings["failed"] = self.clock.monotonic()
+        self.failed.append(job)
+        self._notify(job, False)
+
+    def _notify(self, job: VideoJob, succeeded: bool):
+        """调用 on_complete；出错只影响这一个任务（成功的改记为失败），调度循环继续"""
+        if not self.on_complete:
+            return
+        try:
+            self.on_complete(job, succeeded)
+        except Exception as e:
+            print(f"  [{job.label}] 完成后处理出错: {type(e).__name__}: {e}")
+            job.error = f"on_complete: {e}"
+            if succeeded:
+                self.succeeded.remove(job)
+                del job.timings["done"]
+                self._fail(job)
+
+    def _journal_finished(self, job: VideoJob, status: str):
+        if job.operation_name:
+            journal_append(job.assets_dir, {
+                "event": "finished",
+                "operation": job.operation_name,
+                "status": status,
+                "time": time.time(),
+            })
+            job.operation_name = None
+
+    def _handle_failure(self, job: VideoJob, slot: ApiKeySlot, error):
+        """按错误类型决定冷却 Key / 重新排队 / 放弃"""
+        job.operation = None
+        self._journal_finished(job, "failed")
+        kind = classify_error(error)
+        if job.hedge is not None:
+            # 备用模型还在生成，等它的结果再决定是否重试
+            job.deferred_failure = (slot, error)
+            print(f"  [{job.label}] 主模型失败 ({kind}): {error}，等待备用模型结果")
+            return
+        job.error = f"{kind}: {error}"
+        print(f"  [{job.label}] 错误 ({kind}): {error}")
+        if kind == ERROR_KEY:
+            self.key_pool.disable(slot, error)
+            retry = bool(self.key_pool.usable())
+        elif job.resumed:
+            # 恢复的 operation 可能已在服务端过期（查询返回 4xx），退回到正常提交；
+            # 只有生成结果本身被拒（安全过滤等）才放弃
+            job.resumed = False
+            retry = not (kind == ERROR_REJECTED and isinstance(error, GenerationError))
+        elif kind == ERROR_QUOTA:
+            self.key_pool.report_quota_error(slot)
+            job.quota_errors += 1
+            retry = job.quota_errors < len(self.key_pool) * QUOTA_RETRY_ROUNDS
+        elif kind == ERROR_TRANSIENT:
+            job.transient_errors += 1
+            retry = job.transient_errors <= MAX_TRANSIENT_RETRIES
+        else:
+            retry = False
 
-        output_path = os.path.join(assets_dir, f"{action}.mp4")
-        video_client.files.download(file=video.video)
-        video.video.save(output_path)
-        print(f"  成功! 保存到: {output_path}")
-        return output_path
+        if retry:
+            print(f"  重试 [{job.label}]...")
+            self.pending.appendleft(job)
+        else:
+            print(f"  放弃 [{job.label}]")
+            self._fail(job)
+
+    def _fail_without_keys(self):
+        """所有 Key 都已停用：排队中的任务不可能再提交"""
+        while self.hedge_pending:
+            hedge = self.hedge_pending.popleft()
+            self._on_hedge_failed(hedge, None, GenerationError("没有可用的 API Key", ERROR_KEY))
+        while self.pending:
+            job = self.pending.popleft()
+            job.error = job.error or f"{ERROR_KEY}: 没有可用的 API Key"
+            print(f"  放弃 [{job.label}]：没有可用的 API Key")
+            self._fail(job)
+
+    def _submit_pending(self):
+        if not self.key_pool.usable():
+            self._fail_without_keys()
+            return
+        self._submit_hedges()
+        # 对冲任务不占用并发名额，只受 Key 可用性限制
+        hedges = sum(1 for job, _ in self.tracked.values() if job.hedge_of is not None)
+        while self.pending and len(self.poller) - hedges < self.parallel:
+            slot = self.key_pool.acquire()
+            if slot is None:
+                return
+            job = self.pending.popleft()
+            job.attempts += 1
+            job.key_index = slot.index
+            job.key_fingerprint = slot.fingerprint
+            # 重试时丢弃上一次尝试的时间点，失败尝试的耗时计入 retries 阶段
+            for event in ("submitted", "running", "generated", "downloaded"):
+                job.timings.pop(event, None)
+            now = self.clock.monotonic()
+            job.timings.setdefault("first_submit", now)
+            job.timings["submit_started"] = now
+            try:
+                job.operation = submit_video(slot.backend, job)
+            except Exception as e:
+                self.key_pool.release(slot)
+                self._handle_failure(job, slot, e)
+                continue
+            job.timings["submitted"] = self.clock.monotonic()
+            job.operation_name = job.operation.name
+            journal_append(job.assets_dir, {
+                "event": "submitted",
+                "operation": job.operation_name,
+                "action": job.action,
+                "file": job.output_name,
+                "key_index": slot.index,
+                "key": slot.fingerprint,
+                "input_hash": job.input_hash,
+                "model": job.model,
+                "time": time.time(),
+            })
+            self._track(job, slot)
+
+    def resume(self, job: VideoJob, record: dict) -> bool:
+        """继续轮询日志中未结束的 operation，不重新提交"""
+        slot = self.key_pool.attach(record["key"])
+        if slot is None:
+            return False
+        job.key_index = slot.index
+        job.key_fingerprint = slot.fingerprint
+        job.resumed = True
+        job.operation_name = record["operation"]
+        job.operation = slot.backend.operation_from_name(record["operation"])
+        elapsed = max(0.0, time.time() - record["time"])
+        print(f"[{job.label}] 恢复 operation (Key {slot.label}, 已提交 {elapsed:.0f}秒)")
+        started_at = self.clock.monotonic() - elapsed
+        job.timings["submitted"] = started_at
+        self._track(job, slot, started_at=started_at)
+        return True
+
+    def _track(self, job: VideoJob, slot: ApiKeySlot, started_at: float = None):
+        self.tracked[id(job)] = (job, slot)
+
+        def refresh(operation):
+            operation = slot.backend.refresh(operation)
+            if "running" not in job.timings and slot.backend.is_running(operation):
+                job.timings["running"] = self.clock.monotonic()
+            return operation
+
+        def on_done(operation, elapsed):
+            self.tracked.pop(id(job), None)
+            self.key_pool.release(slot)
+            job.operation = operation
+            if job.hedge_of is not None:
+                self._on_hedge_done(job, slot, operation, elapsed)
+                return
+            self.latency.append(elapsed)
+            try:
+                videos = extract_videos(operation)
+            except Exception as e:
+                self._handle_failure(job, slot, e)
+                return
+            self._drop_hedge(job)
+            self._start_download(job, slot, videos, elapsed)
+
+        def on_error(e):
+            self.tracked.pop(id(job), None)
+            self.key_pool.release(slot)
+            if job.hedge_of is not None:
+                self._on_hedge_failed(job, slot, e)
+            else:
+                self._handle_failure(job, slot, e)
+
+        self.poller.add(id(job), job.operation, refresh,
+                        on_done, on_error, started_at=started_at)
+
+    def _start_download(self, job: VideoJob, slot: ApiKeySlot, videos: list, elapsed: float):
+        job.timings["generated"] = self.clock.monotonic()
+        if job.candidates > 1:
+            # 所有候选并行下载、评分，全部结束后在 _collect_candidate 中挑选
+            print(f"  [{job.label}] 生成完成 ({elapsed:.0f}秒)，开始下载 {len(videos)} 个候选")
+            job.candidate_downloads = []
+            job.candidate_total = len(videos)
+            for i, video in enumerate(videos):
+                path = os.path.join(job.assets_dir, CANDIDATE_DIR, f"{job.clip}-{i + 1}.mp4")
+                future = self.download_pool.submit(download_candidate, slot.backend, job, video, path)
+                self.downloads[future] = (job, slot)
+            return
+        print(f"  [{job.label}] 生成完成 ({elapsed:.0f}秒)，开始下载")
+        future = self.download_pool.submit(download_video, slot.backend, job, videos[0],
+                                           self._download_path(job))
+        self.downloads[future] = (job, slot)
+
+    # ---------- 对冲 ----------
+
+    def hedge_deadline(self) -> float:
+        """主模型运行超过这个秒数仍未完成就发起对冲"""
+        if len(self.latency) < HEDGE_MIN_SAMPLES:
+            return HEDGE_DEFAULT_DEADLINE
+        return percentile(self.latency[-50:], self.hedge["percentile"])
+
+    def _hedge_candidates(self) -> list:
+        """还没发起过对冲的主模型 operation"""
+        return [job for job, _ in self.tracked.values()
+                if job.hedge_of is None and not job.hedged and "submitted" in job.timings]
+
+    def _time_until_hedge(self) -> Optional[float]:
+        if not self.hedge:
+            return None
+        jobs = self._hedge_candidates()
+        if not jobs:
+            return None
+        deadline = self.hedge_deadline()
+        now = self.clock.monotonic()
+        return max(0.0, min(job.timings["submitted"] + deadline - now for job in jobs))
 
-    except Exception as e:
-        print(f"  错误: {e}")
+    def _launch_hedges(self):
+        if not self.hedge:
+            return
+        deadline = self.hedge_deadline()
+        now = self.clock.monotonic()
+        for job in self._hedge_candidates():
+            running = now - job.timings["submitted"]
+            if running < deadline:
+                continue
+            job.hedged = True
+            job.hedge = VideoJob(job.action, job.prompt, job.duration, job.start_frame, job.assets_dir,
+                                 input_hash=job.input_hash, file_name=job.file_name,
+                                 character=job.character, candidates=job.candidates, motion=job.motion,
+                                 model=self.hedge["model"], tier=TIER_HEDGE, hedge_of=job)
+            self.hedge_pending.append(job.hedge)
+            self.hedges_launched += 1
+            print(f"  [{job.label}] 已运行 {running:.0f}秒，超过 p{self.hedge['percentile']:g} "
+                  f"({deadline:.0f}秒)，同时提交给备用模型 {self.hedge['model']}")
+
+    def _submit_hedges(self):
+        while self.hedge_pending:
+            slot = self.key_pool.acquire()
+            if slot is None:
+                return
+            hedge = self.hedge_pending.popleft()
+            hedge.attempts += 1
+            hedge.key_index = slot.index
+            hedge.key_fingerprint = slot.fingerprint
+            try:
+                hedge.operation = submit_video(slot.backend, hedge)
+            except Exception as e:
+                self.key_pool.release(slot)
+                self._on_hedge_failed(hedge, slot, e)
+                continue
+            # 对冲任务不写日志：--resume 时只恢复主模型的 operation
+            hedge.timings["submitted"] = self.clock.monotonic()
+            self._track(hedge, slot)
+
+    def _drop_hedge(self, job: VideoJob):
+        """主模型先完成：撤下还在排队或生成中的对冲任务
+
+        Veo 没有取消 operation 的接口，已提交的对冲只是不再轮询，结果被丢弃。
+        """
+        hedge, job.hedge = job.hedge, None
+        if hedge is None:
+            return
+        if hedge in self.hedge_pending:
+            self.hedge_pending.remove(hedge)
+        else:
+            self.poller.remove(id(hedge))
+            tracked = self.tracked.pop(id(hedge), None)
+            if tracked:
+                self.key_pool.release(tracked[1])
+        print(f"  [{job.label}] 主模型先完成，忽略备用模型的请求")
+
+    def _on_hedge_done(self, hedge: VideoJob, slot: ApiKeySlot, operation, elapsed: float):
+        job = hedge.hedge_of
+        try:
+            videos = extract_videos(operation)
+        except Exception as e:
+            self._on_hedge_failed(hedge, slot, e)
+            return
+        job.hedge = None
+        entry = self.poller.entries.get(id(job))
+        if entry is not None:
+            # 主模型可能也已经完成：两边都有结果时用主模型
+            self.poller.status_calls += 1
+            try:
+                primary = entry["refresh"](entry["operation"])
+                if primary.done:
+                    extract_videos(primary)
+                    entry["operation"] = primary
+                    entry["next_check"] = self.clock.monotonic()
+                    print(f"  [{job.label}] 主模型和备用模型都已完成，使用主模型的结果")
+                    return
+            except Exception:
+                pass
+            self.poller.remove(id(job))
+            _, primary_slot = self.tracked.pop(id(job))
+            self.key_pool.release(primary_slot)
+            self._journal_finished(job, "abandoned")
+        job.deferred_failure = None
+        job.tier = hedge.tier
+        job.model = hedge.model
+        job.key_index = hedge.key_index
+        job.key_fingerprint = hedge.key_fingerprint
+        job.operation = operation
+        self.hedge_wins.append(job)
+        print(f"  [{job.label}] 备用模型 {hedge.model} 先完成，放弃主模型的请求")
+        self._start_download(job, slot, videos, elapsed)
+
+    def _on_hedge_failed(self, hedge: VideoJob, slot: ApiKeySlot, error):
+        job = hedge.hedge_of
+        kind = classify_error(error)
+        if kind == ERROR_QUOTA:
+            self.key_pool.report_quota_error(slot)
+        elif kind == ERROR_KEY and slot is not None:
+            self.key_pool.disable(slot, error)
+        print(f"  [{job.label}] 备用模型失败 ({kind}): {error}")
+        if job.hedge is not hedge:
+            return
+        job.hedge = None
+        if job.deferred_failure:
+            # 主模型早已失败，现在两边都没有结果，按主模型的错误处理
+            primary_slot, primary_error = job.deferred_failure
+            job.deferred_failure = None
+            self._handle_failure(job, primary_slot, primary_error)
+
+    def _collect_downloads(self, timeout: float):
+        """等待最多 timeout 秒，处理已结束的下载和后处理"""
+        done, _ = wait_futures(list(self.downloads) + list(self.postprocessing),
+                               timeout=timeout, return_when=FIRST_COMPLETED)
+        for future in done:
+            if future in self.postprocessing:
+                self._on_postprocessed(self.postprocessing.pop(future), future)
+                continue
+            job, slot = self.downloads.pop(future)
+            try:
+                path = self._collect_candidate(job, future) if job.candidate_total else future.result()
+            except Exception as e:
+                self._on_download_failed(job, slot, e)
+                continue
+            if path is None:
+                continue  # 还有候选在下载
+            job.timings["downloaded"] = self.clock.monotonic()
+            self.key_pool.report_success(slot)
+            # operation 的结果已经落盘，后处理失败也不需要再轮询它
+            self._journal_finished(job, "succeeded")
+            if self.postprocess_options:
+                self._start_postprocess(job, path)
+            else:
+                job.output_path = path
+                self._finish(job)
+
+    def _on_download_failed(self, job: VideoJob, slot: ApiKeySlot, error):
+        """下载线程里的重试都失败了
+
+        视频已过期才重新生成；否则结果还在服务端，任务记为失败，operation 留在任务日志里，
+        之后用 --resume 只重新下载。下载错误不代表 Key 有问题，不影响 Key 的冷却。
+        """
+        if is_video_gone(error):
+            self._handle_failure(job, slot, GenerationError(f"生成结果已过期: {error}", ERROR_TRANSIENT))
+            return
+        job.error = f"download: {error}"
+        print(f"  [{job.label}] 下载失败: {error}")
+        print(f"  放弃 [{job.label}]（operation 仍在任务日志中，可用 --resume 重新下载，不需要重新生成）")
+        self._fail(job)
+
+    def _download_path(self, job: VideoJob) -> Optional[str]:
+        """有后处理时先下载到原始文件缓存，否则直接下载到 assets"""
+        if self.postprocess_options:
+            return os.path.join(job.assets_dir, RAW_CACHE_DIR, job.output_name)
         return None
 
+    def _collect_candidate(self, job: VideoJob, future) -> Optional[str]:
+        """记录一个候选的下载结果；全部结束后把 penalty 最小的候选换到正式位置并返回路径"""
+        try:
+            job.candidate_downloads.append(future.result())
+        except Exception as e:
+            print(f"  [{job.label}] 候选下载失败: {e}")
+            job.candidate_downloads.append(e)
+        if len(job.candidate_downloads) < job.candidate_total:
+            return None
+        results = [result for result in job.candidate_downloads if isinstance(result, tuple)]
+        job.candidate_total = 0
+        if not results:
+            errors = job.candidate_downloads
+            if all(is_video_gone(error) for error in errors):
+                raise errors[0]
+            raise GenerationError(f"所有候选都下载失败: {errors[-1]}", ERROR_TRANSIENT)
+        results.sort(key=lambda result: result[1]["penalty"])
+        for path, score in results:
+            print(f"    {os.path.basename(path)}: 首尾差 {score['loop_error']:.3f}, "
+                  f"运动量 {score['motion']:.3f}, 扣分 {score['penalty']:.3f}")
+        best_path, _ = results[0]
+        output_path = self._download_path(job) or os.path.join(job.assets_dir, job.output_name)
+        job.candidate_scores = [dict(score, file=os.path.basename(path)) for path, score in results]
+        # 复制而不是移动：落选和入选的候选都留在 candidates/ 里供人工对比
+        os.makedirs(os.path.dirname(output_path), exist_ok=True)
+        tmp_path = output_path + ".part.mp4"
+        shutil.copyfile(best_path, tmp_path)
+        adopt_before_replace(output_path)
+        os.replace(tmp_path, output_path)
+        print(f"  [{job.label}] 选用候选 {os.path.basename(best_path)} → {output_path}")
+        return output_path
+
+    def _on_postprocessed(self, job: VideoJob, future):
+        try:
+            job.postprocess = future.result()
+        except Exception as e:
+            detail = e.stderr.decode(errors="replace").strip() if isinstance(e, subprocess.CalledProcessError) else e
+            print(f"  [{job.label}] 后处理失败: {detail}")
+            job.error = f"postprocess: {detail}"
+            self._fail(job)
+            return
+        job.output_path = os.path.join(job.assets_dir, job.output_name)
+        print(f"  [{job.label}] 后处理完成: {job.output_path}")
+        loop = job.postprocess.get("loop")
+        if loop:
+            if "trim_to" in loop:
+                print(f"    循环点: 第 {loop['frame']}/{loop['frames']} 帧，剪掉 {loop['trimmed_seconds']:.2f}秒，"
+                      f"接缝 {loop['seam']:.3f}")
+            if loop["flagged"]:
+                print(f"    ⚠ 循环接缝明显 ({loop['seam']:.3f} > {loop['options']['threshold']})，"
+                      f"建议用 --regenerate-flagged 重新生成")
+        self._finish(job)
+
+    def _wait(self, delay: float):
+        if self.max_wait is not None:
+            # 常驻模式：定期醒来接收新任务
+            delay = self.max_wait if delay is None else min(delay, self.max_wait)
+        if self.downloads or self.postprocessing:
+            # 下载在真实时间里进行；加速时钟（模拟后端）下需要换算等待时间
+            if delay is not None:
+                delay /= getattr(self.clock, "scale", 1)
+            self._collect_downloads(delay)
+        elif delay:
+            self.clock.sleep(delay)
+
+    def busy(self) -> bool:
+        return bool(len(self.poller) or self.pending or self.hedge_pending
+                    or self.downloads or self.postprocessing)
+
+    def _step(self):
+        """等到下一件事（轮询到期 / 对冲截止 / 下载结束 / Key 可用），处理它，再提交能提交的任务"""
+        if len(self.poller):
+            delays = [d for d in (self.poller.time_until_next(), self._time_until_hedge()) if d is not None]
+            self._wait(min(delays))
+            checked = self.poller.poll_due()
+            if checked and len(self.poller):
+                print(f"    生成中... ({len(self.poller)} 个进行中, "
+                      f"累计 {self.poller.status_calls} 次状态查询)")
+            self._launch_hedges()
+        elif (self.pending or self.hedge_pending) and not (self.downloads or self.postprocessing):
+            # 没有进行中的任务，但所有 Key 都在冷却或限速
+            delay = self.key_pool.wait_time()
+            if self.max_wait is None or delay > self.max_wait:
+                print(f"    等待 API Key 可用 ({delay:.0f}秒)...")
+            self._wait(delay)
+        else:
+            self._wait(self.key_pool.wait_time() if self.pending or self.hedge_pending else None)
+        self._submit_pending()
+
+    def _shutdown(self):
+        self.download_pool.shutdown(wait=True)
+        if self.postprocess_pool is not None:
+            self.postprocess_pool.shutdown(wait=True)
+
+    def run(self):
+        """运行直到所有任务完成或失败"""
+        try:
+            self._submit_pending()
+            while self.busy():
+                self._step()
+        finally:
+            self._shutdown()
+
+    def submit_threadsafe(self, job: VideoJob):
+        """从其他线程（HTTP 请求）加入任务，由 serve_forever 所在线程取走"""
+        with self.inbox_lock:
+            self.inbox.append(job)
+        self.wakeup.set()
+
+    def serve_forever(self, stop: threading.Event, tick: float = SERVE_TICK_SECONDS):
+        """常驻模式：一直运行到 stop 被设置，空闲时等待新任务
+
+        Key 池、后端 client、下载线程池和后处理进程池在整个服务期间保持常驻。
+        """
+        self.max_wait = tick
+        try:
+            while not stop.is_set():
+                with self.inbox_lock:
+                    while self.inbox:
+                        self.add(self.inbox.popleft())
+                if not self.busy():
+                    self.wakeup.wait(tick)
+                    self.wakeup.clear()
+                    continue
+                try:
+                    self._step()
+                except Exception as e:
+                    # 单个任务的错误已在 _finish / _notify 中处理，这里兜住其余意外，服务不能停
+                    print(f"[服务] 调度出错: {type(e).__name__}: {e}")
+                    stop.wait(tick)
+        finally:
+            self._shutdown()
+
 
 # ============================================================
-# 主函数
+# 运行指标：每个任务的分阶段耗时，写入 JSONL 运行日志和 Prometheus textfile
 # ============================================================
 
-def main():
-    parser = argparse.ArgumentParser(
-        description='使用 Google Veo API 为数字人角色生成动作视频',
-        formatter_class=argparse.RawDescriptionHelpFormatter,
-        epilog=f"可用角色: {', '.join(CHARACTERS.keys())}"
-    )
-    parser.add_argument('--api-key', '-k', nargs='+', help='Google AI API Key（可提供多个，轮换使用避免配额限制）')
-    parser.add_argument('--character', '-c', default='fox-xiaoli',
-                        help=f'角色 ID (默认: fox-xiaoli, 可选: {", ".join(CHARACTERS.keys())})')
-    parser.add_argument('--action', '-a', help='只生成指定动作的视频')
-    parser.add_argument('--list', '-l', action='store_true', help='列出所有可用动作')
-    parser.add_argument('--no-crop', action='store_true', help='跳过图片裁剪检查')
+RUN_LOG_PATH = os.path.join(PROJECT_DIR, START_FRAME_CACHE_DIR, "runs.jsonl")
+
+# 阶段名 -> 说明，顺序即任务经历的顺序
+PHASES = {
+    "image_prep": "起始帧预处理",
+    "key_wait": "等待 Key / 并发名额",
+    "retries": "失败重试",
+    "submit": "提交请求",
+    "server_queue": "服务端排队",
+    "generation": "生成",
+    "download": "下载",
+    "postprocess": "后处理",
+}
 
-    args = parser.parse_args()
 
-    # 验证角色
-    if args.character not in CHARACTERS:
-        print(f"错误: 未知角色 '{args.character}'")
-        print(f"可用角色: {', '.join(CHARACTERS.keys())}")
+def percentile(values: list, q: float) -> float:
+    """线性插值百分位数，q 取 0-100"""
+    if not values:
+        return float("nan")
+    ordered = sorted(values)
+    k = (len(ordered) - 1) * q / 100
+    lower = int(k)
+    upper = min(lower + 1, len(ordered) - 1)
+    return ordered[lower] + (ordered[upper] - ordered[lower]) * (k - lower)
+
+
+def job_phases(job: VideoJob) -> dict:
+    """把调度器记录的时间点换算成各阶段耗时（秒），没经历的阶段不出现
+
+    服务端没有报告排队状态时（Veo 目前如此），排队时间计入 generation。
+    """
+    t = job.timings
+
+    def span(start: str, end: str) -> Optional[float]:
+        if start in t and end in t:
+            return max(0.0, t[end] - t[start])
+        return None
+
+    phases = {
+        "image_prep": job.start_frame.prep_seconds,
+        "key_wait": span("queued", "first_submit"),
+        "retries": span("first_submit", "submit_started") if job.attempts > 1 else None,
+        "submit": span("submit_started", "submitted"),
+        "server_queue": span("submitted", "running"),
+        "generation": span("running" if "running" in t else "submitted", "generated"),
+        "download": span("generated", "downloaded"),
+        "postprocess": span("postprocess_started", "done"),
+    }
+    return {name: round(seconds, 3) for name, seconds in phases.items() if seconds is not None}
+
+
+def job_record(job: VideoJob, status: str, run_id: str) -> dict:
+    t = job.timings
+    end = t.get("done", t.get("failed"))
+    return {
+        "event": "job",
+        "run": run_id,
+        "time": time.time(),
+        "character": job.character,
+        "action": job.action,
+        "file": job.output_name,
+        "status": status,
+        "model": job.model,
+        "tier": job.tier,
+        "hedged": job.hedged,
+        "key_index": job.key_index,
+        "key": job.key_fingerprint,
+        "attempts": job.attempts,
+        "candidates": job.candidates,
+        "quota_errors": job.quota_errors,
+        "transient_errors": job.transient_errors,
+        "postprocess_only": job.postprocess_only,
+        "phases": job_phases(job),
+        "total": round(end - t["queued"], 3) if end is not None and "queued" in t else None,
+        "error": job.error,
+    }
+
+
+def append_run_log(path: str, records: list):
+    """追加到 JSONL 运行日志，每行一条记录"""
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, 'a', encoding='utf-8') as f:
+        for record in records:
+            f.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+
+def write_prometheus_textfile(path: str, run: dict, jobs: list):
+    """写出 node_exporter textfile collector 格式的本次运行指标（原子替换）"""
+    lines = []
+
+    def metric(name: str, kind: str, help_text: str, samples: list):
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {kind}")
+        for labels, value in samples:
+            label_text = ",".join(f'{k}="{v}"' for k, v in labels.items())
+            lines.append(f"{name}{{{label_text}}} {value}" if label_text else f"{name} {value}")
+
+    metric("veo_run_timestamp_seconds", "gauge", "最近一次运行的结束时间", [({}, run["time"])])
+    metric("veo_run_duration_seconds", "gauge", "最近一次运行的总耗时", [({}, run["duration"])])
+    metric("veo_run_clips", "gauge", "最近一次运行的视频数",
+           [({"status": status}, run[status]) for status in ("succeeded", "failed", "skipped")])
+    metric("veo_run_status_calls", "gauge", "最近一次运行的 operation 状态查询次数",
+           [({}, run["status_calls"])])
+    metric("veo_run_retries", "gauge", "最近一次运行的重新提交次数",
+           [({}, sum(max(0, job["attempts"] - 1) for job in jobs))])
+
+    succeeded = [job for job in jobs if job["status"] == "succeeded"]
+    samples, sums, counts = [], [], []
+    for phase in PHASES:
+        values = [job["phases"][phase] for job in succeeded if phase in job["phases"]]
+        if not values:
+            continue
+        for q in (0.5, 0.95):
+            samples.append(({"phase": phase, "quantile": q}, round(percentile(values, q * 100), 3)))
+        sums.append(({"phase": phase}, round(sum(values), 3)))
+        counts.append(({"phase": phase}, len(values)))
+    lines.append("# HELP veo_run_phase_seconds 最近一次运行中成功任务的分阶段耗时")
+    lines.append("# TYPE veo_run_phase_seconds summary")
+    for labels, value in samples:
+        lines.append(f'veo_run_phase_seconds{{phase="{labels["phase"]}",quantile="{labels["quantile"]}"}} {value}')
+    for labels, value in sums:
+        lines.append(f'veo_run_phase_seconds_sum{{phase="{labels["phase"]}"}} {value}')
+    for labels, value in counts:
+        lines.append(f'veo_run_phase_seconds_count{{phase="{labels["phase"]}"}} {value}')
+
+    per_key = {}
+    for job in succeeded:
+        per_key[job["key"]] = per_key.get(job["key"], 0) + 1
+    metric("veo_run_key_clips", "gauge", "最近一次运行中每个 API Key（指纹）生成成功的视频数",
+           [({"key": key}, count) for key, count in sorted(per_key.items())])
+
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        f.write("\n".join(lines) + "\n")
+    os.replace(tmp_path, path)
+
+
+def print_phase_summary(jobs: list, key_pool: KeyPool, status_calls: int):
+    """打印成功任务的分阶段耗时表和各 Key 的使用情况"""
+    succeeded = [job for job in jobs if job["status"] == "succeeded"]
+    if not succeeded:
         return
+    print(f"\n{'阶段':<12}{'次数':>2}{'p50(s)':>9}{'p95(s)':>9}{'最大(s)':>8}{'合计(s)':>9}")
+    for phase, description in PHASES.items():
+        values = [job["phases"][phase] for job in succeeded if phase in job["phases"]]
+        if not values:
+            continue
+        print(f"{phase:<14}{len(values):>4}{percentile(values, 50):>9.1f}"
+              f"{percentile(values, 95):>9.1f}{max(values):>9.1f}{sum(values):>10.1f}  {description}")
+    totals = [job["total"] for job in succeeded if job["total"] is not None]
+    if totals:
+        print(f"{'total':<14}{len(totals):>4}{percentile(totals, 50):>9.1f}"
+              f"{percentile(totals, 95):>9.1f}{max(totals):>9.1f}{sum(totals):>10.1f}  排队到完成")
+    print(f"状态查询: {status_calls} 次 (平均 {status_calls / len(succeeded):.1f} 次/视频)")
+    usage = key_pool.coordinator.usage(key_pool.fingerprints) if key_pool.coordinator else {}
+    for slot in key_pool.slots:
+        clips = sum(1 for job in succeeded if job["key"] == slot.fingerprint)
+        line = f"Key {slot.label} ({slot.fingerprint}): 提交 {slot.submitted} 次, 成功 {clips} 个"
+        if slot.fingerprint in usage:
+            shared = usage[slot.fingerprint]
+            line += (f"（所有进程累计: 提交 {shared['submitted']} 次, 成功 {shared['succeeded']} 个, "
+                     f"429 {shared['quota_errors']} 次）")
+        print(line)
 
-    char_config = CHARACTERS[args.character]
-    char_name = char_config["name"]
-    char_emoji = char_config["emoji"]
-    videos = char_config["videos"]
 
-    # 角色资源目录
-    assets_dir = os.path.join(CHARACTERS_DIR, args.character, "assets")
+# ============================================================
+# 服务模式：本地 HTTP API 接收生成任务，共用一个常驻调度器
+# ============================================================
 
-    if args.list:
-        print(f"{char_emoji} {char_name} 可用动作:")
-        for action, (prompt, duration) in videos.items():
-            print(f"  - {action} ({duration}秒)")
+SERVE_HOST = "127.0.0.1"
+SERVE_PORT = 8765
+ACTION_NAME_RE = re.compile(r"[A-Za-z0-9_-]{1,64}")
+CLIP_FILE_RE = re.compile(r"[A-Za-z0-9_-]{1,64}\.mp4")
+SERVE_TOKEN_HEADER = "X-Veo-Token"  # 创建任务必须带上启动时打印的令牌
+DURATION_RANGE = (4, 8)  # Veo 支持的时长（秒）
+
+
+def job_status(job: VideoJob, poller: AdaptivePoller, clock=time) -> dict:
+    """根据调度器记录的时间点推断任务状态和进度（0-1）"""
+    t = dict(job.timings)
+    now = clock.monotonic()
+    if "done" in t:
+        status, progress = "succeeded", 1.0
+    elif "failed" in t:
+        status, progress = "failed", 1.0
+    elif "postprocess_started" in t:
+        status, progress = "postprocessing", 0.95
+    elif "generated" in t:
+        status, progress = "downloading", 0.9
+    elif "submitted" in t:
+        # 生成阶段按历史耗时中位数估算进度，最多到 0.85
+        elapsed = now - t["submitted"]
+        status = "generating"
+        progress = round(min(0.85, 0.85 * elapsed / max(1.0, poller.expected_duration())), 3)
+    else:
+        status, progress = "queued", 0.0
+    return {"status": status, "progress": progress}
+
+
+class SchedulerUnavailable(RuntimeError):
+    """调度线程已经退出，新任务不会再被处理"""
+
+
+class GenerationService:
+    """常驻服务：HTTP 线程只登记任务，所有生成工作在一个调度线程中进行"""
+
+    def __init__(self, key_pool: KeyPool, parallel: int, postprocess_options: dict,
+                 crop: bool = True, candidates: int = 1, run_log: str = RUN_LOG_PATH,
+                 hedge: dict = None):
+        self.scheduler = VideoScheduler(key_pool, parallel=parallel,
+                                        postprocess_options=postprocess_options,
+                                        on_complete=self._on_complete, hedge=hedge)
+        self.crop = crop
+        self.candidates = candidates
+        self.run_log = run_log
+        self.run_id = f"serve-{time.strftime('%Y%m%dT%H%M%S')}-{os.getpid()}"
+        self.jobs = {}  # 任务 ID -> VideoJob
+        self.lock = threading.Lock()
+        self.start_frames = {}  # 起始帧路径 -> StartFrame，同一张图的编码结果在请求间复用
+        self.frame_locks = {}  # 角色 ID -> Lock，同一角色的起始帧预处理和 poster 更新不并发
+        self.stop = threading.Event()
+        self.thread = threading.Thread(target=self.scheduler.serve_forever, args=(self.stop,),
+                                       name="veo-scheduler", daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def shutdown(self):
+        self.stop.set()
+        self.scheduler.wakeup.set()
+        self.thread.join()
+
+    def _start_frame(self, character_id: str) -> StartFrame:
+        assets_dir = os.path.join(CHARACTERS_DIR, character_id, "assets")
+        idle_image = find_idle_image(assets_dir)
+        if not idle_image:
+            raise ValueError(f"角色 {character_id} 没有 idle 静态图")
+        with self.lock:
+            frame_lock = self.frame_locks.setdefault(character_id, threading.Lock())
+        started = time.monotonic()
+        with frame_lock:
+            frame_path, message = prepare_start_frame(idle_image, crop=self.crop)
+        if not frame_path:
+            raise ValueError(message)
+        with self.lock:
+            if frame_path not in self.start_frames:
+                self.start_frames[frame_path] = StartFrame(frame_path)
+                self.start_frames[frame_path].prep_seconds = time.monotonic() - started
+            return self.start_frames[frame_path]
+
+    @staticmethod
+    def resolve_clip(character_id: str, videos: dict, action: Optional[str],
+                     file_name: Optional[str]) -> tuple:
+        """和命令行的 --action 一样按播放器引用找输出文件，返回 (文件名, prompts.json 中的动作)
+
+        例如 star-cat 的 speaking 写到 speaking1.mp4、think 写到 thinking2.mp4；
+        播放器没有引用的新动作写到 <动作>.mp4。同一动作对应多个文件时需要用 file 指定。
+        """
+        refs = player_clip_references(load_player_config(character_id))
+        if file_name is None:
+            matches = select_clip_files(refs, action, videos)
+            if len(matches) > 1:
+                # speaking 同时匹配 speaking1（speaking）和 speaking2（speaking_v2），取提示词同名的
+                matches = {name: ref for name, ref in matches.items()
+                           if clip_recipe(name, ref["actions"][0], ref["segment"], videos) == action} or matches
+            if len(matches) > 1:
+                raise ValueError(f"动作 {action!r} 对应多个文件（{', '.join(sorted(matches))}），请用 file 指定")
+            file_name = next(iter(matches), f"{action}.mp4")
+        elif action is not None:
+            return file_name, action  # 明确指定了文件和提示词动作
+        # 给的可能是播放器动作（think），文件实际用的提示词动作以 clip_recipe 为准
+        ref = refs.get(file_name)
+        recipe = clip_recipe(file_name, ref["actions"][0], ref["segment"], videos) if ref else None
+        return file_name, recipe or action or os.path.splitext(file_name)[0]
+
+    def create_job(self, request: dict) -> str:
+        """校验请求并排队，返回任务 ID；参数有误时抛出 ValueError，调度线程已停止时抛出 SchedulerUnavailable"""
+        if not self.thread.is_alive():
+            raise SchedulerUnavailable("调度线程已停止，请查看服务日志并重启服务")
+        character_id = request.get("character")
+        if character_id not in list_characters():
+            raise ValueError(f"未知角色: {character_id!r}")
+        config = load_character(character_id)
+        action = request.get("action")
+        file_name = request.get("file")
+        if action is None and file_name is None:
+            raise ValueError("需要提供 action 或 file")
+        if action is not None and (not isinstance(action, str) or not ACTION_NAME_RE.fullmatch(action)):
+            raise ValueError("action 只能包含字母、数字、下划线和连字符")
+        if file_name is not None and (not isinstance(file_name, str) or not CLIP_FILE_RE.fullmatch(file_name)):
+            raise ValueError("file 必须是 assets 下的 .mp4 文件名，例如 speaking2.mp4")
+        file_name, action = self.resolve_clip(character_id, config["videos"], action, file_name)
+        prompt = request.get("prompt")
+        if prompt is None:
+            if action not in config["videos"]:
+                raise ValueError(f"未知动作 {action!r}，新动作需要提供 prompt")
+            prompt, duration = config["videos"][action]
+        elif not isinstance(prompt, str) or not prompt.strip():
+            raise ValueError("prompt 必须是非空字符串")
+        else:
+            prompt = prompt.replace("{character}", config["character"])
+            duration = config["videos"].get(action, (None, 6))[1]
+        duration = request.get("duration", duration)
+        if not isinstance(duration, int) or not DURATION_RANGE[0] <= duration <= DURATION_RANGE[1]:
+            raise ValueError(f"duration 必须是 {DURATION_RANGE[0]}-{DURATION_RANGE[1]} 之间的整数")
+        candidates = request.get("candidates", self.candidates)
+        if not isinstance(candidates, int) or not 1 <= candidates <= MAX_CANDIDATES:
+            raise ValueError(f"candidates 必须在 1 到 {MAX_CANDIDATES} 之间")
+        if candidates > 1 and not ffmpeg_available():
+            raise ValueError("多候选需要服务器上安装 ffmpeg")
+
+        start_frame = self._start_frame(character_id)
+        job = VideoJob(action, prompt, duration, start_frame,
+                       os.path.join(CHARACTERS_DIR, character_id, "assets"),
+                       compute_input_hash(VIDEO_MODEL, prompt, duration, start_frame.image_bytes),
+                       file_name=file_name, character=character_id, candidates=candidates,
+                       motion=config["motion"].get(action, "medium"))
+        job_id = uuid.uuid4().hex[:12]
+        with self.lock:
+            self.jobs[job_id] = job
+        print(f"[服务] 新任务 {job_id}: {job.label}")
+        self.scheduler.submit_threadsafe(job)
+        return job_id
+
+    def _on_complete(self, job: VideoJob, succeeded: bool):
+        """在调度线程中调用：更新前端资源清单、压缩日志、写运行日志"""
+        if succeeded:
+            write_asset_manifest(job.character)
+        compact_journal(job.assets_dir)
+        append_run_log(self.run_log, [job_record(job, "succeeded" if succeeded else "failed",
+                                                 self.run_id)])
+
+    def describe(self, job_id: str, job: VideoJob, detail: bool = True) -> dict:
+        info = {"id": job_id, "character": job.character, "action": job.action, "file": job.output_name}
+        info.update(job_status(job, self.scheduler.poller))
+        if detail:
+            info.update({
+                "duration": job.duration,
+                "candidates": job.candidates,
+                "hedged": job.hedged,
+                "tier": job.tier,
+                "attempts": job.attempts,
+                "key": job.key_fingerprint,
+                "phases": job_phases(job),
+                "error": job.error,
+                "output": os.path.relpath(job.output_path, PROJECT_DIR) if job.output_path else None,
+            })
+        return info
+
+    def get(self, job_id: str) -> Optional[VideoJob]:
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def list_jobs(self) -> list:
+        with self.lock:
+            items = list(self.jobs.items())
+        return [self.describe(job_id, job, detail=False) for job_id, job in items]
+
+    def health(self) -> dict:
+        scheduler = self.scheduler
+        health = {
+            "model": VIDEO_MODEL,
+            "scheduler": "running" if self.thread.is_alive() else "stopped",
+            "queued": len(scheduler.pending) + len(scheduler.inbox),
+            "generating": len(scheduler.poller),
+            "downloading": len(scheduler.downloads),
+            "postprocessing": len(scheduler.postprocessing),
+            "succeeded": len(scheduler.succeeded),
+            "failed": len(scheduler.failed),
+            "status_calls": scheduler.poller.status_calls,
+            "keys": [{"key": slot.label, "fingerprint": slot.fingerprint, "in_flight": slot.in_flight,
+                      "submitted": slot.submitted, "cooling": round(slot.cooling_for()),
+                      "disabled": slot.disabled}
+                     for slot in scheduler.key_pool.slots],
+        }
+        if scheduler.key_pool.coordinator:
+            # 所有进程共享的用量，同一组 Key 上其他生成进程的任务也算在内
+            usage = scheduler.key_pool.coordinator.usage(scheduler.key_pool.fingerprints)
+            for key in health["keys"]:
+                key["shared"] = usage[key["fingerprint"]]
+        return health
+
+
+class ServiceRequestHandler(BaseHTTPRequestHandler):
+    """POST /jobs 创建任务；GET /jobs、/jobs/<id>、/jobs/<id>/progress 查询；GET /health 服务状态
+
+    创建任务会消耗 API 配额，所以 POST 必须是 application/json（跨域时浏览器会先发预检），
+    带上启动时打印的令牌，并且只接受 --allow-origin 列出的页面发起的跨域请求。
+    """
+
+    service: GenerationService = None  # serve() 中绑定
+    token: str = None
+    allowed_origins: frozenset = frozenset()
+
+    def _cors_headers(self):
+        # 头像页面通常由另一个端口的静态服务器提供，只对列出的来源放行
+        origin = self.headers.get("Origin")
+        if origin and origin in self.allowed_origins:
+            self.send_header("Access-Control-Allow-Origin", origin)
+            self.send_header("Vary", "Origin")
+
+    def _send(self, status: int, body: dict):
+        data = json.dumps(body, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(data)))
+        self._cors_headers()
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_OPTIONS(self):
+        self.send_response(204)
+        self._cors_headers()
+        self.send_header("Access-Control-Allow-Methods", "GET, POST, OPTIONS")
+        self.send_header("Access-Control-Allow-Headers", f"Content-Type, {SERVE_TOKEN_HEADER}")
+        self.end_headers()
+
+    def do_GET(self):
+        parts = [part for part in self.path.split("?")[0].split("/") if part]
+        if parts == ["health"]:
+            health = self.service.health()
+            return self._send(200 if health["scheduler"] == "running" else 503, health)
+        if parts == ["jobs"]:
+            return self._send(200, {"jobs": self.service.list_jobs()})
+        if len(parts) in (2, 3) and parts[0] == "jobs":
+            job = self.service.get(parts[1])
+            if job is None:
+                return self._send(404, {"error": "任务不存在"})
+            if len(parts) == 2:
+                return self._send(200, self.service.describe(parts[1], job))
+            if parts[2] == "progress":
+                return self._send(200, self.service.describe(parts[1], job, detail=False))
+        self._send(404, {"error": "未知路径"})
+
+    def do_POST(self):
+        if self.path.split("?")[0].rstrip("/") != "/jobs":
+            return self._send(404, {"error": "未知路径"})
+        origin = self.headers.get("Origin")
+        if origin and origin not in self.allowed_origins:
+            return self._send(403, {"error": f"不接受来自 {origin} 的请求（见 --allow-origin）"})
+        if not hmac.compare_digest(self.headers.get(SERVE_TOKEN_HEADER, "").encode(), self.token.encode()):
+            return self._send(401, {"error": f"缺少或错误的 {SERVE_TOKEN_HEADER} 请求头"})
+        if self.headers.get_content_type() != "application/json":
+            return self._send(415, {"error": "请求体必须是 application/json"})
+        try:
+            length = int(self.headers.get("Content-Length") or 0)
+            request = json.loads(self.rfile.read(length) or b"{}")
+            if not isinstance(request, dict):
+                raise ValueError("请求体必须是 JSON 对象")
+            job_id = self.service.create_job(request)
+        except (ValueError, json.JSONDecodeError) as e:
+            return self._send(400, {"error": str(e)})
+        except SchedulerUnavailable as e:
+            return self._send(503, {"error": str(e)})
+        except Exception as e:
+            print(f"[服务] 创建任务出错: {type(e).__name__}: {e}")
+            return self._send(500, {"error": f"{type(e).__name__}: {e}"})
+        self._send(202, {"id": job_id, "status": "queued", "url": f"/jobs/{job_id}"})
+
+    def log_message(self, format, *args):
+        pass  # 任务进度已经打印到控制台，不再逐条打印 HTTP 访问日志
+
+
+def hedge_options(parser: argparse.ArgumentParser, args) -> Optional[dict]:
+    """校验 --hedge-model / --hedge-percentile，返回调度器的对冲参数"""
+    if not args.hedge_model:
+        if args.hedge_percentile != HEDGE_PERCENTILE:
+            parser.error("--hedge-percentile 需要配合 --hedge-model 使用")
+        return None
+    if args.hedge_model == VIDEO_MODEL:
+        parser.error(f"--hedge-model 不能和主模型相同 ({VIDEO_MODEL})")
+    if not 0 < args.hedge_percentile < 100:
+        parser.error("--hedge-percentile 必须在 0 到 100 之间")
+    return {"model": args.hedge_model, "percentile": args.hedge_percentile}
+
+
+def add_coordination_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument('--coordination', default=COORDINATION_PATH, metavar='PATH',
+                        help='多个生成进程共享 Key 租约、限速和冷却状态的 SQLite 文件 '
+                             f'(默认: {os.path.relpath(COORDINATION_PATH, PROJECT_DIR)})')
+    parser.add_argument('--no-coordination', action='store_true',
+                        help='不和其他进程协调，只在本进程内分配 Key')
+
+
+def make_key_pool(args) -> KeyPool:
+    coordinator = None if args.no_coordination else KeyCoordinator(args.coordination)
+    return KeyPool(args.api_key, rate_per_minute=args.key_rpm, coordinator=coordinator)
+
+
+def serve(argv: list):
+    """serve 子命令：启动本地 HTTP 服务，直到 Ctrl+C"""
+    parser = argparse.ArgumentParser(prog="generate_videos_veo.py serve",
+                                     description='常驻服务：通过本地 HTTP API 接收视频生成任务')
+    parser.add_argument('--api-key', '-k', nargs='+', required=True, help='Google AI API Key（可提供多个）')
+    parser.add_argument('--host', default=SERVE_HOST, help=f'监听地址 (默认: {SERVE_HOST}，只允许本机访问)')
+    parser.add_argument('--port', type=int, default=SERVE_PORT, help=f'监听端口 (默认: {SERVE_PORT})')
+    parser.add_argument('--allow-origin', nargs='+', default=[], metavar='ORIGIN',
+                        help='允许跨域创建任务的页面来源，例如 http://localhost:8000 (默认: 不允许跨域)')
+    parser.add_argument('--token', default=os.environ.get("VEO_SERVE_TOKEN"),
+                        help=f'创建任务时 {SERVE_TOKEN_HEADER} 请求头必须带的令牌 '
+                             '(默认: 环境变量 VEO_SERVE_TOKEN，未设置时启动时随机生成)')
+    parser.add_argument('--parallel', '-p', type=int, default=2, help='同时在服务端生成的视频数量上限 (默认: 2)')
+    parser.add_argument('--key-rpm', type=float, default=KEY_SUBMITS_PER_MINUTE,
+                        help=f'每个 API Key 每分钟最多提交的请求数 (默认: {KEY_SUBMITS_PER_MINUTE})')
+    parser.add_argument('--no-crop', action='store_true', help='不把起始帧裁剪到 9:16')
+    parser.add_argument('--transcode', action='store_true', help='下载后转码为网页版本（同主命令）')
+    parser.add_argument('--loop-trim', action='store_true', help='后处理时检测并剪切循环点（同主命令）')
+    parser.add_argument('--candidates', type=int, default=1, metavar='N',
+                        help='默认每个任务的候选数，请求中的 candidates 字段可覆盖 (默认: 1)')
+    parser.add_argument('--run-log', default=RUN_LOG_PATH, help='运行日志路径（同主命令）')
+    parser.add_argument('--hedge-model', metavar='MODEL', help='对冲用的备用模型（同主命令）')
+    parser.add_argument('--hedge-percentile', type=float, default=HEDGE_PERCENTILE,
+                        help=f'发起对冲的耗时百分位 (默认: {HEDGE_PERCENTILE})')
+    add_coordination_arguments(parser)
+    args = parser.parse_args(argv)
+
+    if args.parallel < 1:
+        parser.error("--parallel 必须 >= 1")
+    if args.key_rpm <= 0:
+        parser.error("--key-rpm 必须 > 0")
+    if not 1 <= args.candidates <= MAX_CANDIDATES:
+        parser.error(f"--candidates 必须在 1 到 {MAX_CANDIDATES} 之间")
+    if (args.transcode or args.loop_trim or args.candidates > 1) and not ffmpeg_available():
+        parser.error("--transcode / --loop-trim / --candidates 需要 ffmpeg")
+    if args.loop_trim or args.candidates > 1:
+        import_numpy()
+    hedge = hedge_options(parser, args)
+    import_genai()
+
+    postprocess_options = {}
+    if args.transcode:
+        postprocess_options["transcode"] = {"max_bitrate": WEB_MAX_BITRATE, "renditions": []}
+    if args.loop_trim:
+        postprocess_options["loop"] = {"threshold": LOOP_THRESHOLD, "min_keep": LOOP_MIN_KEEP}
+
+    key_pool = make_key_pool(args)
+    service = GenerationService(key_pool, args.parallel, postprocess_options,
+                                crop=not args.no_crop, candidates=args.candidates,
+                                run_log=args.run_log, hedge=hedge)
+    token = args.token or secrets.token_urlsafe(16)
+    handler = type("Handler", (ServiceRequestHandler,), {
+        "service": service, "token": token,
+        "allowed_origins": frozenset(origin.rstrip("/") for origin in args.allow_origin),
+    })
+    try:
+        httpd = ThreadingHTTPServer((args.host, args.port), handler)
+    except OSError as e:
+        parser.error(f"无法监听 {args.host}:{args.port}: {e}")
+    service.start()
+    print("=" * 50)
+    print("Veo 生成服务")
+    print("=" * 50)
+    print(f"模型: {VIDEO_MODEL}")
+    print(f"API Keys: {len(args.api_key)} 个, 并发数: {args.parallel}")
+    if key_pool.coordinator:
+        print(f"Key 协调: {key_pool.coordinator.path}")
+    if hedge:
+        print(f"对冲: 超过 p{args.hedge_percentile:g} 耗时后同时提交给 {args.hedge_model}")
+    print(f"地址: http://{args.host}:{args.port}")
+    print(f"令牌: {token}（创建任务时放在 {SERVE_TOKEN_HEADER} 请求头中）")
+    if args.allow_origin:
+        print(f"允许跨域: {', '.join(sorted(handler.allowed_origins))}")
+    print('  POST /jobs  {"character": "fox-xiaoli", "action": "wave", "file": "（可选）", "prompt": "（可选）"}')
+    print("  GET  /jobs, /jobs/<id>, /jobs/<id>/progress, /health")
+    print("按 Ctrl+C 停止（进行中的 operation 已写入任务日志，可用 --resume 继续）")
+    print("=" * 50)
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        print("\n正在停止...")
+    finally:
+        httpd.server_close()
+        service.shutdown()
+        key_pool.close()
+
+
+# ============================================================
+# 分片：多台机器各生成一部分，merge 子命令校验后合并到 assets/
+# ============================================================
+
+SHARD_RESULT_PATTERN = "shard-{index}-of-{count}.json"
+
+
+def parse_shard(value: str) -> tuple:
+    """'2/4' → (2, 4)，分片编号从 1 开始"""
+    match = re.fullmatch(r"(\d+)/(\d+)", value)
+    if not match or not 1 <= int(match.group(1)) <= int(match.group(2)):
+        raise argparse.ArgumentTypeError("格式应为 i/n，且 1 <= i <= n，例如 2/4")
+    return int(match.group(1)), int(match.group(2))
+
+
+def shard_of(character_id: str, file_name: str, count: int) -> int:
+    """文件属于哪个分片（1 开始）；只取决于角色和文件名，每台机器算出的结果相同"""
+    digest = hashlib.sha256(f"{character_id}/{file_name}".encode("utf-8")).digest()
+    return int.from_bytes(digest[:8], "big") % count + 1
+
+
+def write_shard_result(out_dir: str, shard: tuple, run_id: str, plans: list, failed: list) -> str:
+    """写分片结果清单：本分片产出的每个文件的哈希和生成 manifest 记录
+
+    清单按暂存目录里的生成 manifest 汇总，之前中断的运行（--resume）已完成的文件也包含在内。
+    """
+    files = []
+    for plan in plans:
+        manifest = load_manifest(plan.output_dir)
+        for clip in plan.clips:
+            entry = manifest["assets"].get(clip.file_name)
+            if not entry or "input_hash" not in entry \
+                    or not os.path.exists(os.path.join(plan.output_dir, clip.file_name)):
+                continue
+            # 主文件带上生成 manifest 记录，低分辨率版本跟在后面
+            names = [clip.file_name] + [name for name in entry.get("variants", {}) if name != clip.file_name]
+            for name in names:
+                path = os.path.join(plan.output_dir, name)
+                item = {"character": plan.character_id, "file": name,
+                        "sha256": file_sha256(path), "bytes": os.path.getsize(path)}
+                if name == clip.file_name:
+                    item["entry"] = entry
+                files.append(item)
+    result = {
+        "version": 1,
+        "shard": shard[0],
+        "count": shard[1],
+        "run": run_id,
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "files": files,
+        "failed": [{"character": job.character, "file": job.output_name, "error": job.error}
+                   for job in failed],
+    }
+    path = os.path.join(out_dir, SHARD_RESULT_PATTERN.format(index=shard[0], count=shard[1]))
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(result, f, ensure_ascii=False, indent=2)
+        f.write("\n")
+    os.replace(tmp_path, path)
+    return path
+
+
+def install_file(src: str, dst: str):
+    """复制到目标目录的临时文件再替换，播放器不会读到写了一半的视频"""
+    os.makedirs(os.path.dirname(dst), exist_ok=True)
+    tmp_path = dst + ".part" + os.path.splitext(dst)[1]
+    shutil.copyfile(src, tmp_path)
+    adopt_before_replace(dst)
+    os.replace(tmp_path, dst)
+
+
+def merge(argv: list):
+    """merge 子命令：校验各分片的输出，安装到各角色的 assets/ 并更新 manifest"""
+    parser = argparse.ArgumentParser(prog="generate_videos_veo.py merge",
+                                     description='合并 --shard 各分片的输出到 characters/<id>/assets/')
+    parser.add_argument('dirs', nargs='+', metavar='DIR', help='分片输出目录（--shard-out 指定的目录）')
+    parser.add_argument('--allow-partial', action='store_true', help='缺少部分分片时也合并已有的分片')
+    parser.add_argument('--dry-run', action='store_true', help='只校验，不写入 assets/')
+    args = parser.parse_args(argv)
+
+    results = []
+    for out_dir in args.dirs:
+        paths = sorted(glob.glob(os.path.join(out_dir, SHARD_RESULT_PATTERN.format(index="*", count="*"))))
+        if not paths:
+            parser.error(f"{out_dir} 中没有分片结果清单 (shard-*-of-*.json)")
+        for path in paths:
+            with open(path, encoding="utf-8") as f:
+                results.append((out_dir, json.load(f)))
+
+    counts = {result["count"] for _, result in results}
+    if len(counts) != 1:
+        parser.error(f"分片总数不一致: {sorted(counts)}，不是同一次分片生成的输出")
+    count = counts.pop()
+    indexes = [result["shard"] for _, result in results]
+    duplicates = sorted({i for i in indexes if indexes.count(i) > 1})
+    if duplicates:
+        parser.error(f"分片重复: {', '.join(f'{i}/{count}' for i in duplicates)}")
+    missing = sorted(set(range(1, count + 1)) - set(indexes))
+    if missing:
+        message = f"缺少分片: {', '.join(f'{i}/{count}' for i in missing)}"
+        if not args.allow_partial:
+            parser.error(message + "（使用 --allow-partial 只合并已有分片）")
+        print(f"⚠ {message}")
+
+    # 先全部校验，任何一个文件不对都不写入，避免 assets/ 里混入一半新一半旧的结果
+    characters = list_characters()
+    installs = []
+    errors = []
+    for out_dir, result in sorted(results, key=lambda item: item[1]["shard"]):
+        for item in result["files"]:
+            src = os.path.join(out_dir, item["character"], item["file"])
+            if item["character"] not in characters:
+                errors.append(f"{item['character']}/{item['file']}: 未知角色")
+            elif os.path.basename(item["file"]) != item["file"]:
+                errors.append(f"{item['character']}/{item['file']}: 文件名不合法")
+            elif not os.path.exists(src):
+                errors.append(f"{item['character']}/{item['file']}: 文件不存在")
+            elif file_sha256(src) != item["sha256"]:
+                errors.append(f"{item['character']}/{item['file']}: sha256 不匹配")
+            else:
+                installs.append((out_dir, item))
+        for failure in result["failed"]:
+            print(f"⚠ 分片 {result['shard']}/{count} 未完成: {failure['character']}/{failure['file']} "
+                  f"({failure['error']})")
+    if errors:
+        print("❌ 校验失败，未写入任何文件:")
+        for error in errors:
+            print(f"  {error}")
+        sys.exit(1)
+    print(f"✓ {len(results)} 个分片、{len(installs)} 个文件校验通过")
+    if args.dry_run:
         return
 
-    if not args.api_key:
-        parser.error("--api-key / -k 参数是必须的（可提供多个 key 轮换使用）")
+    touched = {}
+    for out_dir, item in installs:
+        character_id = item["character"]
+        assets_dir = os.path.join(CHARACTERS_DIR, character_id, "assets")
+        install_file(os.path.join(out_dir, character_id, item["file"]),
+                     os.path.join(assets_dir, item["file"]))
+        touched.setdefault(character_id, []).append(item["file"])
+        raw_path = os.path.join(out_dir, character_id, RAW_CACHE_DIR, item["file"])
+        if "entry" in item and os.path.exists(raw_path):
+            install_file(raw_path, os.path.join(assets_dir, RAW_CACHE_DIR, item["file"]))
+    # 所有文件（包括低分辨率版本）都就位后再更新 manifest、入库
+    for out_dir, item in installs:
+        entry = item.get("entry")
+        if entry is None:
+            continue  # 低分辨率版本，记录在主文件的 entry 里
+        assets_dir = os.path.join(CHARACTERS_DIR, item["character"], "assets")
+        manifest = load_manifest(assets_dir)
+        remove_stale_variants(assets_dir, item["file"], manifest["assets"].get(item["file"], {}), entry)
+        manifest["assets"][item["file"]] = entry
+        save_manifest(assets_dir, manifest)
+        store_commit(assets_dir, item["file"], "merge", entry, sha256=item["sha256"])
+    for character_id, files in touched.items():
+        write_asset_manifest(character_id)
+        print(f"✓ {character_id}: {', '.join(files)}")
 
-    api_keys = args.api_key
-    current_key_index = [0]  # 用 list 以便在闭包中修改
 
-    def get_video_client():
-        """获取当前 API Key 的 client"""
-        return genai.Client(
-            http_options={"api_version": "v1beta"},
-            api_key=api_keys[current_key_index[0]],
-        )
+# ============================================================
+# 历史版本：history / rollback 子命令，从内容仓库恢复任意一次的产出
+# ============================================================
 
-    def rotate_key():
-        """切换到下一个 API Key"""
-        if len(api_keys) > 1:
-            old_idx = current_key_index[0]
-            current_key_index[0] = (current_key_index[0] + 1) % len(api_keys)
-            print(f"  🔑 切换 API Key: #{old_idx + 1} → #{current_key_index[0] + 1}")
-            return True
-        return False
+def current_sha256(assets_dir: str, file_name: str) -> Optional[str]:
+    """assets 下文件当前的内容（可能被 cp 等手工改过，每次重新计算）"""
+    path = os.path.join(assets_dir, file_name)
+    return file_sha256(path) if os.path.exists(path) else None
+
+
+def resolve_version(versions: list, current: Optional[str], ref: Optional[str]) -> dict:
+    """ref 为 @N（history 中的序号）或 sha256 前缀；省略时取当前版本之前最近的另一个版本"""
+    if ref is None:
+        newer = [i for i, record in enumerate(versions) if record["sha256"] == current]
+        for record in reversed(versions[:newer[-1] if newer else len(versions)]):
+            if record["sha256"] != current:
+                return record
+        raise ValueError("没有更早的版本")
+    if ref.startswith("@"):
+        if not ref[1:].isdigit() or not 1 <= int(ref[1:]) <= len(versions):
+            raise ValueError(f"版本序号应在 @1 到 @{len(versions)} 之间")
+        return versions[int(ref[1:]) - 1]
+    matches = [record for record in versions if record["sha256"].startswith(ref)]
+    if len({record["sha256"] for record in matches}) != 1:
+        raise ValueError(f"{ref!r} {'匹配多个版本' if matches else '没有匹配的版本'}")
+    return matches[-1]
+
+
+def show_history(argv: list):
+    """history 子命令：列出一个角色的文件在内容仓库中的所有版本"""
+    parser = argparse.ArgumentParser(prog="generate_videos_veo.py history",
+                                     description='列出角色资源的历史版本（→ 为当前版本）')
+    parser.add_argument('--character', '-c', required=True, choices=list_characters(), help='角色 ID')
+    parser.add_argument('files', nargs='*', metavar='FILE', help='只列出这些文件 (默认: 全部)')
+    args = parser.parse_args(argv)
 
-    # 查找 idle 图片（支持 jpg 和 png）
-    idle_jpg = os.path.join(assets_dir, "idle.jpg")
-    idle_png = os.path.join(assets_dir, "idle.png")
+    assets_dir = os.path.join(CHARACTERS_DIR, args.character, "assets")
+    history = load_history(assets_dir)
+    if not history:
+        print(f"{args.character} 还没有历史记录（生成、合并或更新 manifest 时会自动入库）")
+        return
+    for file_name in args.files or sorted({record["file"] for record in history}):
+        versions = [record for record in history if record["file"] == file_name]
+        if not versions:
+            print(f"{file_name}: 没有历史记录")
+            continue
+        current = current_sha256(assets_dir, file_name)
+        current_index = max((i for i, r in enumerate(versions, 1) if r["sha256"] == current), default=None)
+        print(file_name)
+        for i, record in enumerate(versions, 1):
+            marker = "→" if i == current_index else " "
+            stamp = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(record["time"]))
+            model = f"  {record['entry'].get('model')}" if record.get("entry", {}).get("model") else ""
+            print(f" {marker} @{i:<3} {stamp}  {record['sha256'][:12]}  "
+                  f"{record['bytes'] / 1024 / 1024:6.2f}MB  {record['source']}{model}")
+
+
+def rollback(argv: list):
+    """rollback 子命令：把文件换回仓库中的某个版本"""
+    parser = argparse.ArgumentParser(prog="generate_videos_veo.py rollback",
+                                     description='把角色资源恢复到历史中的某个版本')
+    parser.add_argument('--character', '-c', required=True, choices=list_characters(), help='角色 ID')
+    parser.add_argument('file', metavar='FILE', help='要恢复的文件，例如 wave.mp4')
+    parser.add_argument('--to', metavar='REF',
+                        help='目标版本：history 中的 @N 或 sha256 前缀 (默认: 当前版本的上一个版本)')
+    args = parser.parse_args(argv)
 
-    if os.path.exists(idle_jpg):
-        idle_image = idle_jpg
-    elif os.path.exists(idle_png):
-        # PNG → JPG 转换（处理 RGBA 透明通道）
-        print("=" * 50)
-        print("检测到 PNG 格式，转换为 JPG...")
-        print("=" * 50)
-        idle_image = convert_png_to_jpg(idle_png)
-        print()
-    else:
-        print(f"错误: 静态图不存在")
-        print(f"  请将 idle 图片放到: {assets_dir}/idle.jpg 或 idle.png")
+    assets_dir = os.path.join(CHARACTERS_DIR, args.character, "assets")
+    versions = load_history(assets_dir, args.file)
+    if not versions:
+        parser.error(f"{args.file} 没有历史记录")
+    current = current_sha256(assets_dir, args.file)
+    try:
+        target = resolve_version(versions, current, args.to)
+    except ValueError as e:
+        parser.error(str(e))
+    if target["sha256"] == current:
+        print(f"{args.file} 已经是这个版本 ({current[:12]})")
         return
 
-    # 裁剪检查
-    if not args.no_crop:
+    objects = {args.file: target["sha256"], **target.get("variants", {})}
+    missing = [name for name, sha256 in objects.items() if not os.path.exists(object_path(assets_dir, sha256))]
+    if missing:
+        parser.error(f"内容仓库中缺少对象: {', '.join(missing)}")
+    # 恢复前重新校验：对象内容和哈希不符时（例如旧版硬链接被 cp 改写过）宁可不恢复
+    damaged = [name for name, sha256 in objects.items() if not verify_object(assets_dir, sha256)]
+    if damaged:
+        parser.error(f"内容仓库中的对象已损坏（内容和哈希不符）: {', '.join(damaged)}")
+    for name, sha256 in objects.items():
+        copy_replace(object_path(assets_dir, sha256), os.path.join(assets_dir, name))
+    if target.get("raw") and verify_object(assets_dir, target["raw"]):
+        copy_replace(object_path(assets_dir, target["raw"]), os.path.join(assets_dir, RAW_CACHE_DIR, args.file))
+    if "entry" in target:
+        # 连同生成记录一起恢复：prompt 之后改过的话，--plan 会把它标为过期
+        manifest = load_manifest(assets_dir)
+        remove_stale_variants(assets_dir, args.file, manifest["assets"].get(args.file, {}), target["entry"])
+        manifest["assets"][args.file] = target["entry"]
+        save_manifest(assets_dir, manifest)
+    append_history(assets_dir, dict(target, time=time.time(), source="rollback"))
+    write_asset_manifest(args.character)
+    print(f"✓ {args.file}: {current[:12] if current else '(不存在)'} → {target['sha256'][:12]} "
+          f"({time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(target['time']))}, {target['source']})")
+
+
+# ============================================================
+# 主函数
+# ============================================================
+
+class CharacterPlan:
+    """一个角色本次运行的准备结果：起始帧、生成计划、待生成 / 待恢复 / 跳过的文件"""
+
+    def __init__(self, character_id: str):
+        config = load_character(character_id)
+        self.character_id = character_id
+        self.name = config["name"]
+        self.emoji = config["emoji"]
+        self.videos = config["videos"]
+        self.motion = config["motion"]
+        self.candidates = 1
+        self.assets_dir = os.path.join(CHARACTERS_DIR, character_id, "assets")
+        self.output_dir = self.assets_dir  # 分片时写到 --shard-out 下的暂存目录，由 merge 安装
+        self.other_shards = 0
+        self.idle_image = None
+        self.start_frame = None
+        self.clips = []
+        self.jobs = []
+        self.resumed = []
+        self.postprocess_jobs = []
+        self.skipped = []
+
+    def prepare(self, args, postprocess_options: dict) -> bool:
+        """准备起始帧并筛选需要生成的动作，失败时打印原因并返回 False"""
         print("=" * 50)
-        print("检查图片尺寸...")
+        print(f"{self.emoji} {self.name} ({self.character_id}) 准备起始帧...")
         print("=" * 50)
-        success, message = check_and_crop_image(idle_image)
-        if not success:
+        # 查找 idle 图片（支持 jpg 和 png）
+        self.idle_image = find_idle_image(self.assets_dir)
+        if not self.idle_image:
+            print(f"错误: 静态图不存在")
+            print(f"  请将 idle 图片放到: {self.assets_dir}/idle.jpg 或 idle.png")
+            return False
+
+        # 起始帧预处理（透明通道、9:16 裁剪、缩放，结果按源图哈希缓存）；--plan 不改动 idle.jpg
+        prep_started = time.monotonic()
+        frame_path, message = prepare_start_frame(self.idle_image, crop=not args.no_crop,
+                                                  poster=not args.plan)
+        prep_seconds = time.monotonic() - prep_started
+        if not frame_path:
             print(f"\n❌ 错误: {message}")
-            return
+            return False
+        print(f"✓ {message}: {frame_path}")
         print()
 
-    # 选择要生成的动作
-    if args.action:
-        if args.action not in videos:
+        # 按播放器引用列出需要的文件，筛选缺失、过期、损坏的
+        self.candidates = args.candidates
+        self.start_frame = StartFrame(frame_path)
+        self.start_frame.prep_seconds = prep_seconds
+        self.clips = plan_clips(self.character_id, self.start_frame.image_bytes, force=args.force,
+                                regenerate_flagged=args.regenerate_flagged,
+                                only=args.action)
+        if not self.clips:
             print(f"错误: 未知动作 '{args.action}'")
-            print(f"可用动作: {', '.join(videos.keys())}")
-            return
-        videos_to_generate = {args.action: videos[args.action]}
+            print(f"可用动作: {', '.join(self.videos.keys())}")
+            return False
+        missing_prompts = [clip.file_name for clip in self.clips
+                           if clip.status == CLIP_NO_PROMPT and not clip.optional]
+        if missing_prompts:
+            print(f"⚠ prompts.json 中找不到这些文件的提示词: {', '.join(missing_prompts)}")
+        if args.shard:
+            index, count = args.shard
+            mine = [clip for clip in self.clips if shard_of(self.character_id, clip.file_name, count) == index]
+            self.other_shards = len(self.clips) - len(mine)
+            self.clips = mine
+            if args.shard_out:
+                self.output_dir = os.path.join(args.shard_out, self.character_id)
+        if args.plan:
+            return True
+        adopt_unrecorded_clips(self.assets_dir, self.clips, self.start_frame.image_bytes)
+        os.makedirs(self.output_dir, exist_ok=True)
+
+        manifest = load_manifest(self.assets_dir)
+        interrupted = {record.get("file") or f"{record['action']}.mp4": record
+                       for record in load_pending_operations(self.output_dir)}
+        if interrupted and not args.resume:
+            print(f"⚠ 发现 {len(interrupted)} 个上次未完成的 operation: {', '.join(interrupted)}")
+            print("  使用 --resume 继续轮询，避免重复提交")
+        for clip in self.clips:
+            if clip.status == CLIP_NO_PROMPT:
+                continue
+            if args.resume and clip.file_name in interrupted:
+                record = interrupted[clip.file_name]
+                self.resumed.append((self._job(clip, record["input_hash"]), record))
+                continue
+            if not clip.needs_generation:
+                if needs_postprocess(manifest, clip.file_name, postprocess_options):
+                    self.postprocess_jobs.append(self._job(clip))
+                    if self.output_dir != self.assets_dir:
+                        self._stage_for_postprocess(clip.file_name)
+                else:
+                    self.skipped.append(clip.file_name)
+                continue
+            self.jobs.append(self._job(clip))
+        return True
+
+    def _stage_for_postprocess(self, file_name: str):
+        """分片只重新后处理时，把原始视频和生成记录复制到暂存目录"""
+        raw_path = os.path.join(self.assets_dir, RAW_CACHE_DIR, file_name)
+        if not os.path.exists(raw_path):
+            raw_path = os.path.join(self.assets_dir, file_name)
+        install_file(raw_path, os.path.join(self.output_dir, RAW_CACHE_DIR, file_name))
+        staged = load_manifest(self.output_dir)
+        staged["assets"][file_name] = load_manifest(self.assets_dir)["assets"][file_name]
+        save_manifest(self.output_dir, staged)
+
+    def _job(self, clip: PlannedClip, input_hash: str = None) -> VideoJob:
+        prompt, duration = self.videos[clip.recipe]
+        return VideoJob(clip.recipe, prompt, duration, self.start_frame, self.output_dir,
+                        input_hash or clip.input_hash, file_name=clip.file_name,
+                        character=self.character_id, candidates=self.candidates,
+                        motion=self.motion[clip.recipe])
+
+    def schedule(self, scheduler: "VideoScheduler"):
+        """先恢复未完成的 operation，再排队新任务"""
+        for job, record in self.resumed:
+            if not scheduler.resume(job, record):
+                print(f"  [{job.label}] 提交它的 API Key 不在本次 --api-key 列表中，重新提交")
+                journal_append(self.output_dir, {"event": "finished", "operation": record["operation"],
+                                                 "status": "abandoned", "time": time.time()})
+                job.input_hash = compute_input_hash(VIDEO_MODEL, job.prompt, job.duration,
+                                                    self.start_frame.image_bytes)
+                self.jobs.append(job)
+        for job in self.jobs:
+            scheduler.add(job)
+        for job in self.postprocess_jobs:
+            scheduler.add_postprocess(job)
+
+
+def main():
+    if sys.argv[1:2] == ["serve"]:
+        return serve(sys.argv[2:])
+    if sys.argv[1:2] == ["merge"]:
+        return merge(sys.argv[2:])
+    if sys.argv[1:2] == ["history"]:
+        return show_history(sys.argv[2:])
+    if sys.argv[1:2] == ["rollback"]:
+        return rollback(sys.argv[2:])
+    characters = list_characters()
+    parser = argparse.ArgumentParser(
+        description='使用 Google Veo API 为数字人角色生成动作视频',
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog=f"可用角色: {', '.join(characters)}\n"
+               f"常驻服务: generate_videos_veo.py serve -k KEY（详见 serve --help）\n"
+               f"合并分片: generate_videos_veo.py merge DIR...（详见 merge --help）\n"
+               f"历史版本: generate_videos_veo.py history -c ID / rollback -c ID FILE"
+    )
+    parser.add_argument('--api-key', '-k', nargs='+', help='Google AI API Key（可提供多个，并发任务分摊到所有 Key 上）')
+    parser.add_argument('--character', '-c', action='extend', nargs='+',
+                        help=f'角色 ID，可指定多个 (默认: fox-xiaoli, 可选: {", ".join(characters)})')
+    parser.add_argument('--all', action='store_true', help='生成 characters/index.json 中的所有角色')
+    parser.add_argument('--action', '-a', help='只生成指定动作的视频（播放器动作、提示词动作或文件名）')
+    parser.add_argument('--plan', action='store_true',
+                        help='只打印生成计划：播放器引用的文件中哪些缺失、过期、损坏，不调用 API')
+    parser.add_argument('--list', '-l', action='store_true', help='列出所有可用动作')
+    parser.add_argument('--manifest-only', action='store_true',
+                        help='不生成视频，只根据现有文件重新生成 assets/manifest.json')
+    parser.add_argument('--no-crop', action='store_true', help='不把起始帧裁剪到 9:16')
+    parser.add_argument('--parallel', '-p', type=int, default=1,
+                        help='同时在服务端生成的视频数量上限 (默认: 1，即逐个生成)')
+    parser.add_argument('--force', '-f', action='store_true',
+                        help='忽略生成缓存，重新生成所有选中的动作')
+    parser.add_argument('--resume', action='store_true',
+                        help='先继续轮询上次中断时未完成的 operation，再提交新任务')
+    parser.add_argument('--key-rpm', type=float, default=KEY_SUBMITS_PER_MINUTE,
+                        help=f'每个 API Key 每分钟最多提交的请求数 (默认: {KEY_SUBMITS_PER_MINUTE})')
+    parser.add_argument('--transcode', action='store_true',
+                        help='下载后用 ffmpeg 转码为 faststart、无音轨、限码率的网页版本（原始文件保留在 .veo-cache/raw/）')
+    parser.add_argument('--renditions', type=int, nargs='+', default=[], metavar='HEIGHT',
+                        help='转码时额外输出的低分辨率版本高度，例如 960 640（输出 <动作>-640p.mp4）')
+    parser.add_argument('--max-bitrate', default=WEB_MAX_BITRATE,
+                        help=f'转码码率上限 (默认: {WEB_MAX_BITRATE})')
+    parser.add_argument('--loop-trim', action='store_true',
+                        help='后处理时检测循环点：剪到和第一帧最接近的位置，接缝仍明显的视频会被标记')
+    parser.add_argument('--loop-threshold', type=float, default=LOOP_THRESHOLD,
+                        help=f'循环接缝（和第一帧的平均像素差，0-1）超过此值时标记 (默认: {LOOP_THRESHOLD})')
+    parser.add_argument('--regenerate-flagged', action='store_true',
+                        help='重新生成上次被标记为循环接缝明显的动作')
+    parser.add_argument('--candidates', type=int, default=1, metavar='N',
+                        help=f'每个动作一次请求 N 个候选视频（最多 {MAX_CANDIDATES}），按首尾帧相似度和运动量自动选用最好的一个 (默认: 1)')
+    parser.add_argument('--run-log', default=RUN_LOG_PATH,
+                        help='每个任务的分阶段耗时追加到此 JSONL 文件 (默认: 项目根目录 .veo-cache/runs.jsonl)')
+    parser.add_argument('--hedge-model', metavar='MODEL',
+                        help='对冲：主模型运行时间超过历史耗时百分位时，同时提交给这个备用模型，先完成者胜出')
+    parser.add_argument('--hedge-percentile', type=float, default=HEDGE_PERCENTILE,
+                        help=f'发起对冲的耗时百分位 (默认: {HEDGE_PERCENTILE})')
+    add_coordination_arguments(parser)
+    parser.add_argument('--shard', type=parse_shard, metavar='I/N',
+                        help='只生成第 I 个分片（共 N 个，按角色和文件名哈希划分），输出写到 --shard-out')
+    parser.add_argument('--shard-out', metavar='DIR',
+                        help='分片输出目录，之后用 merge 子命令合并到 assets/')
+    parser.add_argument('--metrics-textfile', metavar='PATH',
+                        help='同时把本次运行指标写成 Prometheus textfile（供 node_exporter 采集），例如 /var/lib/node_exporter/veo.prom')
+
+    args = parser.parse_args()
+
+    # 验证角色
+    if args.all:
+        if args.character:
+            parser.error("--all 不能与 --character 同时使用")
+        character_ids = characters
     else:
-        videos_to_generate = videos
+        character_ids = list(dict.fromkeys(args.character or ['fox-xiaoli']))
+    unknown = [c for c in character_ids if c not in characters]
+    if unknown:
+        print(f"错误: 未知角色 {', '.join(repr(c) for c in unknown)}")
+        print(f"可用角色: {', '.join(characters)}")
+        return
+
+    if args.list:
+        for character_id in character_ids:
+            char_config = load_character(character_id)
+            print(f"{char_config['emoji']} {char_config['name']} ({character_id}) 可用动作:")
+            for action, (prompt, duration) in char_config["videos"].items():
+                print(f"  - {action} ({duration}秒)")
+        return
+
+    if args.manifest_only:
+        for character_id in character_ids:
+            print(f"✓ 已更新: {write_asset_manifest(character_id)}")
+        return
+
+    if args.shard_out and not args.shard:
+        parser.error("--shard-out 需要配合 --shard 使用")
+    if args.shard and not (args.shard_out or args.plan):
+        parser.error("--shard 需要用 --shard-out 指定输出目录")
+
+    if args.plan:
+        for character_id in character_ids:
+            plan = CharacterPlan(character_id)
+            if not plan.prepare(args, {}):
+                return
+            print(f"{plan.emoji} {plan.name} ({character_id}) 生成计划（→ 表示需要生成）:")
+            print_plan(plan.clips)
+            todo = [clip for clip in plan.clips if clip.needs_generation]
+            print(f"需要生成: {len(todo)} 个, 已是最新: "
+                  f"{sum(1 for clip in plan.clips if clip.status == CLIP_OK)} 个"
+                  + (f", 属于其他分片: {plan.other_shards} 个" if args.shard else ""))
+            print()
+        return
+
+    if not args.api_key:
+        parser.error("--api-key / -k 参数是必须的（可提供多个 key 轮换使用）")
+    if args.parallel < 1:
+        parser.error("--parallel 必须 >= 1")
+    if args.key_rpm <= 0:
+        parser.error("--key-rpm 必须 > 0")
+    if (args.renditions or args.max_bitrate != WEB_MAX_BITRATE) and not args.transcode:
+        parser.error("--renditions / --max-bitrate 需要配合 --transcode 使用")
+    if not re.fullmatch(r"\d+[kKmM]", args.max_bitrate):
+        parser.error("--max-bitrate 格式应为数字加 k/M，例如 1500k、2M")
+    if args.transcode and not ffmpeg_available():
+        parser.error("--transcode 需要 ffmpeg，请先安装 ffmpeg 并确保它在 PATH 中")
+    if args.loop_threshold != LOOP_THRESHOLD and not args.loop_trim:
+        parser.error("--loop-threshold 需要配合 --loop-trim 使用")
+    if args.loop_trim:
+        if not ffmpeg_available():
+            parser.error("--loop-trim 需要 ffmpeg，请先安装 ffmpeg 并确保它在 PATH 中")
+        import_numpy()
+    if not 1 <= args.candidates <= MAX_CANDIDATES:
+        parser.error(f"--candidates 必须在 1 到 {MAX_CANDIDATES} 之间")
+    if args.candidates > 1:
+        if not ffmpeg_available():
+            parser.error("--candidates 需要 ffmpeg 解码候选视频进行评分")
+        import_numpy()
+    hedge = hedge_options(parser, args)
+
+    import_genai()  # 依赖缺失时在准备工作之前就报错
+    api_keys = args.api_key
+    postprocess_options = {}
+    if args.transcode:
+        postprocess_options["transcode"] = {
+            "max_bitrate": args.max_bitrate,
+            "renditions": sorted(set(args.renditions), reverse=True),
+        }
+    if args.loop_trim:
+        postprocess_options["loop"] = {"threshold": args.loop_threshold, "min_keep": LOOP_MIN_KEEP}
+
+    plans = []
+    for character_id in character_ids:
+        plan = CharacterPlan(character_id)
+        if not plan.prepare(args, postprocess_options):
+            return
+        plans.append(plan)
 
     print("=" * 50)
-    print(f"{char_emoji} {char_name} - Veo 视频生成器")
+    print("Veo 视频生成器")
     print("=" * 50)
-    print(f"角色: {char_name} ({args.character})")
     print(f"模型: {VIDEO_MODEL}")
-    print(f"静态图: {idle_image}")
-    print(f"输出目录: {assets_dir}")
-    print(f"API Keys: {len(api_keys)} 个")
-    print(f"待生成视频: {len(videos_to_generate)} 个")
+    print(f"API Keys: {len(api_keys)} 个" + ("" if args.no_coordination else f"（与其他进程共享: {args.coordination}）"))
+    print(f"并发数: {args.parallel}")
+    if args.shard:
+        print(f"分片: {args.shard[0]}/{args.shard[1]}，输出到 {args.shard_out}")
+    if args.candidates > 1:
+        print(f"候选数: 每个动作 {args.candidates} 个，自动选优")
+    if hedge:
+        print(f"对冲: 超过 p{args.hedge_percentile:g} 耗时后同时提交给 {args.hedge_model}")
+    if args.transcode:
+        renditions = ", ".join(f"{h}p" for h in postprocess_options["transcode"]["renditions"])
+        print(f"转码: 码率上限 {args.max_bitrate}" + (f", 额外分辨率 {renditions}" if renditions else ""))
+    if args.loop_trim:
+        print(f"循环点检测: 接缝阈值 {args.loop_threshold}")
+    for plan in plans:
+        print(f"{plan.emoji} {plan.name} ({plan.character_id})")
+        print(f"  静态图: {plan.idle_image}")
+        print(f"  输出目录: {plan.output_dir}")
+        print(f"  待生成视频: {len(plan.jobs)} 个")
+        if plan.resumed:
+            print(f"  恢复未完成: {len(plan.resumed)} 个")
+        if plan.postprocess_jobs:
+            print(f"  只需重新后处理: {', '.join(job.clip for job in plan.postprocess_jobs)}")
+        if plan.skipped:
+            print(f"  已是最新，跳过: {', '.join(plan.skipped)}（使用 --force 强制重新生成）")
+        if plan.other_shards:
+            print(f"  属于其他分片: {plan.other_shards} 个")
     print("=" * 50)
 
-    success_count = 0
-    fail_count = 0
-
-    for action, (prompt, duration) in videos_to_generate.items():
-        # 尝试生成，遇到 429 则切换 key 重试
-        max_retries = len(api_keys)
-        for attempt in range(max_retries):
-            video_client = get_video_client()
-            result = generate_video(video_client, action, prompt, duration,
-                                    idle_image, assets_dir)
-            if result:
-                success_count += 1
-                # 每次成功后也轮换 key，均匀分配配额
-                if len(api_keys) > 1:
-                    rotate_key()
-                break
-            elif result is None:
-                # 检查是否是配额问题，尝试切换 key
-                if rotate_key():
-                    print(f"  重试 [{action}]...")
-                    continue
-                else:
-                    fail_count += 1
-                    break
-        else:
-            print(f"  所有 API Key 均已耗尽，跳过 [{action}]")
-            fail_count += 1
+    # 所有角色共用一个调度器和 Key 池
+    run_id = f"{time.strftime('%Y%m%dT%H%M%S')}-{os.getpid()}"
+    run_started = time.monotonic()
+    key_pool = make_key_pool(args)
+    scheduler = VideoScheduler(key_pool, parallel=args.parallel,
+                               postprocess_options=postprocess_options, hedge=hedge)
+    for plan in plans:
+        plan.schedule(scheduler)
+    scheduler.run()
+    for plan in plans:
+        compact_journal(plan.output_dir)
+        if not args.shard:
+            write_asset_manifest(plan.character_id)
+    if args.shard:
+        os.makedirs(args.shard_out, exist_ok=True)
+        shard_result = write_shard_result(args.shard_out, args.shard, run_id, plans, scheduler.failed)
+
+    job_records = ([job_record(job, "succeeded", run_id) for job in scheduler.succeeded]
+                   + [job_record(job, "failed", run_id) for job in scheduler.failed])
+    run_record = {
+        "event": "run",
+        "run": run_id,
+        "time": time.time(),
+        "duration": round(time.monotonic() - run_started, 3),
+        "model": VIDEO_MODEL,
+        "characters": character_ids,
+        "parallel": args.parallel,
+        "keys": len(api_keys),
+        "succeeded": len(scheduler.succeeded),
+        "failed": len(scheduler.failed),
+        "skipped": sum(len(plan.skipped) for plan in plans),
+        "status_calls": scheduler.poller.status_calls,
+        "hedge_model": args.hedge_model,
+        "hedges": scheduler.hedges_launched,
+        "hedge_wins": len(scheduler.hedge_wins),
+        "shard": "{}/{}".format(*args.shard) if args.shard else None,
+    }
+    append_run_log(args.run_log, job_records + [run_record])
+    if args.metrics_textfile:
+        write_prometheus_textfile(args.metrics_textfile, run_record, job_records)
 
     print("\n" + "=" * 50)
-    print(f"生成完成! 成功: {success_count}, 失败: {fail_count}")
+    print("生成完成!")
+    for plan in plans:
+        succeeded = [job.clip for job in scheduler.succeeded if job.character == plan.character_id]
+        failed = [job.clip for job in scheduler.failed if job.character == plan.character_id]
+        print(f"{plan.emoji} {plan.name}: 成功 {len(succeeded)}, 失败 {len(failed)}, "
+              f"跳过 {len(plan.skipped)}")
+        if failed:
+            print(f"  失败动作: {', '.join(failed)}")
+        flagged = [job.clip for job in scheduler.succeeded if job.character == plan.character_id
+                   and (job.postprocess or {}).get("loop", {}).get("flagged")]
+        if flagged:
+            print(f"  ⚠ 循环接缝明显: {', '.join(flagged)}")
+    if scheduler.hedges_launched:
+        wins = ", ".join(job.label for job in scheduler.hedge_wins) or "无"
+        print(f"对冲: 发起 {scheduler.hedges_launched} 次，备用模型胜出 {len(scheduler.hedge_wins)} 次 ({wins})")
+    if len(plans) > 1:
+        print(f"合计: 成功 {len(scheduler.succeeded)}, 失败 {len(scheduler.failed)}, "
+              f"跳过 {sum(len(plan.skipped) for plan in plans)}")
+    print_phase_summary(job_records, key_pool, scheduler.poller.status_calls)
+    key_pool.close()
+    if args.shard:
+        print(f"分片 {args.shard[0]}/{args.shard[1]} 结果清单: {shard_result}")
+        print(f"  所有分片完成后: generate_videos_veo.py merge {args.shard_out} ...")
+    print(f"总耗时: {run_record['duration']:.0f}秒，运行日志: {args.run_log}")
     print("=" * 50)
 
 
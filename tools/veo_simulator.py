@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+"""
+模拟后端：在本地模拟 Veo 服务端，测试和基准测试不消耗配额
+SimulatedBackend 与 generate_videos_veo.VeoBackend 接口相同，可直接交给 KeyPool 使用
+"""
+
+import time
+import random
+import struct
+import threading
+from collections import deque
+from types import SimpleNamespace
+from dataclasses import dataclass, field
+from typing import Optional
+
+from generate_videos_veo import ERROR_QUOTA, GenerationError
+
+
+class ScaledClock:
+    """加速时钟：模拟时间以真实时间的 scale 倍流逝，接口与 time 模块相同"""
+
+    def __init__(self, scale: float = 1.0):
+        self.scale = scale
+        self._origin = time.monotonic()
+
+    def monotonic(self) -> float:
+        return (time.monotonic() - self._origin) * self.scale
+
+    def sleep(self, seconds: float):
+        time.sleep(max(0.0, seconds) / self.scale)
+
+
+@dataclass
+class SimulationProfile:
+    """模拟服务端的行为参数（时间单位均为模拟秒）"""
+    queue_latency: float = 20.0       # 平均排队时间（指数分布）
+    generation_time: float = 60.0     # 平均生成时间
+    generation_jitter: float = 15.0   # 生成时间标准差
+    tail_rate: float = 0.0            # 长尾概率：这部分 operation 的生成时间乘以 tail_factor
+    tail_factor: float = 4.0
+    model_time_scale: dict = field(default_factory=dict)  # 模型 -> 生成时间倍数（对冲用的快速模型等）
+    rate_429: float = 0.0             # 每次提交随机返回 429 的概率
+    key_rpm_limit: float = 0          # 服务端每个 Key 每分钟提交上限，0 为不限
+    failure_rate: float = 0.0         # 生成失败（服务端内部错误）的概率
+    payload_bytes: int = 2_000_000    # 生成视频的大小
+    download_mbps: float = 0          # 下载带宽（MB/s），0 为不限速
+    seed: Optional[int] = None
+
+
+def _box(kind: bytes, body: bytes) -> bytes:
+    return struct.pack(">I4s", 8 + len(body), kind) + body
+
+
+def mp4_header(duration: float, timescale: int = 1000) -> bytes:
+    """最小的有效 MP4 开头：ftyp + moov/mvhd，mp4_duration、validate_mp4 都能正常解析"""
+    mvhd = struct.pack(">B3xIIII", 0, 0, 0, timescale, round(duration * timescale))
+    mvhd += struct.pack(">IH10x", 0x00010000, 0x0100)                                     # rate, volume
+    mvhd += struct.pack(">9I", 0x00010000, 0, 0, 0, 0x00010000, 0, 0, 0, 0x40000000)      # 单位矩阵
+    mvhd += bytes(24) + struct.pack(">I", 2)                                              # next_track_id
+    return _box(b"ftyp", b"mp42\0\0\0\0mp42isom") + _box(b"moov", _box(b"mvhd", mvhd))
+
+
+class SimulatedOperation:
+    """与 GenerateVideosOperation 字段相同的模拟 operation"""
+
+    def __init__(self, name: str, done: bool = False, error: dict = None, response=None):
+        self.name = name
+        self.done = done
+        self.error = error
+        self.response = response
+        self.metadata = None
+
+
+class SimulatedVeoServer:
+    """所有 SimulatedBackend 共享的服务端状态，同时统计各类 API 调用次数"""
+
+    def __init__(self, profile: SimulationProfile, clock=time):
+        self.profile = profile
+        self.clock = clock
+        self.rng = random.Random(profile.seed)
+        self.lock = threading.Lock()
+        self.operations = {}  # name -> (开始生成时间, 完成时间, 是否失败, 视频数, 视频时长)
+        self.recent_submits = {}  # api_key -> deque[提交时间]
+        self.submit_calls = 0
+        self.status_calls = 0
+        self.download_calls = 0
+        self.quota_rejections = 0
+
+    def submit(self, api_key: str, model: str, number_of_videos: int = 1,
+               duration: int = 6) -> SimulatedOperation:
+        p = self.profile
+        with self.lock:
+            self.submit_calls += 1
+            now = self.clock.monotonic()
+            window = self.recent_submits.setdefault(api_key, deque())
+            while window and window[0] <= now - 60:
+                window.popleft()
+            if (self.rng.random() < p.rate_429
+                    or (p.key_rpm_limit and len(window) >= p.key_rpm_limit)):
+                self.quota_rejections += 1
+                raise GenerationError("429 RESOURCE_EXHAUSTED (simulated)", ERROR_QUOTA)
+            window.append(now)
+            started_at = now + self.rng.expovariate(1 / p.queue_latency if p.queue_latency else float("inf"))
+            generation = max(1.0, self.rng.gauss(p.generation_time, p.generation_jitter))
+            generation *= p.model_time_scale.get(model, 1.0)
+            if self.rng.random() < p.tail_rate:
+                generation *= p.tail_factor
+            done_at = started_at + generation
+            name = f"models/{model}/operations/sim-{len(self.operations) + 1}"
+            self.operations[name] = (started_at, done_at, self.rng.random() < p.failure_rate,
+                                     number_of_videos, duration)
+        return SimulatedOperation(name)
+
+    def refresh(self, operation) -> SimulatedOperation:
+        with self.lock:
+            self.status_calls += 1
+            started_at, done_at, failed, count, _ = self.operations[operation.name]
+            now = self.clock.monotonic()
+            if now < done_at:
+                pending = SimulatedOperation(operation.name)
+                pending.metadata = {"state": "RUNNING" if now >= started_at else "QUEUED"}
+                return pending
+        if failed:
+            return SimulatedOperation(operation.name, True,
+                                      error={"code": 13, "message": "simulated internal error"})
+        videos = [SimpleNamespace(video=SimpleNamespace(uri=f"{operation.name}/{i}")) for i in range(count)]
+        response = SimpleNamespace(generated_videos=videos, rai_media_filtered_count=None,
+                                   rai_media_filtered_reasons=None)
+        return SimulatedOperation(operation.name, True, response=response)
+
+    def download(self, video, fileobj):
+        """写出 ftyp + moov 开头、mdat 补足到 payload_bytes 的视频"""
+        with self.lock:
+            self.download_calls += 1
+            duration = self.operations[video.video.uri.rsplit("/", 1)[0]][4]
+        p = self.profile
+        header = mp4_header(duration)
+        remaining = max(0, p.payload_bytes - len(header) - 8)
+        fileobj.write(header + struct.pack(">I4s", 8 + remaining, b"mdat"))
+        chunk = b"\0" * (1024 * 1024)
+        while remaining > 0:
+            n = min(remaining, len(chunk))
+            fileobj.write(chunk[:n])
+            remaining -= n
+            if p.download_mbps:
+                self.clock.sleep(n / (p.download_mbps * 1024 * 1024))
+
+
+class SimulatedBackend:
+    """与 VeoBackend 接口相同，请求发给本地的 SimulatedVeoServer"""
+
+    def __init__(self, api_key: str, server: SimulatedVeoServer):
+        self.api_key = api_key
+        self.server = server
+
+    def submit(self, model: str, prompt: str, start_frame, duration: int,
+               number_of_videos: int = 1):
+        return self.server.submit(self.api_key, model, number_of_videos, duration)
+
+    def refresh(self, operation):
+        return self.server.refresh(operation)
+
+    def is_running(self, operation) -> bool:
+        return (operation.metadata or {}).get("state") == "RUNNING"
+
+    def download(self, video, fileobj):
+        self.server.download(video, fileobj)
+
+    def operation_from_name(self, name: str):
+        return SimulatedOperation(name)